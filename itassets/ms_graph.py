@@ -0,0 +1,372 @@
+import asyncio
+import logging
+import random
+import re
+from collections import defaultdict, deque
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+GRAPH_API_URL = "https://graph.microsoft.com"
+# Maximum number of sub-requests in a single JSON batch request.
+# Reference: https://learn.microsoft.com/en-us/graph/json-batching
+BATCH_MAX_REQUESTS = 20
+LOGGER = logging.getLogger("itassets")
+# Path segments matching this pattern are object IDs (e.g. GUIDs, UPNs or SharePoint site IDs),
+# rather than resource or action names.
+GRAPH_ID_PATTERN = re.compile(r"^[0-9a-fA-F-]{32,36}$|^[0-9]+$|[@,'%:]")
+
+
+class GraphCircuitOpenError(requests.exceptions.RequestException):
+    """Raised when a request is refused because the circuit breaker for its Graph API endpoint is open."""
+
+
+class GraphRetryPolicy:
+    """Retry policy for Graph API requests. Throttled (429) and transient (5xx, connection error) failures
+    are retried, waiting for the Retry-After value returned (up to a limit) or else a jittered exponential backoff.
+    Retries are limited by a budget per endpoint (the request method and URL path, with any object IDs
+    normalised, e.g. "GET users/{id}") within a rolling window, so that a struggling endpoint is not flooded with retries. Each endpoint also
+    has a circuit breaker, which opens after a number of consecutive failed requests and refuses further
+    requests to that endpoint until a cooldown period has elapsed.
+    Reference: https://learn.microsoft.com/en-us/graph/throttling
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+    IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+    def __init__(
+        self,
+        max_retries: Optional[int] = None,
+        backoff_base: Optional[float] = None,
+        backoff_max: Optional[float] = None,
+        retry_after_max: Optional[float] = None,
+        retry_budget: Optional[int] = None,
+        budget_window: Optional[float] = None,
+        breaker_threshold: Optional[int] = None,
+        breaker_cooldown: Optional[float] = None,
+        equal_jitter: bool = False,
+    ):
+        self.max_retries = max_retries if max_retries is not None else settings.MS_GRAPH_MAX_RETRIES
+        self.backoff_base = backoff_base or settings.MS_GRAPH_BACKOFF_BASE
+        self.backoff_max = backoff_max or settings.MS_GRAPH_BACKOFF_MAX
+        self.retry_after_max = retry_after_max or settings.MS_GRAPH_RETRY_AFTER_MAX
+        self.retry_budget = retry_budget if retry_budget is not None else settings.MS_GRAPH_RETRY_BUDGET
+        self.budget_window = budget_window or settings.MS_GRAPH_RETRY_BUDGET_WINDOW
+        self.breaker_threshold = breaker_threshold or settings.MS_GRAPH_CIRCUIT_BREAKER_THRESHOLD
+        self.breaker_cooldown = breaker_cooldown or settings.MS_GRAPH_CIRCUIT_BREAKER_COOLDOWN
+        self.equal_jitter = equal_jitter
+        self.lock = Lock()
+        self.retries = defaultdict(deque)  # Endpoint: timestamps of recent retries.
+        self.failures = defaultdict(int)  # Endpoint: count of consecutive failed requests.
+        self.opened = {}  # Endpoint: time at which the circuit breaker opened.
+
+    @staticmethod
+    def get_endpoint(method: str, url: str) -> str:
+        """Returns the endpoint for the passed-in request method and Graph API URL, used to key retry budgets
+        and circuit breakers. Path segments which identify an object (GUIDs, UPNs, site IDs) are replaced
+        with "{id}", so that e.g. all requests to get a user share an endpoint.
+        """
+        segments = [segment for segment in urlparse(url).path.split("/") if segment]
+        if segments and segments[0] in ("v1.0", "beta"):
+            segments = segments[1:]
+        segments = ["{id}" if GRAPH_ID_PATTERN.search(segment) else segment for segment in segments]
+        return f"{method.upper()} {'/'.join(segments)}"
+
+    def backoff(self, attempt: int) -> float:
+        """Returns a delay (seconds) for the passed-in retry attempt (from zero), using exponential backoff
+        with "full jitter" so that concurrent clients do not retry in lockstep.
+        If the policy uses "equal jitter", the delay is at least half of the exponential backoff value.
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        if self.equal_jitter:
+            return delay / 2 + random.uniform(0, delay / 2)
+        return random.uniform(0, delay)
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[int]:
+        """Returns the number of seconds in the passed-in Retry-After header value, or None if the value
+        is absent or not a number of seconds (e.g. an HTTP date).
+        """
+        if value is not None and str(value).strip().isdigit():
+            return int(str(value).strip())
+        return None
+
+    def get_retry_after(self, value: Optional[str]) -> Optional[int]:
+        """Returns the number of seconds in the passed-in Retry-After header value (as per `parse_retry_after`),
+        capped at `retry_after_max` so that an excessive value cannot stall the caller.
+        """
+        retry_after = self.parse_retry_after(value)
+        if retry_after is not None:
+            return min(retry_after, self.retry_after_max)
+        return None
+
+    def get_delay(self, attempt: int, resp: Optional[requests.Response] = None) -> float:
+        """Returns the delay (seconds) before the passed-in retry attempt, honouring any Retry-After header."""
+        if resp is not None:
+            retry_after = self.get_retry_after(resp.headers.get("Retry-After"))
+            if retry_after is not None:
+                return retry_after
+        return self.backoff(attempt)
+
+    def is_retryable(self, method: str, resp: Optional[requests.Response] = None, exc: Optional[Exception] = None) -> bool:
+        """Returns True if the failed request may be retried. Throttled requests were not processed and may
+        always be retried; other failures are only retried for idempotent methods.
+        """
+        if exc is not None:
+            return method.upper() in self.IDEMPOTENT_METHODS
+        if resp.status_code == 429:
+            return True
+        return resp.status_code in self.RETRY_STATUSES and method.upper() in self.IDEMPOTENT_METHODS
+
+    def consume_budget(self, endpoint: str) -> bool:
+        """Returns True (and records a retry) if the retry budget for the passed-in endpoint is not exhausted."""
+        with self.lock:
+            now = monotonic()
+            retries = self.retries[endpoint]
+            while retries and now - retries[0] > self.budget_window:
+                retries.popleft()
+            if len(retries) >= self.retry_budget:
+                return False
+            retries.append(now)
+            return True
+
+    def check_circuit(self, endpoint: str) -> None:
+        """Raises GraphCircuitOpenError if the circuit breaker for the passed-in endpoint is open.
+        Once the cooldown has elapsed, requests are allowed through again (the circuit is "half-open"),
+        and the next result closes or re-opens the circuit.
+        """
+        with self.lock:
+            opened = self.opened.get(endpoint)
+            if opened is not None and monotonic() - opened < self.breaker_cooldown:
+                raise GraphCircuitOpenError(f"Circuit breaker open for Graph API endpoint {endpoint}")
+
+    def record_success(self, endpoint: str) -> None:
+        with self.lock:
+            self.failures[endpoint] = 0
+            self.opened.pop(endpoint, None)
+
+    def record_failure(self, endpoint: str) -> None:
+        with self.lock:
+            self.failures[endpoint] += 1
+            if self.failures[endpoint] >= self.breaker_threshold:
+                if endpoint not in self.opened:
+                    LOGGER.warning(f"Opening circuit breaker for Graph API endpoint {endpoint}")
+                self.opened[endpoint] = monotonic()
+
+    def should_retry(
+        self, method: str, endpoint: str, attempt: int, resp: Optional[requests.Response] = None, exc: Optional[Exception] = None
+    ) -> bool:
+        """Returns True after waiting the appropriate delay, if the failed request should be retried."""
+        if attempt >= self.max_retries or not self.is_retryable(method, resp, exc):
+            return False
+        if not self.consume_budget(endpoint):
+            LOGGER.warning(f"Retry budget exhausted for Graph API endpoint {endpoint}")
+            return False
+        delay = self.get_delay(attempt, resp)
+        LOGGER.info(f"Graph API request to {endpoint} failed, retrying in {delay:.1f} seconds")
+        sleep(delay)
+        return True
+
+
+class MSGraphClient:
+    """A client for the Microsoft Graph API, holding a pooled requests Session so that connections
+    to graph.microsoft.com are kept alive and reused between requests.
+    Request headers (including the Authorization header) are passed in per request, as for `requests`.
+    Failed requests are retried according to the client's GraphRetryPolicy.
+    """
+
+    def __init__(self, pool_size: Optional[int] = None, timeout: Optional[int] = None, retry_policy: Optional[GraphRetryPolicy] = None):
+        self.timeout = timeout or settings.MS_GRAPH_TIMEOUT
+        self.retry_policy = retry_policy or GraphRetryPolicy()
+        pool_size = pool_size or settings.MS_GRAPH_POOL_SIZE
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=pool_size))
+        self.session.headers.update({"Accept": "application/json"})
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        policy = self.retry_policy
+        endpoint = policy.get_endpoint(method, url)
+        policy.check_circuit(endpoint)
+        attempt = 0
+
+        while True:
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as exc:
+                if policy.should_retry(method, endpoint, attempt, exc=exc):
+                    attempt += 1
+                    continue
+                policy.record_failure(endpoint)
+                raise
+
+            if resp.status_code in policy.RETRY_STATUSES:
+                if policy.should_retry(method, endpoint, attempt, resp=resp):
+                    attempt += 1
+                    continue
+                policy.record_failure(endpoint)
+            else:
+                policy.record_success(endpoint)
+            return resp
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PATCH", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
+
+    def follow_pages(self, page: dict, headers: dict) -> Iterator[dict]:
+        """Yields the passed-in page of a paged OData collection, then each subsequent page in turn by
+        following @odata.nextLink. Each page is only requested as the previous one is consumed.
+        """
+        yield page
+        while "@odata.nextLink" in page:
+            resp = self.get(page["@odata.nextLink"], headers=headers)
+            resp.raise_for_status()
+            page = resp.json()
+            yield page
+
+    def iter_pages(self, url: str, headers: dict, params: Optional[dict] = None, page_size: Optional[int] = None) -> Iterator[dict]:
+        """Yields each page (the decoded JSON response) of a paged OData collection, starting from a GET request
+        to the passed-in URL. Pass `page_size` to request pages of that size (sets the $top parameter).
+        """
+        if page_size:
+            params = {**(params or {}), "$top": page_size}
+        resp = self.get(url, headers=headers, params=params)
+        resp.raise_for_status()
+        yield from self.follow_pages(resp.json(), headers)
+
+    def paginate(self, url: str, headers: dict, params: Optional[dict] = None, page_size: Optional[int] = None) -> Iterator[dict]:
+        """Yields the items of a paged OData collection one at a time, so that callers may consume the
+        results as a stream rather than holding every page in memory.
+        """
+        for page in self.iter_pages(url, headers, params=params, page_size=page_size):
+            yield from page["value"]
+
+    def batch(self, sub_requests: list, headers: dict, version: str = "v1.0", max_retries: int = 3) -> dict:
+        """Executes the passed-in list of sub-requests using JSON batching, up to 20 sub-requests per HTTP request.
+        Each sub-request is a dict having a unique `id`, a `method` and a `url` relative to the API version
+        (e.g. "/users/<id>"), and optionally a `body` dict and `headers`.
+        Sub-requests that fail with a 429 or 5xx status are retried up to `max_retries` times, waiting for the
+        longest Retry-After value returned (or the retry policy's backoff delay if none was returned).
+        Returns a dict of {id: sub-response}, each sub-response being a dict having `status` and `body` keys.
+        """
+        url = f"{GRAPH_API_URL}/{version}/$batch"
+        responses = {}
+        pending = []
+
+        for sub_request in sub_requests:
+            if "body" in sub_request:
+                sub_request = {**sub_request, "headers": {"Content-Type": "application/json", **sub_request.get("headers", {})}}
+            pending.append(sub_request)
+
+        attempt = 0
+        while pending:
+            retry = []
+            retry_after = None
+
+            for i in range(0, len(pending), BATCH_MAX_REQUESTS):
+                chunk = pending[i : i + BATCH_MAX_REQUESTS]
+                resp = self.post(url, headers=headers, json={"requests": chunk})
+                resp.raise_for_status()
+                sub_requests_by_id = {sub_request["id"]: sub_request for sub_request in chunk}
+
+                for sub_response in resp.json()["responses"]:
+                    responses[sub_response["id"]] = sub_response
+                    status = sub_response["status"]
+                    if status == 429 or status >= 500:
+                        retry.append(sub_requests_by_id[sub_response["id"]])
+                        sub_headers = {k.lower(): v for k, v in sub_response.get("headers", {}).items()}
+                        sub_retry_after = self.retry_policy.get_retry_after(sub_headers.get("retry-after"))
+                        if sub_retry_after is not None:
+                            retry_after = max(retry_after or 0, sub_retry_after)
+
+            if not retry or attempt >= max_retries:
+                break
+
+            sleep(retry_after if retry_after is not None else self.retry_policy.backoff(attempt))
+            attempt += 1
+            pending = retry
+
+        return responses
+
+
+MS_GRAPH_CLIENT: Optional[MSGraphClient] = None
+MS_GRAPH_CLIENT_LOCK = Lock()
+
+
+def get_graph_client() -> MSGraphClient:
+    """Returns the process-wide Graph API client, creating it on first use."""
+    global MS_GRAPH_CLIENT
+
+    with MS_GRAPH_CLIENT_LOCK:
+        if MS_GRAPH_CLIENT is None:
+            MS_GRAPH_CLIENT = MSGraphClient()
+
+    return MS_GRAPH_CLIENT
+
+
+class AsyncMSGraphClient:
+    """An asyncio wrapper around MSGraphClient, used to fan out many Graph API requests concurrently.
+    Requests are made by the (blocking) wrapped client in worker threads, and a semaphore bounds the
+    number in flight so that the tenant's rate limits and the connection pool are respected.
+    Throttled requests are retried by the wrapped client's retry policy as usual.
+    """
+
+    def __init__(self, client: Optional[MSGraphClient] = None, concurrency: Optional[int] = None):
+        self.client = client or get_graph_client()
+        self.semaphore = asyncio.Semaphore(concurrency or settings.MS_GRAPH_CONCURRENCY)
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Run the passed-in blocking callable in a worker thread, once a slot is available."""
+        async with self.semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        return await self.run(self.client.request, method, url, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> requests.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> requests.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def patch(self, url: str, **kwargs) -> requests.Response:
+        return await self.request("PATCH", url, **kwargs)
+
+    async def put(self, url: str, **kwargs) -> requests.Response:
+        return await self.request("PUT", url, **kwargs)
+
+    async def delete(self, url: str, **kwargs) -> requests.Response:
+        return await self.request("DELETE", url, **kwargs)
+
+    async def gather(self, calls: Iterable[Callable[[], Any]]) -> List:
+        """Run each of the passed-in blocking callables concurrently, returning their results in order.
+        Any exception raised by a callable is returned in place of its result.
+        """
+        return await asyncio.gather(*(self.run(call) for call in calls), return_exceptions=True)
+
+
+def run_concurrently(calls: Iterable[Callable[[], Any]], concurrency: Optional[int] = None) -> List:
+    """Synchronous wrapper around AsyncMSGraphClient.gather, for use in management commands (i.e. outside
+    of a running event loop). Callables should only make Graph API requests, not database queries.
+    """
+
+    async def gather():
+        return await AsyncMSGraphClient(concurrency=concurrency).gather(calls)
+
+    return asyncio.run(gather())
@@ -135,6 +135,31 @@ else:
         }
     }
 API_RESPONSE_CACHE_SECONDS = env("API_RESPONSE_CACHE_SECONDS", 60)
+# Flag to control whether MS Graph API access tokens are shared between processes via the cache.
+MS_GRAPH_TOKEN_SHARED_CACHE = env("MS_GRAPH_TOKEN_SHARED_CACHE", False)
+# Number of seconds before expiry at which a cached MS Graph API access token is refreshed.
+MS_GRAPH_TOKEN_REFRESH_MARGIN = env("MS_GRAPH_TOKEN_REFRESH_MARGIN", 300)
+# Maximum number of pooled connections to the Graph API per process, and the request timeout (seconds).
+MS_GRAPH_POOL_SIZE = env("MS_GRAPH_POOL_SIZE", 10)
+MS_GRAPH_TIMEOUT = env("MS_GRAPH_TIMEOUT", 60)
+# Maximum number of Graph API requests in flight concurrently when fanning out requests.
+MS_GRAPH_CONCURRENCY = env("MS_GRAPH_CONCURRENCY", 8)
+# Page size ($top) requested from paged Graph API collections that support it.
+MS_GRAPH_PAGE_SIZE = env("MS_GRAPH_PAGE_SIZE", 999)
+# Number of seconds for which the subscribed SKU (licence availability) snapshot is reused.
+MS_GRAPH_SKU_CACHE_TTL = env("MS_GRAPH_SKU_CACHE_TTL", 300)
+# Retry policy for failed Graph API requests: maximum retries per request, the exponential backoff
+# base/cap (seconds), the cap on any Retry-After value returned (seconds), the number of retries allowed
+# per endpoint within a rolling window (seconds), and the number of consecutive failures after which
+# requests to an endpoint are refused for a cooldown (seconds).
+MS_GRAPH_MAX_RETRIES = env("MS_GRAPH_MAX_RETRIES", 5)
+MS_GRAPH_BACKOFF_BASE = env("MS_GRAPH_BACKOFF_BASE", 1)
+MS_GRAPH_BACKOFF_MAX = env("MS_GRAPH_BACKOFF_MAX", 60)
+MS_GRAPH_RETRY_AFTER_MAX = env("MS_GRAPH_RETRY_AFTER_MAX", 300)
+MS_GRAPH_RETRY_BUDGET = env("MS_GRAPH_RETRY_BUDGET", 100)
+MS_GRAPH_RETRY_BUDGET_WINDOW = env("MS_GRAPH_RETRY_BUDGET_WINDOW", 60)
+MS_GRAPH_CIRCUIT_BREAKER_THRESHOLD = env("MS_GRAPH_CIRCUIT_BREAKER_THRESHOLD", 5)
+MS_GRAPH_CIRCUIT_BREAKER_COOLDOWN = env("MS_GRAPH_CIRCUIT_BREAKER_COOLDOWN", 60)
 CACHE_MIDDLEWARE_SECONDS = env("CACHE_MIDDLEWARE_SECONDS", 60)
 
 SITE_ID = 1
@@ -157,6 +182,16 @@ ASCENDER_CREATE_AZURE_AD = env("ASCENDER_CREATE_AZURE_AD", False)
 # Flag to set how many days ahead of their start date a new AD account should be created.
 # False == no limit. Value should be a positive integer value.
 ASCENDER_CREATE_AZURE_AD_LIMIT_DAYS = env("ASCENDER_CREATE_AZURE_AD_LIMIT_DAYS", -1)
+# Number of buffered rows to write per transaction when bulk-updating users (e.g. from Entra ID data).
+DEPARTMENT_USER_BULK_WRITE_BATCH_SIZE = env("DEPARTMENT_USER_BULK_WRITE_BATCH_SIZE", 500)
+# Number of buffered rows to write per transaction when bulk-updating users from Ascender data.
+ASCENDER_BULK_WRITE_BATCH_SIZE = env("ASCENDER_BULK_WRITE_BATCH_SIZE", 500)
+# Number of hours after which an incremental Ascender import falls back to a full sync.
+ASCENDER_FULL_SYNC_INTERVAL_HOURS = env("ASCENDER_FULL_SYNC_INTERVAL_HOURS", 24)
+# Flag to control whether Ascender job lookups for existing users are served from the local snapshot table.
+ASCENDER_FETCH_FROM_SNAPSHOT = env("ASCENDER_FETCH_FROM_SNAPSHOT", False)
+# Number of hours after which a delta Entra ID sync (check_azure_accounts) falls back to a full sync.
+ENTRA_ID_FULL_SYNC_INTERVAL_HOURS = env("ENTRA_ID_FULL_SYNC_INTERVAL_HOURS", 24)
 # Number of days after which an Entra ID account may be considered "dormant":
 DORMANT_ACCOUNT_DAYS = env("DORMANT_ACCOUNT_DAYS", 90)
 # Flag to control whether dormant accounts are deactivated.
@@ -178,6 +213,15 @@ FOREIGN_SERVER = env("FOREIGN_SERVER", None)
 FOREIGN_SCHEMA = env("FOREIGN_SCHEMA", default="public")
 FOREIGN_TABLE = env("FOREIGN_TABLE", None)
 FOREIGN_TABLE_CC_MANAGER = env("FOREIGN_TABLE_CC_MANAGER", None)
+# Optional timestamp column in the Ascender view recording when each row last changed (enables incremental imports).
+FOREIGN_TABLE_CHANGE_COLUMN = env("FOREIGN_TABLE_CHANGE_COLUMN", None)
+# Number of rows to transfer per round-trip when streaming rows from the Ascender view.
+FOREIGN_DB_FETCH_BATCH_SIZE = env("FOREIGN_DB_FETCH_BATCH_SIZE", 2000)
+# Ascender database connection pool sizing, idle timeout (seconds) and connection wait timeout (seconds).
+FOREIGN_DB_POOL_MIN_SIZE = env("FOREIGN_DB_POOL_MIN_SIZE", 1)
+FOREIGN_DB_POOL_MAX_SIZE = env("FOREIGN_DB_POOL_MAX_SIZE", 4)
+FOREIGN_DB_POOL_MAX_IDLE = env("FOREIGN_DB_POOL_MAX_IDLE", 300)
+FOREIGN_DB_POOL_TIMEOUT = env("FOREIGN_DB_POOL_TIMEOUT", 30)
 
 # Database configuration
 DATABASES = {
@@ -0,0 +1,344 @@
+import asyncio
+from threading import Lock
+from time import sleep
+from unittest.mock import MagicMock, patch
+
+from django.test import TestCase, override_settings
+
+from itassets.ms_graph import (
+    AsyncMSGraphClient,
+    GraphCircuitOpenError,
+    GraphRetryPolicy,
+    MSGraphClient,
+    get_graph_client,
+    run_concurrently,
+)
+
+
+class MSGraphClientTestCase(TestCase):
+    @override_settings(MS_GRAPH_POOL_SIZE=5, MS_GRAPH_TIMEOUT=30)
+    def test_session_is_pooled(self):
+        client = MSGraphClient()
+        adapter = client.session.get_adapter("https://graph.microsoft.com/v1.0/users")
+        self.assertEqual(adapter._pool_maxsize, 5)
+        self.assertEqual(client.timeout, 30)
+        self.assertEqual(client.session.headers["Accept"], "application/json")
+
+    @patch("itassets.ms_graph.requests.Session.request")
+    def test_request_applies_default_timeout(self, mock_request):
+        client = MSGraphClient(timeout=15)
+        client.get("https://graph.microsoft.com/v1.0/users", headers={"Authorization": "Bearer token"})
+        mock_request.assert_called_once_with(
+            "GET", "https://graph.microsoft.com/v1.0/users", headers={"Authorization": "Bearer token"}, timeout=15
+        )
+        client.post("https://graph.microsoft.com/v1.0/users", json={}, timeout=5)
+        self.assertEqual(mock_request.call_args.kwargs["timeout"], 5)
+
+    def test_get_graph_client_is_shared(self):
+        self.assertIs(get_graph_client(), get_graph_client())
+
+
+def batch_response(responses):
+    resp = MagicMock()
+    resp.json.return_value = {"responses": responses}
+    return resp
+
+
+class MSGraphClientBatchTestCase(TestCase):
+    def setUp(self):
+        self.client = MSGraphClient()
+        self.headers = {"Authorization": "Bearer token"}
+
+    @patch("itassets.ms_graph.MSGraphClient.post")
+    def test_batch_chunks_requests(self, mock_post):
+        sub_requests = [{"id": str(i), "method": "GET", "url": f"/users/{i}"} for i in range(45)]
+        mock_post.side_effect = lambda url, headers, json: batch_response(
+            [{"id": r["id"], "status": 200, "body": {"id": r["id"]}} for r in json["requests"]]
+        )
+
+        responses = self.client.batch(sub_requests, headers=self.headers)
+
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(mock_post.call_args_list[0][0][0], "https://graph.microsoft.com/v1.0/$batch")
+        self.assertEqual([len(c.kwargs["json"]["requests"]) for c in mock_post.call_args_list], [20, 20, 5])
+        self.assertEqual(len(responses), 45)
+        self.assertEqual(responses["44"]["body"], {"id": "44"})
+
+    @patch("itassets.ms_graph.MSGraphClient.post")
+    def test_batch_adds_content_type_for_body(self, mock_post):
+        mock_post.return_value = batch_response([{"id": "1", "status": 200, "body": {}}])
+
+        self.client.batch([{"id": "1", "method": "POST", "url": "/users/1/getMemberGroups", "body": {}}], headers=self.headers)
+
+        sub_request = mock_post.call_args.kwargs["json"]["requests"][0]
+        self.assertEqual(sub_request["headers"]["Content-Type"], "application/json")
+
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.MSGraphClient.post")
+    def test_batch_retries_throttled_items(self, mock_post, mock_sleep):
+        mock_post.side_effect = [
+            batch_response(
+                [
+                    {"id": "1", "status": 200, "body": {}},
+                    {"id": "2", "status": 429, "headers": {"Retry-After": "7"}, "body": {}},
+                ]
+            ),
+            batch_response([{"id": "2", "status": 200, "body": {"ok": True}}]),
+        ]
+        sub_requests = [{"id": "1", "method": "GET", "url": "/users/1"}, {"id": "2", "method": "GET", "url": "/users/2"}]
+
+        responses = self.client.batch(sub_requests, headers=self.headers)
+
+        mock_sleep.assert_called_once_with(7)
+        self.assertEqual([r["id"] for r in mock_post.call_args_list[1].kwargs["json"]["requests"]], ["2"])
+        self.assertEqual(responses["2"]["status"], 200)
+
+    @patch("itassets.ms_graph.GraphRetryPolicy.backoff", return_value=2.5)
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.MSGraphClient.post")
+    def test_batch_non_numeric_retry_after_uses_backoff(self, mock_post, mock_sleep, mock_backoff):
+        mock_post.side_effect = [
+            batch_response([{"id": "1", "status": 503, "headers": {"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"}, "body": {}}]),
+            batch_response([{"id": "1", "status": 200, "body": {}}]),
+        ]
+
+        responses = self.client.batch([{"id": "1", "method": "GET", "url": "/users/1"}], headers=self.headers)
+
+        mock_sleep.assert_called_once_with(2.5)
+        self.assertEqual(responses["1"]["status"], 200)
+
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.MSGraphClient.post")
+    def test_batch_retry_after_is_capped(self, mock_post, mock_sleep):
+        self.client = MSGraphClient(retry_policy=GraphRetryPolicy(retry_after_max=30))
+        mock_post.side_effect = [
+            batch_response([{"id": "1", "status": 429, "headers": {"Retry-After": "86400"}, "body": {}}]),
+            batch_response([{"id": "1", "status": 200, "body": {}}]),
+        ]
+
+        self.client.batch([{"id": "1", "method": "GET", "url": "/users/1"}], headers=self.headers)
+
+        mock_sleep.assert_called_once_with(30)
+
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.MSGraphClient.post")
+    def test_batch_gives_up_after_max_retries(self, mock_post, mock_sleep):
+        mock_post.return_value = batch_response([{"id": "1", "status": 503, "body": {}}])
+
+        responses = self.client.batch([{"id": "1", "method": "GET", "url": "/users/1"}], headers=self.headers, max_retries=2)
+
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(responses["1"]["status"], 503)
+
+
+def page_response(value, next_link=None):
+    resp = MagicMock()
+    j = {"value": value}
+    if next_link:
+        j["@odata.nextLink"] = next_link
+    resp.json.return_value = j
+    return resp
+
+
+class MSGraphClientPaginateTestCase(TestCase):
+    def setUp(self):
+        self.client = MSGraphClient()
+        self.headers = {"Authorization": "Bearer token"}
+
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_paginate_yields_all_items(self, mock_get):
+        mock_get.side_effect = [page_response([1, 2], "https://next/1"), page_response([3], "https://next/2"), page_response([4])]
+
+        items = list(self.client.paginate("https://graph.microsoft.com/v1.0/users", self.headers))
+
+        self.assertEqual(items, [1, 2, 3, 4])
+        self.assertEqual([c[0][0] for c in mock_get.call_args_list[1:]], ["https://next/1", "https://next/2"])
+
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_paginate_is_lazy(self, mock_get):
+        mock_get.side_effect = [page_response([1, 2], "https://next/1"), page_response([3])]
+
+        items = self.client.paginate("https://graph.microsoft.com/v1.0/users", self.headers)
+        self.assertEqual(next(items), 1)
+        self.assertEqual(next(items), 2)
+        # The next page is only requested once the first page has been consumed.
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(next(items), 3)
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_paginate_sets_page_size(self, mock_get):
+        mock_get.return_value = page_response([])
+
+        list(self.client.paginate("https://graph.microsoft.com/v1.0/users", self.headers, params={"$select": "id"}, page_size=999))
+
+        self.assertEqual(mock_get.call_args.kwargs["params"], {"$select": "id", "$top": 999})
+
+
+def status_response(status_code, headers=None):
+    resp = MagicMock()
+    resp.status_code = status_code
+    resp.headers = headers or {}
+    return resp
+
+
+class GraphRetryPolicyTestCase(TestCase):
+    def setUp(self):
+        self.policy = GraphRetryPolicy(
+            max_retries=3, backoff_base=1, backoff_max=10, retry_budget=100, budget_window=60, breaker_threshold=2, breaker_cooldown=60
+        )
+        self.client = MSGraphClient(retry_policy=self.policy)
+        self.url = "https://graph.microsoft.com/v1.0/users/123"
+
+    def test_get_endpoint(self):
+        self.assertEqual(GraphRetryPolicy.get_endpoint("get", self.url), "GET users/{id}")
+        self.assertEqual(
+            GraphRetryPolicy.get_endpoint("POST", "https://graph.microsoft.com/v1.0/users/user@dbca.wa.gov.au/assignLicense"),
+            "POST users/{id}/assignLicense",
+        )
+        self.assertEqual(
+            GraphRetryPolicy.get_endpoint("POST", "https://graph.microsoft.com/beta/users/validatePassword"), "POST users/validatePassword"
+        )
+        self.assertEqual(GraphRetryPolicy.get_endpoint("GET", "https://graph.microsoft.com/v1.0/users/delta"), "GET users/delta")
+        self.assertEqual(
+            GraphRetryPolicy.get_endpoint("GET", "https://graph.microsoft.com/v1.0/sites/dbca.sharepoint.com,1a2b,3c4d/drive"),
+            "GET sites/{id}/drive",
+        )
+        self.assertEqual(GraphRetryPolicy.get_endpoint("POST", "https://graph.microsoft.com/v1.0/$batch"), "POST $batch")
+
+    def test_backoff_is_capped(self):
+        for attempt in range(10):
+            delay = self.policy.backoff(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(10, 2**attempt))
+
+    def test_equal_jitter_backoff_has_floor(self):
+        policy = GraphRetryPolicy(backoff_base=1, backoff_max=300, equal_jitter=True)
+        for attempt in range(10):
+            delay = policy.backoff(attempt)
+            self.assertGreaterEqual(delay, min(300, 2**attempt) / 2)
+            self.assertLessEqual(delay, min(300, 2**attempt))
+
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.requests.Session.request")
+    def test_retries_throttled_request_after_retry_after(self, mock_request, mock_sleep):
+        mock_request.side_effect = [status_response(429, {"Retry-After": "4"}), status_response(200)]
+
+        resp = self.client.get(self.url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(mock_request.call_count, 2)
+        mock_sleep.assert_called_once_with(4)
+
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.requests.Session.request")
+    def test_retry_after_is_capped(self, mock_request, mock_sleep):
+        self.policy.retry_after_max = 30
+        mock_request.side_effect = [status_response(429, {"Retry-After": "86400"}), status_response(200)]
+
+        resp = self.client.get(self.url)
+
+        self.assertEqual(resp.status_code, 200)
+        mock_sleep.assert_called_once_with(30)
+
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.requests.Session.request")
+    def test_gives_up_after_max_retries(self, mock_request, mock_sleep):
+        mock_request.return_value = status_response(503)
+
+        resp = self.client.get(self.url)
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(mock_request.call_count, 4)
+
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.requests.Session.request")
+    def test_does_not_retry_non_idempotent_server_error(self, mock_request, mock_sleep):
+        mock_request.return_value = status_response(500)
+
+        resp = self.client.post(self.url, json={})
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(mock_request.call_count, 1)
+        mock_sleep.assert_not_called()
+
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.requests.Session.request")
+    def test_retry_budget_limits_retries(self, mock_request, mock_sleep):
+        self.policy.retry_budget = 1
+        mock_request.return_value = status_response(503)
+
+        self.client.get(self.url)
+
+        # One retry only, as the budget for the endpoint is exhausted.
+        self.assertEqual(mock_request.call_count, 2)
+
+    @patch("itassets.ms_graph.sleep")
+    @patch("itassets.ms_graph.requests.Session.request")
+    def test_circuit_breaker_opens_after_failures(self, mock_request, mock_sleep):
+        self.policy.max_retries = 0
+        mock_request.return_value = status_response(503)
+
+        self.client.get(self.url)
+        self.client.get(self.url)
+        with self.assertRaises(GraphCircuitOpenError):
+            self.client.get(self.url)
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertIn("GET users/{id}", self.policy.opened)
+        # Other endpoints are unaffected, including other requests for the same resource.
+        self.client.get("https://graph.microsoft.com/v1.0/subscribedSkus")
+        self.client.get(f"{self.url}/memberOf")
+        self.assertEqual(mock_request.call_count, 4)
+
+    @patch("itassets.ms_graph.monotonic")
+    @patch("itassets.ms_graph.requests.Session.request")
+    def test_circuit_breaker_closes_after_cooldown(self, mock_request, mock_monotonic):
+        self.policy.max_retries = 0
+        mock_monotonic.return_value = 1000
+        mock_request.return_value = status_response(503)
+        self.client.get(self.url)
+        self.client.get(self.url)
+
+        mock_monotonic.return_value = 1061
+        mock_request.return_value = status_response(200)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertNotIn("GET users/{id}", self.policy.opened)
+
+
+class AsyncMSGraphClientTestCase(TestCase):
+    def test_run_concurrently_returns_results_in_order(self):
+        def fail():
+            raise ValueError("failed")
+
+        results = run_concurrently([lambda: 1, fail, lambda: 3])
+
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], 3)
+
+    def test_concurrency_is_bounded(self):
+        lock = Lock()
+        state = {"running": 0, "max": 0}
+
+        def call():
+            with lock:
+                state["running"] += 1
+                state["max"] = max(state["max"], state["running"])
+            sleep(0.01)
+            with lock:
+                state["running"] -= 1
+
+        run_concurrently([call] * 12, concurrency=3)
+
+        self.assertGreater(state["max"], 1)
+        self.assertLessEqual(state["max"], 3)
+
+    @patch("itassets.ms_graph.MSGraphClient.request")
+    def test_async_request(self, mock_request):
+        mock_request.return_value = "response"
+
+        async def get():
+            return await AsyncMSGraphClient(client=MSGraphClient(), concurrency=2).get("https://graph.microsoft.com/v1.0/users")
+
+        self.assertEqual(asyncio.run(get()), "response")
+        mock_request.assert_called_once_with("GET", "https://graph.microsoft.com/v1.0/users")
@@ -1,11 +1,13 @@
 import json
 import os
 from io import BytesIO
+from time import time
 from unittest.mock import MagicMock, call, patch
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from itassets.utils import (
+    MS_GRAPH_TOKEN_PROVIDER,
     ModelDescMixin,
     breadcrumbs_list,
     download_blob,
@@ -15,6 +17,8 @@ from itassets.utils import (
     get_query,
     human_time_duration,
     humanise_bytes,
+    iter_blob_json_array,
+    iter_json_array,
     ms_graph_client_token,
     ms_security_api_client_token,
     smart_truncate,
@@ -45,6 +49,12 @@ def make_page(page_number, num_pages):
 
 
 class MsGraphClientTokenTestCase(TestCase):
+    def setUp(self):
+        MS_GRAPH_TOKEN_PROVIDER.reset()
+
+    def tearDown(self):
+        MS_GRAPH_TOKEN_PROVIDER.reset()
+
     @patch.dict(os.environ, ENV_VARS)
     @patch("itassets.utils.ConfidentialClientApplication")
     def test_returns_token(self, mock_msal_cls):
@@ -73,6 +83,47 @@ class MsGraphClientTokenTestCase(TestCase):
 
         self.assertIn("error", token)
 
+    @patch.dict(os.environ, ENV_VARS)
+    @patch("itassets.utils.ConfidentialClientApplication")
+    def test_reuses_cached_token(self, mock_msal_cls):
+        mock_app = MagicMock()
+        mock_app.acquire_token_for_client.return_value = {**FAKE_TOKEN, "expires_in": 3599}
+        mock_msal_cls.return_value = mock_app
+
+        ms_graph_client_token()
+        token = ms_graph_client_token()
+
+        self.assertEqual(token["access_token"], FAKE_TOKEN["access_token"])
+        mock_msal_cls.assert_called_once()
+        mock_app.acquire_token_for_client.assert_called_once()
+
+    @patch.dict(os.environ, ENV_VARS)
+    @patch("itassets.utils.ConfidentialClientApplication")
+    @override_settings(MS_GRAPH_TOKEN_REFRESH_MARGIN=300)
+    def test_refreshes_token_before_expiry(self, mock_msal_cls):
+        mock_app = MagicMock()
+        mock_app.acquire_token_for_client.return_value = {**FAKE_TOKEN, "expires_in": 299}
+        mock_msal_cls.return_value = mock_app
+
+        ms_graph_client_token()
+        ms_graph_client_token()
+
+        mock_msal_cls.assert_called_once()
+        self.assertEqual(mock_app.acquire_token_for_client.call_count, 2)
+
+    @patch.dict(os.environ, ENV_VARS)
+    @patch("itassets.utils.cache")
+    @patch("itassets.utils.ConfidentialClientApplication")
+    @override_settings(MS_GRAPH_TOKEN_SHARED_CACHE=True)
+    def test_uses_shared_cache(self, mock_msal_cls, mock_cache):
+        mock_cache.get.return_value = {"token": FAKE_TOKEN, "expires": time() + 3600}
+
+        token = ms_graph_client_token()
+
+        self.assertEqual(token, FAKE_TOKEN)
+        mock_msal_cls.assert_not_called()
+        mock_cache.get.assert_called_once_with("ms_graph_client_token:test-tenant-id:test-client-id")
+
 
 class MsSecurityApiClientTokenTestCase(TestCase):
     @patch.dict(os.environ, ENV_VARS)
@@ -172,6 +223,53 @@ class GetBlobJsonTestCase(TestCase):
         mock_download.assert_called_once()
 
 
+class IterJsonArrayTestCase(TestCase):
+    def setUp(self):
+        self.data = [
+            {"ObjectGUID": str(i), "EmailAddress": f"user{i}@dbca.wa.gov.au", "Groups": ["a, ]", {"b": "ü"}]} for i in range(20)
+        ] + [12345, -1.5e10, "text", None, True, []]
+        # Include a UTF-8 byte order mark, as written by PowerShell.
+        self.document = b"\xef\xbb\xbf [\n" + ",\n".join(json.dumps(i, ensure_ascii=False) for i in self.data).encode() + b"\n]\n"
+
+    def test_parses_any_chunk_size(self):
+        for size in (1, 3, 16, len(self.document)):
+            chunks = [self.document[i : i + size] for i in range(0, len(self.document), size)]
+            self.assertEqual(list(iter_json_array(chunks)), self.data)
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_json_array([b" [ ", b"] "])), [])
+
+    def test_invalid_documents(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"key": "value"}']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'[{"key": "value"},']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'[{"key": ']))
+
+    def test_elements_must_be_separated(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'[{"a": 1} {"b": 2}]']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b"[1,", b" 2 3]"]))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b"[1,,2]"]))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b"[1, 2,]"]))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b"[,1]"]))
+
+    @patch.dict(os.environ, ENV_VARS)
+    @patch("itassets.utils.BlobServiceClient")
+    def test_iter_blob_json_array(self, mock_bsc_cls):
+        mock_container_client = mock_bsc_cls.from_connection_string.return_value.get_container_client.return_value
+        mock_container_client.download_blob.return_value.chunks.return_value = iter([self.document[:10], self.document[10:]])
+
+        self.assertEqual(list(iter_blob_json_array("mycontainer", "myblob")), self.data)
+        mock_container_client.download_blob.assert_called_once_with("myblob")
+        mock_container_client.download_blob.return_value.readall.assert_not_called()
+
+
 class BreadcrumbsListTestCase(TestCase):
     def test_single_item_renders_active(self):
         result = breadcrumbs_list([("/", "Home")])
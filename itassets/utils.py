@@ -1,31 +1,95 @@
+import codecs
 import json
 import os
 import re
 from io import BytesIO
-from typing import BinaryIO, Dict
+from threading import Lock
+from time import time
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional
 
 import requests
 from azure.storage.blob import BlobServiceClient
+from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Q
 from django.utils.encoding import smart_str
 from msal import ConfidentialClientApplication
 
 
-def ms_graph_client_token() -> Dict:
-    """Uses the Microsoft msal library to obtain an access token for the Graph API.
+class MSGraphTokenProvider:
+    """A thread-safe provider of access tokens for the Graph API, intended to be used as a single
+    instance per process. Reuses one MSAL client application, caches the current token in memory
+    (and optionally in the Django cache, to share it between processes) and requests a new token
+    once the cached one is within MS_GRAPH_TOKEN_REFRESH_MARGIN seconds of expiry.
     Ref: https://docs.microsoft.com/en-us/python/api/msal/msal.application.confidentialclientapplication
     """
-    azure_tenant_id = os.environ["AZURE_TENANT_ID"]
-    client_id = os.environ["AZURE_CLIENT_ID"]
-    client_secret = os.environ["AZURE_CLIENT_SECRET"]
-    context = ConfidentialClientApplication(
-        client_id=client_id,
-        client_credential=client_secret,
-        authority=f"https://login.microsoftonline.com/{azure_tenant_id}",
-    )
-    token = context.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
 
-    return token
+    scopes = ["https://graph.microsoft.com/.default"]
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard the MSAL client application and any cached token."""
+        self.app = None
+        self.token = None
+        self.expires = 0
+
+    def get_app(self) -> ConfidentialClientApplication:
+        if not self.app:
+            azure_tenant_id = os.environ["AZURE_TENANT_ID"]
+            self.app = ConfidentialClientApplication(
+                client_id=os.environ["AZURE_CLIENT_ID"],
+                client_credential=os.environ["AZURE_CLIENT_SECRET"],
+                authority=f"https://login.microsoftonline.com/{azure_tenant_id}",
+            )
+        return self.app
+
+    def get_cache_key(self) -> str:
+        return f"ms_graph_client_token:{os.environ['AZURE_TENANT_ID']}:{os.environ['AZURE_CLIENT_ID']}"
+
+    def is_fresh(self, expires: float) -> bool:
+        return expires - settings.MS_GRAPH_TOKEN_REFRESH_MARGIN > time()
+
+    def get_token(self) -> Dict:
+        """Returns a cached access token, or requests a new one if required.
+        Error responses from MSAL are returned as-is and are not cached.
+        """
+        if self.token and self.is_fresh(self.expires):
+            return self.token
+
+        with self.lock:
+            # Another thread may have refreshed the token while we waited for the lock.
+            if self.token and self.is_fresh(self.expires):
+                return self.token
+
+            if settings.MS_GRAPH_TOKEN_SHARED_CACHE:
+                cached: Optional[dict] = cache.get(self.get_cache_key())
+                if cached and self.is_fresh(cached["expires"]):
+                    self.token, self.expires = cached["token"], cached["expires"]
+                    return self.token
+
+            token = self.get_app().acquire_token_for_client(scopes=self.scopes)
+            if "access_token" not in token:
+                return token
+
+            self.token = token
+            self.expires = time() + int(token.get("expires_in", 0))
+            if settings.MS_GRAPH_TOKEN_SHARED_CACHE:
+                timeout = int(self.expires - time() - settings.MS_GRAPH_TOKEN_REFRESH_MARGIN)
+                if timeout > 0:
+                    cache.set(self.get_cache_key(), {"token": token, "expires": self.expires}, timeout)
+
+            return token
+
+
+MS_GRAPH_TOKEN_PROVIDER = MSGraphTokenProvider()
+
+
+def ms_graph_client_token() -> Dict:
+    """Returns an access token for the Graph API from the process-wide token provider."""
+    return MS_GRAPH_TOKEN_PROVIDER.get_token()
 
 
 def ms_security_api_client_token() -> str:
@@ -172,6 +236,93 @@ def get_blob_json(container: str, blob: str) -> Dict:
     return json.loads(tf.read())
 
 
+def iter_blob_chunks(container: str, blob: str) -> Iterator[bytes]:
+    """Download the nominated Azure blob, yielding its content in chunks rather than reading it into memory."""
+    connect_string = os.environ.get("AZURE_CONNECTION_STRING")
+    service_client = BlobServiceClient.from_connection_string(connect_string)
+    container_client = service_client.get_container_client(container=container)
+    yield from container_client.download_blob(blob).chunks()
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator:
+    """Incrementally parse a JSON document consisting of an array from the passed-in iterable of
+    UTF-8 encoded chunks, yielding each element of the array as soon as it has been parsed.
+    Only the element currently being parsed is held in memory (not the whole document).
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    chunks = iter(chunks)
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+    parsed = False
+    # True when an element has been parsed, and a separator (or the end of the array) is expected.
+    separator = False
+
+    def read() -> bool:
+        """Append the next chunk to the buffer, discarding parsed content. Returns False at the end of input."""
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        try:
+            buffer = buffer[pos:] + text_decoder.decode(next(chunks))
+        except StopIteration:
+            buffer = buffer[pos:] + text_decoder.decode(b"", final=True)
+            eof = True
+        pos = 0
+        return True
+
+    while True:
+        # Skip whitespace.
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos == len(buffer):
+            if read():
+                continue
+            raise ValueError("Unexpected end of JSON array")
+
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("JSON document is not an array")
+            started = True
+            pos += 1
+            continue
+        if separator:
+            # Each element must be followed by a comma or the end of the array.
+            if buffer[pos] == "]":
+                return
+            if buffer[pos] != ",":
+                raise ValueError(f"Expected ',' or ']' after JSON array element, found {buffer[pos]!r}")
+            separator = False
+            pos += 1
+            continue
+        if buffer[pos] == "]" and not parsed:
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The element is incomplete; read more input and try again.
+            if read():
+                continue
+            raise
+        # A scalar not followed by a delimiter (e.g. a partial number) may be continued in the next chunk.
+        if (end == len(buffer) or not (buffer[end].isspace() or buffer[end] in ",]")) and read():
+            continue
+        pos = end
+        parsed = separator = True
+        yield element
+
+
+def iter_blob_json_array(container: str, blob: str) -> Iterator:
+    """Convenience function to stream an Azure blob which contains a JSON array, yielding each
+    element as it is parsed. Pass in the container and blob names.
+    Unlike get_blob_json, memory use does not grow with the size of the blob.
+    """
+    yield from iter_json_array(iter_blob_chunks(container, blob))
+
+
 def get_previous_pages(page_num, count=3):
     """Convenience function to take a Paginator page object and return the previous `count`
     page numbers, to a minimum of 1.
@@ -1,7 +1,13 @@
+import atexit
+import hashlib
+import json
 import logging
 import re
+from collections import defaultdict
 from collections.abc import Iterator
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from functools import partial
+from threading import Lock
 from time import sleep
 from typing import List, Literal, Optional
 
@@ -10,17 +16,45 @@ from django.conf import settings
 from django.contrib.admin.models import ADDITION, LogEntry
 from django.contrib.auth import get_user_model
 from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
 from django.utils import timezone
 from psycopg import Connection, connect, sql
+from psycopg_pool import ConnectionPool
 
+from itassets.ms_graph import GraphRetryPolicy, get_graph_client
 from itassets.utils import ms_graph_client_token
+from organisation.bulk import DepartmentUserBulkWriter
 from organisation.microsoft_products import MS_PRODUCTS
-from organisation.models import AscenderActionLog, CostCentre, DepartmentUser, DepartmentUserLog, Location
-from organisation.utils import generate_password, ms_graph_get_subscribed_sku, ms_graph_validate_password, title_except
+from organisation.models import (
+    AscenderActionLog,
+    AscenderJobSnapshot,
+    CostCentre,
+    DepartmentUser,
+    DepartmentUserLog,
+    Location,
+    SyncCheckpoint,
+)
+from organisation.utils import SUBSCRIBED_SKU_CACHE, generate_password, ms_graph_validate_password, title_except
 
 User = get_user_model()
 LOGGER = logging.getLogger("organisation")
+# Connection pool for the Ascender database, created on first use (see get_ascender_db_pool).
+ASCENDER_DB_POOL: Optional[ConnectionPool] = None
+ASCENDER_DB_POOL_LOCK = Lock()
 DATE_MAX = date(2049, 12, 31)
+# Job sort score for a job having no end date (see ascender_job_sort_key).
+DATE_MAX_SCORE = int(DATE_MAX.strftime("%Y%m%d")) * 10
+# Name of the SyncCheckpoint used by incremental Ascender imports, and the overlap applied to its
+# watermark to allow for clock differences between hosts.
+ASCENDER_SYNC_CHECKPOINT = "ascender"
+ASCENDER_SYNC_OVERLAP = timedelta(minutes=15)
+# Name of the SyncCheckpoint recording the differences found by the last Ascender snapshot refresh.
+ASCENDER_SNAPSHOT_CHECKPOINT = "ascender_snapshot"
+# Backoff used while polling a newly-created Entra ID account until it is ready to be licensed, and the
+# minimum total time (seconds) to wait before giving up (and deleting the account). Equal jitter is used
+# so that each delay is at least half of the exponential backoff value.
+PROVISIONING_RETRY_POLICY = GraphRetryPolicy(backoff_max=300, equal_jitter=True)
+PROVISIONING_MIN_WAIT = 511
 # The list below defines which columns to SELECT from the Ascender view, what to name the object
 # dict key after querying, plus how to parse the returned value of each column (if required).
 FOREIGN_TABLE_FIELDS = (
@@ -173,42 +207,108 @@ TERM_REASON_MAP = {
 }
 
 
+def get_ascender_db_connection_kwargs() -> dict:
+    """Returns the connection parameters for the Ascender database."""
+    return {
+        "host": settings.FOREIGN_DB_HOST,
+        "port": settings.FOREIGN_DB_PORT,
+        "dbname": settings.FOREIGN_DB_NAME,
+        "user": settings.FOREIGN_DB_USERNAME,
+        "password": settings.FOREIGN_DB_PASSWORD,
+    }
+
+
 def get_ascender_db_connection() -> Connection:
-    """Returns a database connection to the Ascender database."""
-    return connect(
-        host=settings.FOREIGN_DB_HOST,
-        port=settings.FOREIGN_DB_PORT,
-        dbname=settings.FOREIGN_DB_NAME,
-        user=settings.FOREIGN_DB_USERNAME,
-        password=settings.FOREIGN_DB_PASSWORD,
-    )
+    """Returns a new (unpooled) database connection to the Ascender database.
+    The caller is responsible for closing the connection; prefer get_ascender_db_pool().connection().
+    """
+    return connect(**get_ascender_db_connection_kwargs())
 
 
-def row_to_python(row):
-    """A convenience function to convert a row from the Ascender database to a
-    Python dict, applying optional transforms to each column.
-    Transforms can be to convert strings to datetime, or to rename column in
-    the returned dict.
+def get_ascender_db_pool() -> ConnectionPool:
+    """Returns the process-wide connection pool for the Ascender database, opening it on first use.
+    Connections are checked before being handed out, and connections in excess of the minimum pool
+    size are closed after being idle for FOREIGN_DB_POOL_MAX_IDLE seconds.
+    Usage: `with get_ascender_db_pool().connection() as conn:`
     """
-    record = {}
+    global ASCENDER_DB_POOL
+
+    with ASCENDER_DB_POOL_LOCK:
+        if ASCENDER_DB_POOL is None:
+            ASCENDER_DB_POOL = ConnectionPool(
+                kwargs=get_ascender_db_connection_kwargs(),
+                min_size=settings.FOREIGN_DB_POOL_MIN_SIZE,
+                max_size=settings.FOREIGN_DB_POOL_MAX_SIZE,
+                max_idle=settings.FOREIGN_DB_POOL_MAX_IDLE,
+                timeout=settings.FOREIGN_DB_POOL_TIMEOUT,
+                check=ConnectionPool.check_connection,
+                name="ascender",
+                open=True,
+            )
+            atexit.register(ASCENDER_DB_POOL.close)
 
-    for k, field in enumerate(FOREIGN_TABLE_FIELDS):
+    return ASCENDER_DB_POOL
+
+
+def compile_row_transformer(fields: tuple) -> tuple[tuple, tuple]:
+    """Compile a FOREIGN_TABLE_FIELDS-style definition into a tuple of record keys (one per column,
+    in SELECT order) and a tuple of (key, column index, callable) transforms for those columns
+    having a transformer function.
+    """
+    keys = []
+    transforms = []
+
+    for k, field in enumerate(fields):
         # If the field in a list or tuple, use the first element as the record key
         # and the second element (a callable function) as a transformer.
         if isinstance(field, (list, tuple)):
             if callable(field[1]):
-                record[field[0]] = field[1](row[k])
+                keys.append(field[0])
+                transforms.append((field[0], k, field[1]))
             else:
-                record[field[1]] = row[k]
+                keys.append(field[1])
         else:
-            record[field] = row[k]
+            keys.append(field)
+
+    return tuple(keys), tuple(transforms)
+
+
+# The Ascender view column names, in SELECT order.
+FOREIGN_TABLE_COLUMNS = tuple(f[0] if isinstance(f, (list, tuple)) else f for f in FOREIGN_TABLE_FIELDS)
+# Record keys and column transforms for FOREIGN_TABLE_FIELDS, compiled once at import.
+FOREIGN_TABLE_KEYS, FOREIGN_TABLE_TRANSFORMS = compile_row_transformer(FOREIGN_TABLE_FIELDS)
+
+
+def row_to_python(row):
+    """A convenience function to convert a row from the Ascender database to a
+    Python dict, applying optional transforms to each column.
+    Transforms can be to convert strings to datetime, or to rename column in
+    the returned dict.
+    """
+    record = dict(zip(FOREIGN_TABLE_KEYS, row))
+
+    for key, k, transform in FOREIGN_TABLE_TRANSFORMS:
+        record[key] = transform(row[k])
 
     return record
 
 
-def ascender_db_fetch(employee_id: Optional[str] = None) -> Iterator:
+def ascender_db_fetch(
+    employee_id: Optional[str] = None,
+    stream: bool = False,
+    batch_size: Optional[int] = None,
+    ranked: bool = False,
+    top_job_only: bool = False,
+    changed_since: Optional[datetime] = None,
+) -> Iterator:
     """Returns an iterator which yields all rows from the Ascender database query.
-    Optionally pass employee_id to filter on a single employee.
+    Optionally pass employee_id to filter on a single employee, or `changed_since` to filter on
+    employees having any job row changed since that time (requires FOREIGN_TABLE_CHANGE_COLUMN).
+    Pass `stream=True` to use a named (server-side) cursor, which transfers rows from the database
+    in batches of `batch_size` rows instead of holding the whole result set in memory.
+    Pass `ranked=True` to have the database rank each employee's jobs (using the same order as
+    ascender_job_sort_key) and return rows ordered by employee and rank. Pass `top_job_only=True`
+    to return only the top-ranked job for each employee.
     """
     if employee_id:
         # Validate `employee_id`: this value needs be castable as an integer, even though we use it as a string.
@@ -217,31 +317,83 @@ def ascender_db_fetch(employee_id: Optional[str] = None) -> Iterator:
         except ValueError:
             raise ValueError("Invalid employee ID value")
 
-    conn = get_ascender_db_connection()
-    cur = conn.cursor()
-    columns = sql.SQL(",").join(sql.Identifier(f[0]) if isinstance(f, (list, tuple)) else sql.Identifier(f) for f in FOREIGN_TABLE_FIELDS)
+    if changed_since and not settings.FOREIGN_TABLE_CHANGE_COLUMN:
+        raise ValueError("FOREIGN_TABLE_CHANGE_COLUMN must be set to filter on changed rows")
+
+    if not batch_size:
+        batch_size = settings.FOREIGN_DB_FETCH_BATCH_SIZE
+
+    columns = sql.SQL(",").join(sql.Identifier(column) for column in FOREIGN_TABLE_COLUMNS)
     schema = sql.Identifier(settings.FOREIGN_SCHEMA)
     table = sql.Identifier(settings.FOREIGN_TABLE)
     employee_no = sql.Identifier("employee_no")
+    job_end_date = sql.Identifier("job_end_date")
+    params = {}
 
     if employee_id:
-        query = sql.SQL("SELECT {columns} FROM {schema}.{table} WHERE {employee_no} = %s").format(
-            columns=columns, schema=schema, table=table, employee_no=employee_no
+        where = sql.SQL(" WHERE {employee_no} = %(employee_id)s").format(employee_no=employee_no)
+        params["employee_id"] = employee_id
+    elif changed_since:
+        # Return every job for each changed employee, so that their current job can still be selected.
+        where = sql.SQL(
+            " WHERE {employee_no} IN (SELECT {employee_no} FROM {schema}.{table} WHERE {change_column} >= %(changed_since)s)"
+        ).format(
+            employee_no=employee_no,
+            schema=schema,
+            table=table,
+            change_column=sql.Identifier(settings.FOREIGN_TABLE_CHANGE_COLUMN),
+        )
+        params["changed_since"] = changed_since
+    else:
+        where = sql.SQL("")
+
+    if ranked or top_job_only:
+        # Rank jobs per employee: jobs with a future end date first (latest end date first), then jobs
+        # with no end date, then jobs that have already ended (most recently ended first).
+        # Ascender records a "null" job end date as DATE_MAX.
+        job_rank_order = sql.SQL(
+            "CASE WHEN {job_end_date} IS NULL OR {job_end_date} = %(date_max)s THEN 1 "
+            "WHEN {job_end_date} >= %(today)s THEN 0 ELSE 2 END, {job_end_date} DESC"
+        ).format(job_end_date=job_end_date)
+        params["date_max"] = DATE_MAX
+        params["today"] = date.today()
+        query = sql.SQL(
+            "SELECT {columns} FROM ("
+            "SELECT {columns}, ROW_NUMBER() OVER (PARTITION BY {employee_no} ORDER BY {job_rank_order}) AS job_rank "
+            "FROM {schema}.{table}{where}"
+            ") AS jobs{top_job} ORDER BY {employee_no}, job_rank"
+        ).format(
+            columns=columns,
+            employee_no=employee_no,
+            job_rank_order=job_rank_order,
+            schema=schema,
+            table=table,
+            where=where,
+            top_job=sql.SQL(" WHERE job_rank = 1") if top_job_only else sql.SQL(""),
         )
-        cur.execute(query, (employee_id,))
     else:
-        query = sql.SQL("SELECT {columns} FROM {schema}.{table}").format(columns=columns, schema=schema, table=table)
-        cur.execute(query)
+        query = sql.SQL("SELECT {columns} FROM {schema}.{table}{where}").format(columns=columns, schema=schema, table=table, where=where)
 
-    while True:
-        row = cur.fetchone()
-        if row is None:
-            break
-        record = row_to_python(row)
-        yield record
+    with get_ascender_db_pool().connection() as conn:
+        if stream:
+            cur = conn.cursor(name="ascender_db_fetch")
+            cur.itersize = batch_size
+        else:
+            cur = conn.cursor()
+
+        cur.execute(query, params or None)
+
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row_to_python(row)
+
+        cur.close()
 
 
-def ascender_job_sort_key(record: dict) -> int:
+def ascender_job_sort_key(record: dict, today: Optional[str] = None) -> int:
     """
     Returns an integer value to "sort" a job, based on job end date.
     Jobs with an end date in the future will be preferenced over jobs with no end date, which will be
@@ -251,22 +403,42 @@ def ascender_job_sort_key(record: dict) -> int:
     - If the job has ended, the initial score is calculated using the job's end date.
     - If the job is not ended, the initial score is calculated using the end date times 100.
     - If the job has no end date recorded, the initial score is calculated using the DATE_MAX value times 10.
+
+    Optionally pass in today's date as a YYYY-MM-DD string, to avoid recalculating it for each job.
     """
-    today = datetime.now().date()
+    if not today:
+        today = date.today().strftime("%Y-%m-%d")
 
     # Initial score from job_end_date.
-    if record["job_end_date"] and record["job_end_date"] < today.strftime("%Y-%m-%d"):
-        score = int(record["job_end_date"].replace("-", ""))
-    elif record["job_end_date"] and record["job_end_date"] >= today.strftime("%Y-%m-%d"):
-        score = int(record["job_end_date"].replace("-", "")) * 100
-    else:  # No job end date.
-        score = int(DATE_MAX.strftime("%Y%m%d")) * 10
+    job_end_date = record["job_end_date"]
+    if not job_end_date:  # No job end date.
+        return DATE_MAX_SCORE
+    elif job_end_date < today:
+        return int(job_end_date.replace("-", ""))
+    else:
+        return int(job_end_date.replace("-", "")) * 100
+
+
+def ascender_jobs_sort(jobs: list, today: Optional[str] = None) -> list:
+    """Sorts the passed-in list of jobs in place, in descending order of "score" from ascender_job_sort_key.
+    The sort key of each job is calculated once.
+    """
+    if not today:
+        today = date.today().strftime("%Y-%m-%d")
+    jobs.sort(key=partial(ascender_job_sort_key, today=today), reverse=True)
+    return jobs
 
-    return score
 
+def ascender_employee_fetch(employee_id, from_snapshot: bool = False) -> tuple:
+    """Returns a tuple: (employee_id, [sorted employee jobs])
+    Pass `from_snapshot=True` to return jobs from the local snapshot table, falling back to the
+    Ascender database if the employee is not present in the snapshot.
+    """
+    if from_snapshot:
+        jobs = ascender_snapshot_employee_fetch(employee_id)
+        if jobs:
+            return (employee_id, jobs)
 
-def ascender_employee_fetch(employee_id) -> tuple:
-    """Returns a tuple: (employee_id, [sorted employee jobs])"""
     try:
         ascender_records = ascender_db_fetch(employee_id)
     except ValueError:
@@ -278,35 +450,160 @@ def ascender_employee_fetch(employee_id) -> tuple:
         jobs.append(row)
 
     # Sort the list of jobs in descending order of "score" from ascender_job_sort_key.
-    jobs.sort(key=ascender_job_sort_key, reverse=True)
+    ascender_jobs_sort(jobs)
     return (employee_id, jobs)
 
 
-def ascender_employees_fetch_all() -> dict:
-    """Returns a dict: {'<employee_id>': [sorted employee jobs], ...}"""
-    ascender_records = ascender_db_fetch()
-    records = {}
+def ascender_employees_fetch_all(ranked: bool = False, top_job_only: bool = False, changed_since: Optional[datetime] = None) -> dict:
+    """Returns a dict: {'<employee_id>': [sorted employee jobs], ...}
+    Pass `ranked=True` to sort each employee's jobs in the database query rather than in Python.
+    Pass `top_job_only=True` to return only the top-ranked job for each employee (implies `ranked`).
+    Pass `changed_since` to return only employees having a job row changed since that time.
+    """
+    ranked = ranked or top_job_only
+    ascender_records = ascender_db_fetch(stream=True, ranked=ranked, top_job_only=top_job_only, changed_since=changed_since)
+    records = defaultdict(list)
 
+    # Group all jobs by employee first, then sort each employee's list of jobs once.
     for row in ascender_records:
-        employee_id = row["employee_id"]
-        if employee_id in records:
-            # Append the next job to the list of jobs, sort and replace the dict value.
-            jobs = records[employee_id]
-            jobs.append(row)
-            jobs.sort(key=ascender_job_sort_key, reverse=True)
-            records[employee_id] = jobs
-        else:
-            records[employee_id] = [row]
+        records[row["employee_id"]].append(row)
+
+    if not ranked:
+        today = date.today().strftime("%Y-%m-%d")
+        for jobs in records.values():
+            ascender_jobs_sort(jobs, today)
+
+    return dict(records)
+
+
+def ascender_snapshot_employee_fetch(employee_id) -> list:
+    """Returns the sorted list of jobs for the employee from the local snapshot table."""
+    return list(AscenderJobSnapshot.objects.filter(employee_id=employee_id).order_by("job_rank").values_list("data", flat=True))
+
+
+def ascender_snapshot_refresh(employee_records: dict, partial: bool = False) -> dict:
+    """Refreshes the local snapshot table from the passed-in dict of {'<employee_id>': [sorted employee jobs]},
+    writing only those employees whose jobs differ from the previous snapshot.
+    Pass `partial=True` if `employee_records` does not include every employee (e.g. an incremental
+    import), so that absent employees are not removed from the snapshot.
+    Returns a dict of lists of employee IDs which were added, removed or changed since the previous snapshot.
+    """
+    snapshot_at = timezone.now()
+    previous = defaultdict(list)
+    for employee_id, row_hash in AscenderJobSnapshot.objects.order_by("employee_id", "job_rank").values_list("employee_id", "row_hash"):
+        previous[employee_id].append(row_hash)
+    current = {employee_id: [ascender_job_hash(job) for job in jobs] for employee_id, jobs in employee_records.items() if jobs}
+
+    added = current.keys() - previous.keys()
+    removed = set() if partial else previous.keys() - current.keys()
+    changed = {employee_id for employee_id in current.keys() & previous.keys() if current[employee_id] != previous[employee_id]}
+
+    snapshots = [
+        AscenderJobSnapshot(
+            employee_id=employee_id,
+            position_no=job["position_no"],
+            job_rank=rank,
+            data=job,
+            row_hash=current[employee_id][rank],
+            snapshot_at=snapshot_at,
+        )
+        for employee_id in added | changed
+        for rank, job in enumerate(employee_records[employee_id])
+    ]
+    diff = {"added": sorted(added), "removed": sorted(removed), "changed": sorted(changed)}
+
+    with transaction.atomic():
+        AscenderJobSnapshot.objects.filter(employee_id__in=removed | changed).delete()
+        AscenderJobSnapshot.objects.bulk_create(snapshots, batch_size=settings.ASCENDER_BULK_WRITE_BATCH_SIZE)
+        SyncCheckpoint.objects.update_or_create(name=ASCENDER_SNAPSHOT_CHECKPOINT, defaults={"watermark": snapshot_at, "data": diff})
+
+    LOGGER.info(f"Ascender snapshot refreshed: {len(added)} employees added, {len(removed)} removed, {len(changed)} changed")
+    return diff
+
 
-    return records
+class AscenderLookups:
+    """Run-scoped lookup maps used while bulk-importing Ascender data, to avoid querying the database
+    for each employee. DepartmentUsers are keyed by employee_id, CostCentres by ascender_code and
+    Locations by ascender_desc. Objects created during the run should be added via the `add_*` methods.
+    """
+
+    def __init__(self):
+        self.users = {user.employee_id: user for user in DepartmentUser.objects.filter(employee_id__isnull=False)}
+        self.cost_centres = {cc.ascender_code: cc for cc in CostCentre.objects.filter(ascender_code__isnull=False)}
+        self.locations = {loc.ascender_desc: loc for loc in Location.objects.filter(ascender_desc__isnull=False)}
+
+    def get_user(self, employee_id: str) -> Optional[DepartmentUser]:
+        return self.users.get(employee_id)
+
+    def get_cost_centre(self, ascender_code: str) -> Optional[CostCentre]:
+        return self.cost_centres.get(ascender_code)
+
+    def get_location(self, ascender_desc: str) -> Optional[Location]:
+        return self.locations.get(ascender_desc)
+
+    def get_related_ids(self, job: dict) -> dict:
+        """Returns the primary keys of the cost centre, manager and location resolved from the passed-in
+        Ascender job record (each is None if no match exists).
+        """
+        cc = self.get_cost_centre(job.get("paypoint"))
+        manager = self.get_user(job.get("manager_emp_no"))
+        location = self.get_location(job.get("geo_location_desc"))
+        return {
+            "cost_centre": cc.pk if cc else None,
+            "manager": manager.pk if manager else None,
+            "location": location.pk if location else None,
+        }
+
+    def add_user(self, user: DepartmentUser):
+        if user.employee_id:
+            self.users[user.employee_id] = user
+
+    def add_cost_centre(self, cc: CostCentre):
+        if cc.ascender_code:
+            self.cost_centres[cc.ascender_code] = cc
+
+    def add_location(self, location: Location):
+        if location.ascender_desc:
+            self.locations[location.ascender_desc] = location
+
+
+class AscenderBulkWriter(DepartmentUserBulkWriter):
+    """Buffers DepartmentUser updates and log records (including AscenderActionLog records) made during
+    a bulk Ascender import, and writes them in batched transactions.
+    """
+
+    def __init__(self, batch_size: Optional[int] = None, autoflush: bool = True):
+        super().__init__(batch_size=batch_size or settings.ASCENDER_BULK_WRITE_BATCH_SIZE, autoflush=autoflush)
+
+    def clear(self):
+        super().clear()
+        self.action_logs = []
+
+    def add_action_log(self, **kwargs):
+        self.action_logs.append(AscenderActionLog(**kwargs))
+        self.flush_if_full()
+
+    def buffered(self) -> int:
+        return super().buffered() + len(self.action_logs)
+
+    def write(self):
+        super().write()
+        if self.action_logs:
+            AscenderActionLog.objects.bulk_create(self.action_logs, batch_size=self.batch_size)
+            LOGGER.info(f"Bulk created {len(self.action_logs)} action logs")
 
 
 def validate_ascender_user_account_rules(
-    job: dict, ignore_job_start_date: bool = False, manager_override_email: Optional[str] = None, logging: bool = False
+    job: dict,
+    ignore_job_start_date: bool = False,
+    manager_override_email: Optional[str] = None,
+    logging: bool = False,
+    lookups: Optional[AscenderLookups] = None,
 ) -> tuple | Literal[False]:
     """Given a passed-in Ascender record and any qualifiers, determine
     whether a new Entra ID account can be provisioned for that user.
     The 'job start date' rule can be optionally bypassed.
+    Optionally pass in preloaded `lookups` to avoid per-record database queries.
     Returns either a tuple of values required to provision the new account, or False.
     """
     ascender_record = f"{job['employee_id']}, {job['first_name']} {job['surname']}"
@@ -320,7 +617,11 @@ def validate_ascender_user_account_rules(
         return False
 
     # If a matching DepartmentUser already exists, skip.
-    if DepartmentUser.objects.filter(employee_id=job["employee_id"]).exists():
+    if lookups:
+        user_exists = lookups.get_user(job["employee_id"]) is not None
+    else:
+        user_exists = DepartmentUser.objects.filter(employee_id=job["employee_id"]).exists()
+    if user_exists:
         if logging:
             LOGGER.warning("Matching DepartmentUser object already exists, aborting")
         return False
@@ -359,33 +660,42 @@ def validate_ascender_user_account_rules(
     # Rule: user must have a manager recorded, and that manager must exist in our database.
     # Partial exception: if the email is specified, we can override the manager in Ascender.
     # That specifed manager must still exist in our database to proceed.
-    if manager_override_email and DepartmentUser.objects.filter(email=manager_override_email).exists():
-        manager = DepartmentUser.objects.get(email=manager_override_email)
-    elif manager_override_email and not DepartmentUser.objects.filter(email=manager_override_email).exists():
-        if logging:
-            LOGGER.warning(f"Manager with email {manager_override_email} not present in IT Assets, aborting")
-        return False
-    elif job["manager_emp_no"] and DepartmentUser.objects.filter(employee_id=job["manager_emp_no"]).exists():
-        manager = DepartmentUser.objects.get(employee_id=job["manager_emp_no"])
-    elif job["manager_emp_no"] and not DepartmentUser.objects.filter(employee_id=job["manager_emp_no"]).exists():
-        if logging:
-            LOGGER.warning(f"Manager employee ID {job['manager_emp_no']} not present in IT Assets, aborting")
-        return False
-    elif not job["manager_emp_no"]:  # Short circuit: if there is no manager recorded, skip account creation.
+    if manager_override_email:
+        manager = DepartmentUser.objects.filter(email=manager_override_email).first()
+        if not manager:
+            if logging:
+                LOGGER.warning(f"Manager with email {manager_override_email} not present in IT Assets, aborting")
+            return False
+    elif job["manager_emp_no"]:
+        if lookups:
+            manager = lookups.get_user(job["manager_emp_no"])
+        else:
+            manager = DepartmentUser.objects.filter(employee_id=job["manager_emp_no"]).first()
+        if not manager:
+            if logging:
+                LOGGER.warning(f"Manager employee ID {job['manager_emp_no']} not present in IT Assets, aborting")
+            return False
+    else:  # Short circuit: if there is no manager recorded, skip account creation.
         if logging:
             LOGGER.warning("No manager employee ID recorded in Ascender, aborting")
         return False
 
     # Rule: user must have a Cost Centre recorded (paypoint in Ascender).
-    if job["paypoint"] and CostCentre.objects.filter(ascender_code=job["paypoint"]).exists():
-        cc = CostCentre.objects.get(ascender_code=job["paypoint"])
-    elif job["paypoint"] and not CostCentre.objects.filter(ascender_code=job["paypoint"]).exists():
+    if job["paypoint"]:
+        if lookups:
+            cc = lookups.get_cost_centre(job["paypoint"])
+        else:
+            cc = CostCentre.objects.filter(ascender_code=job["paypoint"]).first()
+
+    if job["paypoint"] and not cc:
         # Attempt to automatically create a new CC from Ascender data.
         try:
             cc = CostCentre.objects.create(
                 code=job["paypoint"],
                 ascender_code=job["paypoint"],
             )
+            if lookups:
+                lookups.add_cost_centre(cc)
             log = f"New Entra ID account process generated new cost centre, code {job['paypoint']}"
             AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=job)
             LOGGER.info(log)
@@ -427,9 +737,13 @@ def validate_ascender_user_account_rules(
             return False
 
     # Rule: user must have a physical location recorded, and that location must exist in our database.
-    if job["geo_location_desc"] and Location.objects.filter(ascender_desc=job["geo_location_desc"]).exists():
-        location = Location.objects.get(ascender_desc=job["geo_location_desc"])
-    else:
+    if job["geo_location_desc"]:
+        if lookups:
+            location = lookups.get_location(job["geo_location_desc"])
+        else:
+            location = Location.objects.filter(ascender_desc=job["geo_location_desc"]).first()
+
+    if not location:
         if job["geo_location_desc"]:
             LOGGER.warning(f"Job physical location {job['geo_location_desc']} does not exist in IT Assets, aborting")
         else:
@@ -443,14 +757,60 @@ def validate_ascender_user_account_rules(
         return False
 
 
-def ascender_user_import_all():
+def ascender_job_hash(job: dict, related_ids: Optional[dict] = None) -> str:
+    """Returns a stable content hash of the passed-in Ascender job record.
+    Optionally pass in the primary keys of related objects resolved from the job record (cost centre,
+    manager and location), so that the hash also changes when those are created or changed.
+    """
+    data = {"job": job, "related_ids": related_ids} if related_ids is not None else job
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def ascender_user_import_all(top_job_only: bool = False, bulk: bool = False, force: bool = False, incremental: bool = False):
     """A utility function to cache data from Ascender to matching DepartmentUser objects.
     On no match, create a new Entra ID account and DepartmentUser based on Ascender data,
     assuming it meets all the business rules for new account provisioning.
+    Pass `top_job_only=True` to only query the top-ranked job for each employee from Ascender;
+    the full list of jobs is still queried for users having a `position_no` override.
+    Pass `bulk=True` to buffer changes to existing users and write them in batches, rather than
+    saving each user individually.
+    Existing users whose selected job is unchanged since the last import are skipped, unless
+    `force=True` is passed.
+    Pass `incremental=True` to only query employees having Ascender rows changed since the last
+    successful import (falls back to a full sync every ASCENDER_FULL_SYNC_INTERVAL_HOURS).
     """
-    LOGGER.info("Querying Ascender database for employee information")
+    run_started = timezone.now()
+    checkpoint = None
+    changed_since = None
+
+    if incremental:
+        checkpoint, _ = SyncCheckpoint.objects.get_or_create(name=ASCENDER_SYNC_CHECKPOINT)
+        if not settings.FOREIGN_TABLE_CHANGE_COLUMN:
+            LOGGER.info("FOREIGN_TABLE_CHANGE_COLUMN is not set, running a full Ascender sync")
+        elif checkpoint.full_sync_due(timedelta(hours=settings.ASCENDER_FULL_SYNC_INTERVAL_HOURS)):
+            LOGGER.info("Full Ascender sync is due, running a full sync")
+        else:
+            changed_since = checkpoint.watermark - ASCENDER_SYNC_OVERLAP
+
+    if changed_since:
+        LOGGER.info(f"Querying Ascender database for employees changed since {changed_since.isoformat()}")
+    else:
+        LOGGER.info("Querying Ascender database for employee information")
     token = ms_graph_client_token()
-    employee_records = ascender_employees_fetch_all()
+    employee_records = ascender_employees_fetch_all(top_job_only=top_job_only, changed_since=changed_since)
+    # Preload existing users, cost centres and locations for the duration of this run.
+    lookups = AscenderLookups()
+    writer = AscenderBulkWriter() if bulk else None
+    unchanged_count = 0
+
+    if top_job_only:
+        # Users having a position_no override require the full list of their jobs.
+        for employee_id, user in lookups.users.items():
+            if user.position_no and employee_id in employee_records:
+                _, employee_records[employee_id] = ascender_employee_fetch(employee_id)
+    else:
+        # Refresh the local snapshot (this requires the complete list of jobs for each employee).
+        ascender_snapshot_refresh(employee_records, partial=bool(changed_since))
 
     for employee_id, jobs in employee_records.items():
         # If we have no jobs data from Ascender for this employee, skip them.
@@ -466,8 +826,8 @@ def ascender_user_import_all():
         job = jobs[0]
         # For an existing matched DepartmentUser record where a position_no value is recorded,
         # attempt to select that job from the list instead.
-        if DepartmentUser.objects.filter(employee_id=employee_id, position_no__isnull=False).exists():
-            user = DepartmentUser.objects.get(employee_id=employee_id)
+        user = lookups.get_user(employee_id)
+        if user and user.position_no:
             position_no = user.position_no
             for j in jobs:
                 if j["position_no"] == position_no:
@@ -481,16 +841,15 @@ def ascender_user_import_all():
         # Physical locations: if the Ascender physical location doesn't exist in our database, create it.
         # This is out of band to checks whether the user is new or otherwise, because sometimes new locations
         # are added to existing users.
-        if (
-            job["geo_location_desc"] and not Location.objects.filter(ascender_desc=job["geo_location_desc"]).exists()
-        ):  # geo_location_desc must have a value.
+        if job["geo_location_desc"] and not lookups.get_location(job["geo_location_desc"]):  # geo_location_desc must have a value.
             # Attempt to manually create a new location description from Ascender data.
             try:
-                Location.objects.create(
+                location = Location.objects.create(
                     name=job["geo_location_desc"],
                     ascender_desc=job["geo_location_desc"],
                     address=job["geo_location_desc"],
                 )
+                lookups.add_location(location)
                 log = f"Creation of new Entra ID account process generated new location, description {job['geo_location_desc']}"
                 AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=job)
                 LOGGER.info(log)
@@ -499,33 +858,47 @@ def ascender_user_import_all():
                 log = f"ASCENDER SYNC: exception during creation of new location in new Entra ID account process, description {job['geo_location_desc']}"
                 LOGGER.error(log)
 
-        if DepartmentUser.objects.filter(employee_id=employee_id).exists():
+        if user:
             # Ascender record does exist in our database; cache the current job record on the
             # DepartmentUser instance.
-            user = DepartmentUser.objects.get(employee_id=employee_id)
+            # If the Ascender paypoint doesn't exist in our database as a cost centre, create it now (rather than
+            # in update_from_ascender_data) so that it is included in the job hash below.
+            if job.get("paypoint") and not lookups.get_cost_centre(job["paypoint"]):
+                LOGGER.info(f"Cost centre {job['paypoint']} is not present in the IT Assets database, creating it")
+                lookups.add_cost_centre(CostCentre.objects.create(code=job["paypoint"], ascender_code=job["paypoint"]))
+
+            # If the job record (and the objects resolved from it) is unchanged since it was last applied, skip the user.
+            job_hash = ascender_job_hash(job, lookups.get_related_ids(job))
+            if not force and user.ascender_data_hash == job_hash:
+                unchanged_count += 1
+                continue
 
             # Check if the user already has Ascender data cached. If so, check if the position_no
             # value has changed. In that situation, create a DepartmentUserLog object.
+            if writer:
+                writer.track(user)
             if user.ascender_data and "position_no" in user.ascender_data and user.ascender_data["position_no"] != job["position_no"]:
-                DepartmentUserLog.objects.create(
-                    department_user=user,
-                    log={
-                        "ascender_field": "position_no",
-                        "old_value": user.ascender_data["position_no"],
-                        "new_value": job["position_no"],
-                        "description": "Update position_no value from Ascender",
-                    },
-                )
+                log = {
+                    "ascender_field": "position_no",
+                    "old_value": user.ascender_data["position_no"],
+                    "new_value": job["position_no"],
+                    "description": "Update position_no value from Ascender",
+                }
+                if writer:
+                    writer.add_user_log(user, log)
+                else:
+                    DepartmentUserLog.objects.create(department_user=user, log=log)
 
             # Cache the job record.
             user.ascender_data = job
             user.ascender_data_updated = timezone.localtime()
-            user.update_from_ascender_data()  # This method calls save()
-        elif not DepartmentUser.objects.filter(employee_id=employee_id).exists():
+            user.ascender_data_hash = job_hash
+            user.update_from_ascender_data(lookups, writer)  # This method calls save(), unless writer is passed in.
+        else:
             # Ascender record does not exist in our database; conditionally create a new
             # Entra ID account and DepartmentUser instance for them.
             # In this bulk check/create function, we do not ignore any account creation rules.
-            rules_passed = validate_ascender_user_account_rules(job, logging=False)
+            rules_passed = validate_ascender_user_account_rules(job, logging=False, lookups=lookups)
 
             if not rules_passed:
                 # This DepartmentUser does not exist but has not passed all rules to generate a new Entra ID user account.
@@ -536,7 +909,21 @@ def ascender_user_import_all():
 
             if cc and job_start_date and licence_type and manager and location:
                 LOGGER.info(f"Ascender employee ID {employee_id} does not exist and passed all rules; provisioning new account")
-                _ = create_entra_id_user(job, cc, job_start_date, manager, location, token)
+                new_user = create_entra_id_user(job, cc, job_start_date, manager, location, token)
+                if new_user:
+                    lookups.add_user(new_user)
+
+    if writer:
+        writer.flush()
+        LOGGER.info(f"Bulk updated {writer.users_updated} users from Ascender data")
+    LOGGER.info(f"Skipped {unchanged_count} users having unchanged Ascender data")
+
+    # Record the successful run.
+    if checkpoint:
+        checkpoint.watermark = run_started
+        if not changed_since:
+            checkpoint.last_full_sync = run_started
+        checkpoint.save()
 
 
 def ascender_user_import(
@@ -638,8 +1025,8 @@ def _resolve_names(job: dict) -> tuple[str, str, str, str]:
 def _check_licence_availability(licence_type_code: str, token: dict, ascender_record: str) -> str | None:
     """Check Microsoft 365 licence availability for the given Ascender licence type code.
 
-    Queries the MS Graph subscribedSku endpoint to verify that at least one licence
-    of each required SKU remains available for assignment. Returns the human-readable
+    Checks the cached subscribedSku snapshot (see SubscribedSkuCache) to verify that at least
+    one licence of each required SKU remains available for assignment. Returns the human-readable
     licence type string ("On-premise" or "Cloud") if all required licences are available,
     or None if the check fails or no licences remain.
 
@@ -657,7 +1044,7 @@ def _check_licence_availability(licence_type_code: str, token: dict, ascender_re
     - https://github.com/microsoftgraph/microsoft-graph-docs-contrib/issues/2337
     """
     if licence_type_code == "ONPUL":
-        e5_sku = ms_graph_get_subscribed_sku(MS_PRODUCTS["MICROSOFT 365 E5"], token)
+        e5_sku = SUBSCRIBED_SKU_CACHE.get_sku(MS_PRODUCTS["MICROSOFT 365 E5"], token)
         if not e5_sku:
             LOGGER.warning(f"Graph API E5 SKU query returned no data ({ascender_record})")
             return None
@@ -668,7 +1055,7 @@ def _check_licence_availability(licence_type_code: str, token: dict, ascender_re
         return "On-premise"
 
     elif licence_type_code == "CLDUL":
-        f3_sku = ms_graph_get_subscribed_sku(MS_PRODUCTS["MICROSOFT 365 F3"], token)
+        f3_sku = SUBSCRIBED_SKU_CACHE.get_sku(MS_PRODUCTS["MICROSOFT 365 F3"], token)
         if not f3_sku:
             LOGGER.warning(f"Graph API F3 SKU query returned no data ({ascender_record})")
             return None
@@ -677,7 +1064,7 @@ def _check_licence_availability(licence_type_code: str, token: dict, ascender_re
             LOGGER.warning(f"Creation of new Entra ID account aborted, no Cloud F3 licences available ({ascender_record})")
             return None
 
-        eo_sku = ms_graph_get_subscribed_sku(MS_PRODUCTS["EXCHANGE ONLINE (PLAN 2)"], token)
+        eo_sku = SUBSCRIBED_SKU_CACHE.get_sku(MS_PRODUCTS["EXCHANGE ONLINE (PLAN 2)"], token)
         if not eo_sku:
             LOGGER.warning(f"Graph API Exchange Online (Plan 2) SKU query returned no data ({ascender_record})")
             return None
@@ -686,7 +1073,7 @@ def _check_licence_availability(licence_type_code: str, token: dict, ascender_re
             LOGGER.warning(f"Creation of new Entra ID account aborted, no Cloud Exchange Online licences available ({ascender_record})")
             return None
 
-        sec_sku = ms_graph_get_subscribed_sku(MS_PRODUCTS["MICROSOFT 365 F5 SECURITY + COMPLIANCE ADD-ON"], token)
+        sec_sku = SUBSCRIBED_SKU_CACHE.get_sku(MS_PRODUCTS["MICROSOFT 365 F5 SECURITY + COMPLIANCE ADD-ON"], token)
         if not sec_sku:
             LOGGER.warning(f"Graph API F5 Security Addon SKU query returned no data ({ascender_record})")
             return None
@@ -740,12 +1127,25 @@ def _build_licence_payload(licence_type: str) -> dict:
         }
 
 
+def _provisioning_delays() -> Iterator[float]:
+    """Yields the delays (seconds) between attempts to configure a newly-created Entra ID account,
+    until at least PROVISIONING_MIN_WAIT seconds have been waited in total.
+    """
+    waited = 0
+    attempt = 0
+    while waited < PROVISIONING_MIN_WAIT:
+        delay = PROVISIONING_RETRY_POLICY.backoff(attempt)
+        waited += delay
+        attempt += 1
+        yield delay
+
+
 def _wait_for_usage_location(guid: str, headers: dict, job: dict, email: str) -> bool:
     """Poll MS Graph until the user's usageLocation field is confirmed set to 'AU'.
 
     Entra ID can take time to propagate newly-created user attributes, and the
     assignLicense call will fail if usageLocation is absent. This function retries
-    with exponential backoff (starting at 1 s, doubling each attempt, up to a 300 s cap).
+    with jittered exponential backoff for at least PROVISIONING_MIN_WAIT seconds.
 
     On success returns True. On timeout: logs a warning, creates an AscenderActionLog
     entry, and emails admins before returning False.
@@ -753,13 +1153,13 @@ def _wait_for_usage_location(guid: str, headers: dict, job: dict, email: str) ->
     user_has_usage_location = False
     graph_user = None
     timestamp = datetime.now()
-    retry_delay = 1
+    retry_delay = 0
     url = f"https://graph.microsoft.com/v1.0/users/{guid}"
     params = {"$select": "id,usageLocation"}
 
-    while retry_delay < 300:
-        resp = requests.get(url, headers=headers, params=params)
+    for delay in _provisioning_delays():
         try:
+            resp = get_graph_client().get(url, headers=headers, params=params)
             resp.raise_for_status()
             graph_user = resp.json()
         except (requests.exceptions.HTTPError, requests.exceptions.RequestException, Exception) as exc:
@@ -771,9 +1171,9 @@ def _wait_for_usage_location(guid: str, headers: dict, job: dict, email: str) ->
             user_has_usage_location = True
             break
         else:
-            LOGGER.info(f"User {guid} usageLocation not set; retrying in {retry_delay} seconds")
+            retry_delay = delay
+            LOGGER.info(f"User {guid} usageLocation not set; retrying in {retry_delay:.1f} seconds")
             sleep(retry_delay)
-            retry_delay = retry_delay * 2
 
     if not user_has_usage_location:
         log = f"Create new Entra ID user failed at assign license step for {email}, usageLocation field value not set"
@@ -797,8 +1197,8 @@ def _assign_licence_with_retry(
     """Assign M365 licences to a newly-created Entra ID user, retrying with exponential backoff.
 
     Newly-created accounts can take time to become fully ready for licence assignment, so
-    this function retries the assignLicense Graph API call starting at 1 s, doubling each
-    attempt, up to a 300 s cap.
+    this function retries the assignLicense Graph API call with jittered exponential backoff
+    for at least PROVISIONING_MIN_WAIT seconds.
 
     On permanent failure: logs a warning, creates an AscenderActionLog entry, emails admins,
     and attempts to DELETE the orphaned Entra ID account to avoid leaving a half-provisioned
@@ -809,12 +1209,12 @@ def _assign_licence_with_retry(
     user_has_license = False
     url = f"https://graph.microsoft.com/v1.0/users/{guid}/assignLicense"
     timestamp = datetime.now()
-    retry_delay = 1
+    retry_delay = 0
     resp = None
 
-    while retry_delay < 300:
+    for delay in _provisioning_delays():
         try:
-            resp = requests.post(url, headers=headers, json=licence_payload)
+            resp = get_graph_client().post(url, headers=headers, json=licence_payload)
             resp.raise_for_status()
             user_has_license = True
         except (requests.exceptions.HTTPError, requests.exceptions.RequestException, Exception) as exc:
@@ -823,13 +1223,17 @@ def _assign_licence_with_retry(
         timestamp = datetime.now()
 
         if user_has_license:
+            # Count the assigned licences against the cached licence availability.
+            SUBSCRIBED_SKU_CACHE.record_assignment([licence["skuId"] for licence in licence_payload["addLicenses"]])
             break
         else:
-            LOGGER.info(f"Licence assignment for user {guid} not yet successful; retrying in {retry_delay} seconds")
+            retry_delay = delay
+            LOGGER.info(f"Licence assignment for user {guid} not yet successful; retrying in {retry_delay:.1f} seconds")
             sleep(retry_delay)
-            retry_delay = retry_delay * 2
 
     if not user_has_license:
+        # The licence assignment may have partially succeeded, so refresh the cached licence availability.
+        SUBSCRIBED_SKU_CACHE.invalidate()
         log = f"Create new Entra ID user failed at assign license step for {email}, ask administrator to investigate ({ascender_record})"
         _log_and_abort(log, job)
         resp_code = resp.status_code if resp is not None else "N/A"
@@ -842,7 +1246,7 @@ def _assign_licence_with_retry(
         # Delete the partially-provisioned account to avoid an orphaned Entra ID user.
         delete_url = f"https://graph.microsoft.com/v1.0/users/{guid}"
         try:
-            delete_resp = requests.delete(delete_url, headers=headers)
+            delete_resp = get_graph_client().delete(delete_url, headers=headers)
             delete_resp.raise_for_status()
             cleanup_log = (
                 f"Create new Entra ID user cleanup due to license assign failure: deleted orphaned Entra ID account {guid} ({email})"
@@ -964,7 +1368,7 @@ def create_entra_id_user(
     }
     resp = None
     try:
-        resp = requests.post(url, headers=headers, json=data)
+        resp = get_graph_client().post(url, headers=headers, json=data)
         resp.raise_for_status()
         guid = resp.json()["id"]
     except (requests.exceptions.HTTPError, requests.exceptions.RequestException, Exception):
@@ -994,16 +1398,19 @@ def create_entra_id_user(
         "streetAddress": location.address,
         "state": "Western Australia",
     }
-    resp = requests.patch(url, headers=headers, json=data)
+    resp = None
     try:
+        resp = get_graph_client().patch(url, headers=headers, json=data)
         resp.raise_for_status()
     except (requests.exceptions.HTTPError, requests.exceptions.RequestException, Exception):
         log = f"Create new Entra ID user failed at account update step for {email}, ask administrator to investigate ({ascender_record})"
         AscenderActionLog.objects.create(level="ERROR", log=log, ascender_data=job)
         LOGGER.exception(log)
+        resp_code = resp.status_code if resp is not None else "N/A"
+        resp_content = resp.content if resp is not None else "N/A"
         _send_admin_failure_email(
             log,
-            f"Ascender record:\n{job}\nRequest URL: {url}\nRequest body:\n{data}\nResponse code: {resp.status_code}\nResponse content:\n{resp.content}",
+            f"Ascender record:\n{job}\nRequest URL: {url}\nRequest body:\n{data}\nResponse code: {resp_code}\nResponse content:\n{resp_content}",
         )
         return None
 
@@ -1011,16 +1418,19 @@ def create_entra_id_user(
     sleep(3)
     manager_url = f"https://graph.microsoft.com/v1.0/users/{guid}/manager/$ref"
     data = {"@odata.id": f"https://graph.microsoft.com/v1.0/users/{manager.azure_guid}"}
-    resp = requests.put(manager_url, headers=headers, json=data)
+    resp = None
     try:
+        resp = get_graph_client().put(manager_url, headers=headers, json=data)
         resp.raise_for_status()
     except (requests.exceptions.HTTPError, requests.exceptions.RequestException, Exception):
         log = f"Create new Entra ID user failed at assign manager update step for {email} (manager {manager})"
         AscenderActionLog.objects.create(level="ERROR", log=log, ascender_data=job)
         LOGGER.exception(log)
+        resp_code = resp.status_code if resp is not None else "N/A"
+        resp_content = resp.content if resp is not None else "N/A"
         _send_admin_failure_email(
             log,
-            f"Ascender record:\n{job}\nRequest URL: {manager_url}\nRequest body:\n{data}\nResponse code: {resp.status_code}\nResponse content:\n{resp.content}",
+            f"Ascender record:\n{job}\nRequest URL: {manager_url}\nRequest body:\n{data}\nResponse code: {resp_code}\nResponse content:\n{resp_content}",
         )
         return None
 
@@ -1120,6 +1530,7 @@ def department_user_create(
         manager=manager,
         ascender_data=job,
         ascender_data_updated=timezone.localtime(),
+        ascender_data_hash=ascender_job_hash(job, {"cost_centre": cc.pk, "manager": manager.pk, "location": location.pk}),
         position_no=position_no,
     )
 
@@ -1221,10 +1632,10 @@ OIM Service Desk\n"""
 
 def ascender_cc_manager_fetch() -> List[tuple]:
     """Returns all records from cc_manager_view."""
-    conn = get_ascender_db_connection()
-    cursor = conn.cursor()
     schema = sql.Identifier(settings.FOREIGN_SCHEMA)
     table = sql.Identifier(settings.FOREIGN_TABLE_CC_MANAGER)
     query = sql.SQL("SELECT * FROM {schema}.{table}").format(schema=schema, table=table)
-    cursor.execute(query)
-    return cursor.fetchall()
+    with get_ascender_db_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+            return cursor.fetchall()
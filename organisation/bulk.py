@@ -0,0 +1,86 @@
+import logging
+from typing import Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import DepartmentUser, DepartmentUserLog
+
+LOGGER = logging.getLogger("organisation")
+
+
+class DepartmentUserBulkWriter:
+    """Buffers DepartmentUser updates and DepartmentUserLog records made during a bulk import, and writes
+    them in batched transactions using bulk_update and bulk_create.
+    Call `track()` on each user before modifying it, so that only changed fields are written.
+    Pass `autoflush=False` to only write when `flush()` is called explicitly.
+    """
+
+    def __init__(self, batch_size: Optional[int] = None, autoflush: bool = True):
+        self.batch_size = batch_size or settings.DEPARTMENT_USER_BULK_WRITE_BATCH_SIZE
+        self.autoflush = autoflush
+        self.fields = [f for f in DepartmentUser._meta.concrete_fields if not f.primary_key]
+        self.snapshots = {}
+        self.users_updated = 0
+        self.clear()
+
+    def clear(self):
+        """Discard all buffered users and log records."""
+        self.users = {}
+        self.update_fields = set()
+        self.user_logs = []
+
+    def track(self, user: DepartmentUser):
+        """Record the current field values of the user, prior to it being modified."""
+        self.snapshots[user.pk] = {f.attname: getattr(user, f.attname) for f in self.fields}
+
+    def add_user(self, user: DepartmentUser):
+        """Buffer the user for writing, if any of its field values have changed since `track()` was called.
+        Untracked users have all fields written.
+        """
+        user.apply_business_rules()
+        snapshot = self.snapshots.pop(user.pk, None)
+        if snapshot is None:
+            changed = {f.name for f in self.fields}
+        else:
+            changed = {f.name for f in self.fields if getattr(user, f.attname) != snapshot[f.attname]}
+        if not changed:
+            return
+
+        # bulk_update doesn't apply auto_now, so set the timestamp here.
+        user.date_updated = timezone.now()
+        self.users[user.pk] = user
+        self.update_fields.update(changed, ["date_updated"])
+        self.flush_if_full()
+
+    def add_user_log(self, user: DepartmentUser, log: dict):
+        self.user_logs.append(DepartmentUserLog(department_user=user, log=log))
+        self.flush_if_full()
+
+    def buffered(self) -> int:
+        """Returns the number of buffered users and log records."""
+        return len(self.users) + len(self.user_logs)
+
+    def flush_if_full(self):
+        if self.autoflush and self.buffered() >= self.batch_size:
+            self.flush()
+
+    def write(self):
+        """Write all buffered records (called by `flush()` within a transaction)."""
+        if self.users:
+            DepartmentUser.objects.bulk_update(self.users.values(), sorted(self.update_fields), batch_size=self.batch_size)
+        if self.user_logs:
+            DepartmentUserLog.objects.bulk_create(self.user_logs, batch_size=self.batch_size)
+
+    def flush(self):
+        """Write all buffered users and log records in a single transaction."""
+        if not self.buffered():
+            return
+
+        with transaction.atomic():
+            self.write()
+
+        LOGGER.info(f"Bulk updated {len(self.users)} users and created {len(self.user_logs)} user logs")
+        self.users_updated += len(self.users)
+        self.clear()
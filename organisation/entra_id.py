@@ -0,0 +1,178 @@
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Optional
+
+from django.db import DatabaseError, transaction
+
+from .bulk import DepartmentUserBulkWriter
+from .microsoft_products import MS_PRODUCTS
+from .models import CostCentre, DepartmentUser, Location
+from .utils import payload_changes
+
+LOGGER = logging.getLogger("organisation")
+
+
+class EntraIdReconciler:
+    """Matches Entra ID user accounts to DepartmentUser objects using in-memory indexes, loaded
+    from the database once, and writes the resulting changes in bulk.
+    Call `reconcile()` for each Entra ID account, then `flush()` to write the changes.
+    Linked users whose cached Entra ID data has no material change are skipped, unless `force=True`.
+    """
+
+    LINK = "link"
+    CREATE = "create"
+    UPDATE = "update"
+    UNCHANGED = "unchanged"
+    CONFLICT_EMAIL = "conflict_email"
+    CONFLICT_EMPLOYEE_ID = "conflict_employee_id"
+    SKIP = "skip"
+
+    # Only create a new DepartmentUser if the Entra ID account has one of these licences assigned.
+    CREATE_LICENCES = {MS_PRODUCTS["MICROSOFT 365 E5"], MS_PRODUCTS["MICROSOFT 365 F3"]}
+
+    def __init__(self, member_groups: Optional[dict] = None, batch_size: Optional[int] = None, force: bool = False):
+        self.member_groups = member_groups or {}
+        self.force = force
+        self.counts = Counter()
+        self.writer = DepartmentUserBulkWriter(batch_size=batch_size, autoflush=False)
+        self.created = []
+        self.by_azure_guid = {}
+        self.by_email = {}
+        self.by_employee_id = {}
+        for user in DepartmentUser.objects.all():
+            self.index(user)
+        self.cost_centres = {cc.code: cc for cc in CostCentre.objects.all()}
+        self.locations = {loc.name: loc for loc in Location.objects.all()}
+
+    def index(self, user: DepartmentUser):
+        if user.azure_guid:
+            self.by_azure_guid[user.azure_guid] = user
+        if user.email:
+            self.by_email.setdefault(user.email.lower(), user)
+        if user.employee_id:
+            self.by_employee_id.setdefault(user.employee_id, user)
+
+    def get_user_by_email(self, email: Optional[str]) -> Optional[DepartmentUser]:
+        return self.by_email.get(email.lower()) if email else None
+
+    def classify(self, az: dict) -> tuple:
+        """Classify the passed-in Entra ID account without modifying any data.
+        Returns a tuple of (action, DepartmentUser or None).
+        """
+        user = self.by_azure_guid.get(az["objectId"])
+        # An existing DepartmentUser is linked to this Entra ID user.
+        if user:
+            if not self.force and not payload_changes(user.azure_ad_data, az):
+                return self.UNCHANGED, user
+            return self.UPDATE, user
+
+        # EDGE CASE 1: a department user with matching email may already exist with a different azure_guid.
+        # This should be cleaned up by the 'invalid GUID' check in most cases.
+        user = self.get_user_by_email(az["userPrincipalName"])
+        if user and user.azure_guid:
+            return self.CONFLICT_EMAIL, user
+
+        # EDGE CASE 2: a department user with matching employee ID may already exist with no azure_guid.
+        if az["employeeId"]:
+            existing_user = self.by_employee_id.get(az["employeeId"])
+            if existing_user and not existing_user.azure_guid:
+                return self.CONFLICT_EMPLOYEE_ID, existing_user
+
+        # A department user with matching email may already exist with no azure_guid.
+        if user:
+            return self.LINK, user
+
+        if az["assignedLicenses"] and not self.CREATE_LICENCES.isdisjoint(az["assignedLicenses"]):
+            return self.CREATE, None
+
+        return self.SKIP, None
+
+    def reconcile(self, az: dict) -> tuple:
+        """Classify the passed-in Entra ID account and apply the result to the matching (or new)
+        DepartmentUser in memory. Conflicts are not applied and need to be resolved manually.
+        Returns a tuple of (action, DepartmentUser or None).
+        """
+        action, user = self.classify(az)
+        self.counts[action] += 1
+
+        if action == self.UPDATE:
+            self.writer.track(user)
+            user.azure_ad_data = az
+            # Cache the list of assigned Entra groups on the user account (unless the query failed).
+            groups = self.member_groups.get(user.azure_guid)
+            if groups is not None:
+                user.assigned_groups = groups
+            else:
+                LOGGER.warning(f"Unable to query assigned groups for {user}")
+            user.azure_ad_data_updated = datetime.now(timezone.utc)
+            user.update_from_entra_id_data(writer=self.writer)
+        elif action == self.LINK:
+            self.writer.track(user)
+            user.azure_guid = az["objectId"]
+            user.azure_ad_data = az
+            user.azure_ad_data_updated = datetime.now(timezone.utc)
+            user.update_from_entra_id_data(writer=self.writer)
+            self.index(user)
+            LOGGER.info(f"Linked existing user {user.email} with Azure objectId {az['objectId']}")
+        elif action == self.CREATE:
+            user = DepartmentUser(
+                azure_guid=az["objectId"],
+                azure_ad_data=az,
+                azure_ad_data_updated=datetime.now(timezone.utc),
+                active=az["accountEnabled"],
+                email=az["userPrincipalName"],
+                name=az["displayName"],
+                given_name=az["givenName"],
+                surname=az["surname"],
+                title=az["jobTitle"],
+                telephone=az["telephoneNumber"],
+                mobile_phone=az["mobilePhone"],
+                employee_id=az["employeeId"],
+                cost_centre=self.cost_centres.get(az["companyName"]) if az["companyName"] else None,
+                location=self.locations.get(az["officeLocation"]) if az["officeLocation"] else None,
+                dir_sync_enabled=az["onPremisesSyncEnabled"],
+            )
+            user.apply_entra_id_data()
+            user.apply_business_rules()
+            self.created.append(user)
+            self.index(user)
+            LOGGER.info(f"Created new department user {user}")
+
+        return action, user
+
+    def flush(self) -> list:
+        """Write all changed and new DepartmentUser objects to the database in bulk. If a bulk write
+        fails, each user is saved individually instead.
+        Returns a list of (DepartmentUser, exception) tuples for any users that could not be saved.
+        """
+        failed = []
+        try:
+            self.writer.flush()
+        except DatabaseError:
+            LOGGER.exception("Bulk update of department users failed, saving users individually")
+            users = list(self.writer.users.values())
+            self.writer.clear()
+            failed += self.save_each(users)
+
+        if self.created:
+            try:
+                with transaction.atomic():
+                    DepartmentUser.objects.bulk_create(self.created, batch_size=self.writer.batch_size)
+                LOGGER.info(f"Bulk created {len(self.created)} department users")
+            except DatabaseError:
+                LOGGER.exception("Bulk creation of department users failed, saving users individually")
+                failed += self.save_each(self.created)
+            self.created = []
+
+        return failed
+
+    def save_each(self, users: list) -> list:
+        failed = []
+        for user in users:
+            try:
+                with transaction.atomic():
+                    user.save()
+            except Exception as e:
+                failed.append((user, e))
+        return failed
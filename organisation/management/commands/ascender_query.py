@@ -15,10 +15,16 @@ class Command(BaseCommand):
             dest="employee_id",
             help="Ascender employee no.",
         )
+        parser.add_argument(
+            "--snapshot",
+            action="store_true",
+            dest="snapshot",
+            help="Query the local snapshot of Ascender data instead of the Ascender database",
+        )
 
     def handle(self, *args, **options):
         print("Querying Ascender")
-        employee_id, jobs = ascender_employee_fetch(options["employee_id"])
+        employee_id, jobs = ascender_employee_fetch(options["employee_id"], from_snapshot=options["snapshot"])
 
         if not jobs:
             print("No data")
@@ -8,6 +8,32 @@ from sentry_sdk.crons import monitor
 class Command(BaseCommand):
     help = "Caches data from Ascender on DepartmentUser objects, optionally create new M365 accounts"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--top-job-only",
+            action="store_true",
+            dest="top_job_only",
+            help="Query only the top-ranked Ascender job for each employee (ranked by the database)",
+        )
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            dest="bulk",
+            help="Buffer changes to existing users and write them to the database in batches",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            dest="force",
+            help="Update all users from Ascender data, including those whose job data is unchanged",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            dest="incremental",
+            help="Query only employees changed since the last successful run (periodically runs a full sync)",
+        )
+
     def handle(self, *args, **options):
         logger = logging.getLogger("organisation")
         logger.info("Running Ascender database import")
@@ -15,7 +41,11 @@ class Command(BaseCommand):
         if settings.SENTRY_CRON_CHECK_ASCENDER:
             logger.info(f"Applying Sentry Cron Monitor: {settings.SENTRY_CRON_CHECK_ASCENDER}")
             with monitor(monitor_slug=settings.SENTRY_CRON_CHECK_ASCENDER):
-                ascender_user_import_all()
+                ascender_user_import_all(
+                    top_job_only=options["top_job_only"], bulk=options["bulk"], force=options["force"], incremental=options["incremental"]
+                )
         else:
-            ascender_user_import_all()
+            ascender_user_import_all(
+                top_job_only=options["top_job_only"], bulk=options["bulk"], force=options["force"], incremental=options["incremental"]
+            )
         logger.info("Completed")
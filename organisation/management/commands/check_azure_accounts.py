@@ -1,21 +1,38 @@
 import json
 import logging
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
+import requests
 from django.conf import settings
 from django.core import mail
 from django.core.management.base import BaseCommand
 from sentry_sdk.crons import monitor
 
 from itassets.utils import ms_graph_client_token
-from organisation.microsoft_products import MS_PRODUCTS
-from organisation.models import CostCentre, DepartmentUser, Location
-from organisation.utils import ms_graph_list_member_groups, ms_graph_list_users
+from organisation.entra_id import EntraIdReconciler
+from organisation.models import DepartmentUser, SyncCheckpoint
+from organisation.utils import (
+    ms_graph_list_member_groups_batch,
+    ms_graph_list_users,
+    ms_graph_list_users_delta,
+    ms_graph_users_delta_link,
+)
+
+# Name of the SyncCheckpoint persisting the Graph API delta link between runs.
+ENTRA_ID_SYNC_CHECKPOINT = "entra_id_users"
 
 
 class Command(BaseCommand):
     help = "Checks licensed user accounts from Entra ID and updates linked DepartmentUser objects"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            dest="full",
+            help="Check all Entra ID user accounts, rather than only those changed since the last successful run",
+        )
+
     def handle(self, *args, **options):
         logger = logging.getLogger("organisation")
         logger.info("Querying Microsoft Graph API for Entra ID user accounts")
@@ -23,139 +40,164 @@ class Command(BaseCommand):
         if settings.SENTRY_CRON_CHECK_AZURE:
             with monitor(monitor_slug=settings.SENTRY_CRON_CHECK_AZURE):
                 logger.info(f"Applying Sentry Cron Monitor: {settings.SENTRY_CRON_CHECK_AZURE}")
-                self.check_azure_accounts(logger)
+                self.check_azure_accounts(logger, full=options["full"])
         else:
-            self.check_azure_accounts(logger)
+            self.check_azure_accounts(logger, full=options["full"])
 
         logger.info("Completed")
 
-    def check_azure_accounts(self, logger):
+    def check_azure_accounts(self, logger, full=False):
         """Separate the body of this management command to allow running it in context with
         the Sentry monitor process.
+        Unless `full=True` is passed, only Entra ID users created, changed or deleted since the last
+        successful run are checked (using the persisted Graph API delta link). A full sync is run if
+        no delta link exists, if it has expired, or every ENTRA_ID_FULL_SYNC_INTERVAL_HOURS.
         """
+        run_started = datetime.now(timezone.utc)
         token = ms_graph_client_token()
-        azure_users = ms_graph_list_users(token=token)
+        checkpoint, _ = SyncCheckpoint.objects.get_or_create(name=ENTRA_ID_SYNC_CHECKPOINT)
+        azure_users = None
+        removed_azure_guids = None
+        failed_azure_guids = []
+
+        if full:
+            logger.info("Running a full Entra ID sync")
+        elif not checkpoint.data.get("delta_link"):
+            logger.info("No delta link is saved, running a full Entra ID sync")
+        elif checkpoint.full_sync_due(timedelta(hours=settings.ENTRA_ID_FULL_SYNC_INTERVAL_HOURS)):
+            logger.info("Full Entra ID sync is due, running a full sync")
+        else:
+            try:
+                delta = ms_graph_list_users_delta(checkpoint.data["delta_link"], token=token)
+            except requests.HTTPError as e:
+                # The Graph API returns 410 Gone if the delta link has expired.
+                if e.response is None or e.response.status_code != 410:
+                    raise
+                logger.warning("Saved delta link has expired, running a full Entra ID sync")
+                delta = None
+            if delta:
+                azure_users, removed_azure_guids, failed_azure_guids, delta_link = delta
+                logger.info(
+                    f"Entra ID delta query returned {len(azure_users)} changed and {len(removed_azure_guids)} removed user accounts"
+                )
+                if failed_azure_guids:
+                    logger.warning(
+                        f"Unable to query {len(failed_azure_guids)} changed Entra ID user account(s): {', '.join(failed_azure_guids)}"
+                    )
+
+        if azure_users is None:
+            # Obtain a delta link prior to listing all users, so that no changes made during the listing are missed.
+            try:
+                delta_link = ms_graph_users_delta_link(token=token)
+            except requests.HTTPError:
+                logger.exception("Unable to obtain an Entra ID delta link, the next run will be a full sync")
+                delta_link = None
+            azure_users = ms_graph_list_users(token=token)
 
-        if not azure_users:
-            logger.error("Microsoft Graph API returned no data")
-            return
+            if not azure_users:
+                logger.error("Microsoft Graph API returned no data")
+                return
 
         logger.info("Comparing Department Users to Entra ID user accounts")
 
         # Initially, check for any invalid Entra ID GUID values that are cached.
         logger.info("Checking cached Entra ID GUID values for validity")
-        valid_azure_guids = [i["objectId"] for i in azure_users]
-        cached_azure_guids = DepartmentUser.objects.filter(azure_guid__isnull=False).values_list("azure_guid", flat=True)
-        for guid in cached_azure_guids:
-            if guid not in valid_azure_guids:
-                du = DepartmentUser.objects.get(azure_guid=guid)
-                du.azure_guid = None
-                du.save()
-                logger.info(f"Removed invalid Entra ID GUID {guid} from department user {du}")
+        cached_azure_guids = set(DepartmentUser.objects.filter(azure_guid__isnull=False).values_list("azure_guid", flat=True))
+        if removed_azure_guids is None:
+            invalid_azure_guids = cached_azure_guids - {az["objectId"] for az in azure_users}
+        else:
+            # Delta sync: only GUIDs of removed Entra ID users are invalid.
+            invalid_azure_guids = cached_azure_guids & set(removed_azure_guids)
+        cleared = DepartmentUser.clear_guids("azure_guid", invalid_azure_guids)
+        if cleared:
+            removed = ", ".join(f"{guid} ({email})" for email, guid in cleared)
+            logger.info(f"Removed {len(cleared)} invalid Entra ID GUID(s) from department users: {removed}")
+
+        # Match Entra ID accounts to department users in memory, then write the changes in bulk.
+        # Linked users with no material change to their Entra ID data are skipped during a delta sync. Group
+        # membership isn't part of the payload, so every linked user is updated during a full sync.
+        reconciler = EntraIdReconciler(force=full or removed_azure_guids is None)
+
+        # Classify each Entra ID account. Any account which can't be classified (e.g. a malformed payload)
+        # is reported and skipped.
+        failed = len(failed_azure_guids)
+        valid_azure_users = []
+        changed_azure_users = []
+        for az in azure_users:
+            try:
+                action, _ = reconciler.classify(az)
+            except Exception as e:
+                self.report_exception(logger, az, e)
+                failed += 1
+                continue
+            valid_azure_users.append(az)
+            if action == reconciler.UPDATE:
+                changed_azure_users.append(az["objectId"])
+
+        # Query the assigned groups of changed Entra ID users linked to a DepartmentUser in batches.
+        logger.info("Querying assigned groups for changed, linked Entra ID accounts")
+        if changed_azure_users:
+            reconciler.member_groups = ms_graph_list_member_groups_batch(changed_azure_users, token=token) or {}
 
         logger.info("Checking Entra ID accounts against DepartmentUser records")
-        licences = set([MS_PRODUCTS["MICROSOFT 365 E5"], MS_PRODUCTS["MICROSOFT 365 F3"]])
-        for az in azure_users:
+        for az in valid_azure_users:
             try:
-                # No existing DepartmentUser is linked to this Entra ID user.
-                if not DepartmentUser.objects.filter(azure_guid=az["objectId"]).exists():
-                    # EDGE CASE 1: a department user with matching email may already exist with a different azure_guid.
-                    # This should be cleaned up by the 'invalid GUID' check above in most cases.
-                    # We'll need to correct this issue manually. Email a warning to admins and skip the account.
-                    if (
-                        az["userPrincipalName"]
-                        and DepartmentUser.objects.filter(email=az["userPrincipalName"], azure_guid__isnull=False).exists()
-                    ):
-                        existing_user = DepartmentUser.objects.filter(email=az["userPrincipalName"]).first()
-                        message = f"Skipped {az['userPrincipalName']} ({az['objectId']}): email exists and is already associated with Entra ID {existing_user.azure_guid}"
-                        logger.warning(message)
-                        mail.send_mail(
-                            subject=f"ENTRA ID SYNC: DepartmentUser with duplicate email while syncing Entra ID account {az['objectId']}",
-                            message=message,
-                            from_email=settings.NOREPLY_EMAIL,
-                            recipient_list=settings.ADMIN_EMAILS,
-                            fail_silently=True,
-                        )
-                        continue
-
-                    # EDGE CASE 2: a department user with matching employee ID may already exist with a different azure_guid.
-                    # We'll need to correct this issue manually. Email a warning to admins and skip the account.
-                    if az["employeeId"] and DepartmentUser.objects.filter(employee_id=az["employeeId"], azure_guid__isnull=True).exists():
-                        existing_user = DepartmentUser.objects.filter(employee_id=az["employeeId"]).first()
-                        message = f"Skipped {az['userPrincipalName']} ({az['objectId']}): employeeId exists and is already associated with {existing_user}"
-                        logger.warning(message)
-                        mail.send_mail(
-                            subject=f"ENTRA ID SYNC: DepartmentUser with duplicate employee_id while syncing Entra ID account {az['objectId']}",
-                            message=message,
-                            from_email=settings.NOREPLY_EMAIL,
-                            recipient_list=settings.ADMIN_EMAILS,
-                            fail_silently=True,
-                        )
-                        continue
-
-                    # A department user with matching email may already exist in IT Assets with no azure_guid.
-                    # If so, associate the Entra ID objectId with that user record.
-                    if DepartmentUser.objects.filter(email=az["userPrincipalName"], azure_guid__isnull=True).exists():
-                        existing_user = DepartmentUser.objects.get(email=az["userPrincipalName"])
-                        existing_user.azure_guid = az["objectId"]
-                        existing_user.azure_ad_data = az
-                        existing_user.azure_ad_data_updated = datetime.now(timezone.utc)
-                        existing_user.update_from_entra_id_data()  # This method calls save()
-                        logger.info(f"Linked existing user {existing_user.email} with Azure objectId {az['objectId']}")
-                        continue  # Skip to the next Azure user.
-
-                    # Only create a new DepartmentUser instance if the Entra ID account has an E5 or F3 licence assigned.
-                    if az["assignedLicenses"] and not licences.isdisjoint(az["assignedLicenses"]):
-                        if az["companyName"] and CostCentre.objects.filter(code=az["companyName"]).exists():
-                            cost_centre = CostCentre.objects.get(code=az["companyName"])
-                        else:
-                            cost_centre = None
-
-                        if az["officeLocation"] and Location.objects.filter(name=az["officeLocation"]).exists():
-                            location = Location.objects.get(name=az["officeLocation"])
-                        else:
-                            location = None
-
-                        new_user = DepartmentUser.objects.create(
-                            azure_guid=az["objectId"],
-                            azure_ad_data=az,
-                            azure_ad_data_updated=datetime.now(timezone.utc),
-                            active=az["accountEnabled"],
-                            email=az["userPrincipalName"],
-                            name=az["displayName"],
-                            given_name=az["givenName"],
-                            surname=az["surname"],
-                            title=az["jobTitle"],
-                            telephone=az["telephoneNumber"],
-                            mobile_phone=az["mobilePhone"],
-                            employee_id=az["employeeId"],
-                            cost_centre=cost_centre,
-                            location=location,
-                            dir_sync_enabled=az["onPremisesSyncEnabled"],
-                        )
-                        new_user.update_from_entra_id_data()
-                        logger.info(f"Created new department user {new_user}")
-                # An existing DepartmentUser is linked to this Entra ID user - cache the Azure data on it.
-                elif DepartmentUser.objects.filter(azure_guid=az["objectId"]).exists():
-                    # Update the existing DepartmentUser object fields with values from Azure.
-                    existing_user = DepartmentUser.objects.get(azure_guid=az["objectId"])
-                    existing_user.azure_ad_data = az
-                    # Cache the list of assigned Entra groups on the user account.
-                    groups = ms_graph_list_member_groups(azure_guid=existing_user.azure_guid, token=token)
-                    existing_user.assigned_groups = groups
-                    existing_user.azure_ad_data_updated = datetime.now(timezone.utc)
-                    existing_user.update_from_entra_id_data()  # This method calls save()
+                action, existing_user = reconciler.reconcile(az)
+                # Conflicts need to be corrected manually. Email a warning to admins and skip the account.
+                if action == reconciler.CONFLICT_EMAIL:
+                    message = f"Skipped {az['userPrincipalName']} ({az['objectId']}): email exists and is already associated with Entra ID {existing_user.azure_guid}"
+                    self.report_conflict(logger, az, "email", message)
+                elif action == reconciler.CONFLICT_EMPLOYEE_ID:
+                    message = f"Skipped {az['userPrincipalName']} ({az['objectId']}): employeeId exists and is already associated with {existing_user}"
+                    self.report_conflict(logger, az, "employee_id", message)
             except Exception as e:
-                # In the event of an exception, fail gracefully and alert the admins.
-                subject = f"ENTRA ID SYNC: exception during sync of Entra ID account {az['objectId']}"
-                logger.exception(subject)
-                message = f"Azure data:\n{json.dumps(az, indent=2)}\nException:\n{str(e)}\n"
-                html_message = f"<p>Azure data:</p><p>{json.dumps(az, indent=2)}</p><p>Exception:</p><p>{str(e)}\n</p>"
-                mail.send_mail(
-                    subject=subject,
-                    message=message,
-                    from_email=settings.NOREPLY_EMAIL,
-                    recipient_list=settings.ADMIN_EMAILS,
-                    html_message=html_message,
-                    fail_silently=True,
-                )
+                self.report_exception(logger, az, e)
+                failed += 1
+
+        for user, e in reconciler.flush():
+            self.report_exception(logger, user.azure_ad_data, e)
+            failed += 1
+        counts = reconciler.counts
+        logger.info(
+            f"Entra ID accounts: {counts[reconciler.UPDATE]} updated, {counts[reconciler.UNCHANGED]} unchanged (skipped), "
+            f"{counts[reconciler.LINK]} linked, {counts[reconciler.CREATE]} created, "
+            f"{counts[reconciler.CONFLICT_EMAIL] + counts[reconciler.CONFLICT_EMPLOYEE_ID]} conflicts"
+        )
+
+        if failed:
+            # The next delta query would not return the accounts which failed to sync, so their changes would be
+            # lost until the next full sync. Discard the delta link so that the next run is a full sync.
+            logger.warning(f"{failed} Entra ID account(s) failed to sync, the next run will be a full sync")
+            checkpoint.data["delta_link"] = None
+        else:
+            # Record the successful run.
+            checkpoint.data["delta_link"] = delta_link
+            checkpoint.watermark = run_started
+            if removed_azure_guids is None:
+                checkpoint.last_full_sync = run_started
+        checkpoint.save()
+
+    def report_conflict(self, logger, az, field, message):
+        logger.warning(message)
+        mail.send_mail(
+            subject=f"ENTRA ID SYNC: DepartmentUser with duplicate {field} while syncing Entra ID account {az['objectId']}",
+            message=message,
+            from_email=settings.NOREPLY_EMAIL,
+            recipient_list=settings.ADMIN_EMAILS,
+            fail_silently=True,
+        )
+
+    def report_exception(self, logger, az, e):
+        # In the event of an exception, fail gracefully and alert the admins.
+        subject = f"ENTRA ID SYNC: exception during sync of Entra ID account {az.get('objectId')}"
+        logger.exception(subject)
+        message = f"Azure data:\n{json.dumps(az, indent=2)}\nException:\n{str(e)}\n"
+        html_message = f"<p>Azure data:</p><p>{json.dumps(az, indent=2)}</p><p>Exception:</p><p>{str(e)}\n</p>"
+        mail.send_mail(
+            subject=subject,
+            message=message,
+            from_email=settings.NOREPLY_EMAIL,
+            recipient_list=settings.ADMIN_EMAILS,
+            html_message=html_message,
+            fail_silently=True,
+        )
@@ -29,6 +29,7 @@ class Command(BaseCommand):
             if du.employee_id is None:
                 du.ascender_data = {}
                 du.ascender_data_updated = None
+                du.ascender_data_hash = None
 
             logger.info(f"Clearing cached data from {du}")
             du.save()
@@ -5,8 +5,8 @@ from django.core import mail
 from django.core.management.base import BaseCommand, CommandError
 
 from itassets.utils import ms_graph_client_token
-from organisation.microsoft_products import MS_PRODUCTS
-from organisation.utils import ms_graph_get_subscribed_sku
+from organisation.microsoft_products import MS_MONITORED_PRODUCTS, get_sku_id
+from organisation.utils import SUBSCRIBED_SKU_CACHE
 
 
 class Command(BaseCommand):
@@ -63,48 +63,22 @@ class Command(BaseCommand):
         logger.info("Checking Microsoft 365 license availability")
         token = ms_graph_client_token()
 
-        e5_sku = ms_graph_get_subscribed_sku(MS_PRODUCTS["MICROSOFT 365 E5"], token)
-        e5_consumed = e5_sku["consumedUnits"]
-        e5_assignable = e5_sku["prepaidUnits"]["enabled"] + e5_sku["prepaidUnits"]["warning"]
-        e5_available = e5_assignable - e5_consumed
-        if e5_available <= threshold:
-            send_notification = True
-
-        f3_sku = ms_graph_get_subscribed_sku(MS_PRODUCTS["MICROSOFT 365 F3"], token)
-        f3_consumed = f3_sku["consumedUnits"]
-        f3_assignable = f3_sku["prepaidUnits"]["enabled"] + f3_sku["prepaidUnits"]["warning"]
-        f3_available = f3_assignable - f3_consumed
-        if f3_available <= threshold:
-            send_notification = True
-
-        eo_sku = ms_graph_get_subscribed_sku(MS_PRODUCTS["EXCHANGE ONLINE (PLAN 2)"], token)
-        eo_consumed = eo_sku["consumedUnits"]
-        eo_assignable = eo_sku["prepaidUnits"]["enabled"] + eo_sku["prepaidUnits"]["warning"]
-        eo_available = eo_assignable - eo_consumed
-        if eo_available <= threshold:
-            send_notification = True
-
-        sec_sku = ms_graph_get_subscribed_sku(MS_PRODUCTS["MICROSOFT 365 F5 SECURITY + COMPLIANCE ADD-ON"], token)
-        sec_consumed = sec_sku["consumedUnits"]
-        sec_assignable = sec_sku["prepaidUnits"]["enabled"] + sec_sku["prepaidUnits"]["warning"]
-        sec_available = sec_assignable - sec_consumed
-        if sec_available <= threshold:
-            send_notification = True
+        availability = []
+        for name, description in MS_MONITORED_PRODUCTS.items():
+            sku = SUBSCRIBED_SKU_CACHE.get_sku(get_sku_id(name), token)
+            consumed = sku["consumedUnits"]
+            assignable = sku["prepaidUnits"]["enabled"] + sku["prepaidUnits"]["warning"]
+            available = assignable - consumed
+            if available <= threshold:
+                send_notification = True
+            availability.append(f"{description}: {consumed} assigned, {available} available")
 
         subject = f"Notification - Microsoft M365 licence availability has reached warning threshold ({threshold})"
-        message = f"""This is an automated notification regarding low Microsoft 365 licence availability:\n\n
-        Microsoft 365 E5 (On-premise): {e5_consumed} assigned, {e5_available} available\n\n
-        Microsoft 365 F3 (Cloud): {f3_consumed} assigned, {f3_available} available\n
-        Exchange Online (Plan 2): {eo_consumed} assigned, {eo_available} available\n
-        Microsoft Defender + Purview Suite Add-on for FLW (Microsoft 365 F5 Security + Compliance Add-on): {sec_consumed} assigned, {sec_available} available\n
-        """
-        html_message = f"""<p>This is an automated notification regarding low Microsoft 365 licence availability:</p>
-        <ul>
-        <li>Microsoft 365 E5 (On-premise): {e5_consumed} assigned, {e5_available} available</li>
-        <li>Microsoft 365 F3 (Cloud): {f3_consumed} assigned, {f3_available} available</li>
-        <li>Exchange Online (Plan 2): {eo_consumed} assigned, {eo_available} available</li>
-        <li>Microsoft Defender + Purview Suite Add-on for FLW (Microsoft 365 F5 Security + Compliance Add-on): {sec_consumed} assigned, {sec_available} available</li>
-        </ul>"""
+        message = "This is an automated notification regarding low Microsoft 365 licence availability:\n\n"
+        message += "".join(f"{i}\n" for i in availability)
+        html_message = "<p>This is an automated notification regarding low Microsoft 365 licence availability:</p>\n<ul>\n"
+        html_message += "".join(f"<li>{i}</li>\n" for i in availability)
+        html_message += "</ul>"
 
         if send_notification:
             logger.info(subject)
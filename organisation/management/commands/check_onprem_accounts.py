@@ -5,7 +5,7 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 from sentry_sdk.crons import monitor
 
-from itassets.utils import get_blob_json
+from itassets.utils import iter_blob_json_array
 from organisation.models import DepartmentUser
 
 
@@ -35,44 +35,47 @@ class Command(BaseCommand):
         """Separate the body of this management command to allow running it in context with
         the Sentry monitor process.
         """
-        ad_users = get_blob_json(container=container, blob=blob)
-
-        if not ad_users:
-            logger.error("No on-prem AD user account data could be downloaded")
-            return
-
-        # Initially, check for any invalid onprem AD GUID values that are cached.
-        logger.info("Checking cached onprem AD GUID values")
-        valid_ad_guids = [i["ObjectGUID"] for i in ad_users]
-        cached_ad_guids = DepartmentUser.objects.filter(ad_guid__isnull=False).values_list("ad_guid", flat=True)
-        for guid in cached_ad_guids:
-            if guid not in valid_ad_guids:
-                du = DepartmentUser.objects.get(ad_guid=guid)
-                du.ad_guid = None
-                du.save()
-                logger.info(f"Removed invalid onprem AD GUID {guid} from department user {du}")
-
+        # Stream the AD user account data from the blob, processing each account as it is parsed.
+        # Accounts not linked to a department user are only linked after invalid GUID values are cleared.
+        # Only retain unlinked accounts having an email matching a department user, as no others can be linked.
         logger.info("Comparing Department Users to on-prem AD user accounts")
-        for ad in ad_users:
+        valid_ad_guids = set()
+        unlinked_ad_users = []
+        emails = {email.lower() for email in DepartmentUser.objects.filter(email__isnull=False).values_list("email", flat=True)}
+        for ad in iter_blob_json_array(container=container, blob=blob):
+            valid_ad_guids.add(ad["ObjectGUID"])
             # Skip admin accounts
             if "EmailAddress" in ad and ad["EmailAddress"] and "-admin" in ad["EmailAddress"]:  # Skip admin users.
                 continue
             if not DepartmentUser.objects.filter(ad_guid=ad["ObjectGUID"]).exists():
-                # No current link to this onprem AD user; try to find a match by email and link it.
-                if (
-                    "EmailAddress" in ad
-                    and ad["EmailAddress"]
-                    and DepartmentUser.objects.filter(ad_guid__isnull=True, email__istartswith=ad["EmailAddress"]).exists()
-                ):
-                    du = DepartmentUser.objects.get(email=ad["EmailAddress"].lower())
-                    du.ad_guid = ad["ObjectGUID"]
-                    du.ad_data = ad
-                    du.ad_data_updated = datetime.now(timezone.utc)
-                    du.save()
-                    logger.info(f"Linked existing department user {du} with onprem AD object {ad['ObjectGUID']}")
+                # No current link to this onprem AD user; try to find a match by email later.
+                if "EmailAddress" in ad and ad["EmailAddress"] and ad["EmailAddress"].lower() in emails:
+                    unlinked_ad_users.append(ad)
             else:
                 # An existing department user is linked to this onprem AD user.
                 du = DepartmentUser.objects.get(ad_guid=ad["ObjectGUID"])
                 du.ad_data = ad
                 du.ad_data_updated = datetime.now(timezone.utc)
                 du.save()
+
+        if not valid_ad_guids:
+            logger.error("No on-prem AD user account data could be downloaded")
+            return
+
+        # Check for any invalid onprem AD GUID values that are cached.
+        logger.info("Checking cached onprem AD GUID values")
+        cached_ad_guids = set(DepartmentUser.objects.filter(ad_guid__isnull=False).values_list("ad_guid", flat=True))
+        cleared = DepartmentUser.clear_guids("ad_guid", cached_ad_guids - valid_ad_guids)
+        if cleared:
+            removed = ", ".join(f"{guid} ({email})" for email, guid in cleared)
+            logger.info(f"Removed {len(cleared)} invalid onprem AD GUID(s) from department users: {removed}")
+
+        # Link unlinked onprem AD users to a department user with matching email.
+        for ad in unlinked_ad_users:
+            if DepartmentUser.objects.filter(ad_guid__isnull=True, email__istartswith=ad["EmailAddress"]).exists():
+                du = DepartmentUser.objects.get(email=ad["EmailAddress"].lower())
+                du.ad_guid = ad["ObjectGUID"]
+                du.ad_data = ad
+                du.ad_data_updated = datetime.now(timezone.utc)
+                du.save()
+                logger.info(f"Linked existing department user {du} with onprem AD object {ad['ObjectGUID']}")
@@ -12,8 +12,11 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         logger = logging.getLogger("organisation")
         logger.info("Checking currently-recorded emails for department users against Entra ID")
-        entra_users = ms_graph_list_users()
-        entra_emails = [i["mail"].lower() for i in entra_users if i["mail"]]
+        entra_users = ms_graph_list_users(fields=["mail"], compact=True)
+        if not entra_users:
+            logger.error("Microsoft Graph API returned no data")
+            return
+        entra_emails = set(mail.lower() for (mail,) in entra_users if mail)
         du_emails = [
             i.lower()
             for i in DepartmentUser.objects.filter(email__iendswith="@dbca.wa.gov.au", active=False).values_list("email", flat=True)
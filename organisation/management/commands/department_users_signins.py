@@ -1,11 +1,11 @@
 import logging
 from datetime import datetime, timedelta, timezone
 
-import requests
 from dateutil.parser import parse
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from itassets.ms_graph import get_graph_client
 from itassets.utils import ms_graph_client_token
 from organisation.models import DepartmentUser
 
@@ -53,16 +53,7 @@ class Command(BaseCommand):
         if log:
             logger.info(f"Querying user interactive sign-ins since {ts}")
 
-        resp = requests.get(url, headers=headers, params=params)
-        resp.raise_for_status()
-        j = resp.json()
-        signins = j["value"]
-
-        while "@odata.nextLink" in j:
-            resp = requests.get(j["@odata.nextLink"], headers=headers)
-            resp.raise_for_status()
-            j = resp.json()
-            signins.extend(j["value"])
+        signins = get_graph_client().paginate(url, headers, params=params, page_size=settings.MS_GRAPH_PAGE_SIZE)
 
         for signin in signins:
             try:
@@ -1,9 +1,28 @@
 from django.core.management.base import BaseCommand
 import logging
+from functools import partial
+from itassets.ms_graph import get_graph_client, run_concurrently
 from itassets.utils import ms_graph_client_token
 from organisation.models import DepartmentUser
 
 
+def make_graph_requests(graph_requests: list) -> list:
+    """Make the passed-in list of (method, url, kwargs, logs) Graph API requests in order, returning a list
+    of (response, logs) tuples for each request made. If a request raises an exception, the exception is
+    returned in place of its response and no further requests are made.
+    """
+    client = get_graph_client()
+    results = []
+    for method, url, kwargs, logs in graph_requests:
+        try:
+            resp = client.request(method, url, **kwargs)
+        except Exception as e:
+            results.append((e, logs))
+            break
+        results.append((resp, logs))
+    return results
+
+
 class Command(BaseCommand):
     help = "Caches data from Ascender on matching DepartmentUser objects"
 
@@ -19,7 +38,31 @@ class Command(BaseCommand):
         logger = logging.getLogger("organisation")
         logger.info("Checking department users for required changes to sync to AD")
         token = ms_graph_client_token()
+        user_requests = {}
 
         # Check all users, not just 'active' ones, otherwise we won't catch all changes.
         for du in DepartmentUser.objects.all():
-            du.sync_ad_data(log_only=options["log_only"], token=token)
+            graph_requests = []
+            du.sync_ad_data(log_only=options["log_only"], token=token, graph_requests=graph_requests)
+            if graph_requests:
+                user_requests[du] = graph_requests
+
+        # Make the Graph API requests to change cloud accounts concurrently (each user's requests are made in order).
+        if user_requests:
+            logger.info(f"Making Graph API requests to update {len(user_requests)} Entra ID accounts")
+            results = run_concurrently([partial(make_graph_requests, graph_requests) for graph_requests in user_requests.values()])
+            for du, result in zip(user_requests, results):
+                if isinstance(result, Exception):
+                    logger.error(f"ENTRA ID SYNC: Graph API requests to update {du} raised an exception: {result}")
+                    continue
+                # Only log the changes which were actually made in Entra ID.
+                for resp, logs in result:
+                    if isinstance(resp, Exception):
+                        logger.error(
+                            f"ENTRA ID SYNC: Graph API request to update {du} raised an exception (no further requests made): {resp}"
+                        )
+                    elif resp.ok:
+                        for log in logs:
+                            logger.info(log)
+                    else:
+                        logger.error(f"ENTRA ID SYNC: Graph API request to update {du} failed: {resp.status_code} {resp.text}")
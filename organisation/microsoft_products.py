@@ -41,3 +41,49 @@ MS_PRODUCTS = {
     "MICROSOFT TEAMS ROOMS PRO": "4cde982a-ede4-4409-9ae6-b003453c8ea6",
     "MICROSOFT TEAMS PREMIUM": "36a0f3b3-adb5-49ea-bf66-762134cf063a",
 }
+
+# Reverse map of SKU GUID to the human-readable Microsoft product name.
+MS_PRODUCT_NAMES = {guid: name for name, guid in MS_PRODUCTS.items()}
+
+# Licence tier descriptions (consistent with other OIM communications) of the primary Microsoft 365
+# licences assigned to user accounts, in order of precedence.
+MS_LICENCE_TIERS = {
+    "MICROSOFT 365 E5": "On-premise",
+    "MICROSOFT 365 F3": "Cloud",
+}
+
+# Products which licence a user account for inclusion in the user account lists.
+MS_USER_LICENCES = ["MICROSOFT 365 E5", "MICROSOFT 365 F3", "OFFICE 365 E5", "OFFICE 365 E1"]
+
+# Products having their availability monitored, mapped to the description used in notifications.
+MS_MONITORED_PRODUCTS = {
+    "MICROSOFT 365 E5": "Microsoft 365 E5 (On-premise)",
+    "MICROSOFT 365 F3": "Microsoft 365 F3 (Cloud)",
+    "EXCHANGE ONLINE (PLAN 2)": "Exchange Online (Plan 2)",
+    "MICROSOFT 365 F5 SECURITY + COMPLIANCE ADD-ON": "Microsoft Defender + Purview Suite Add-on for FLW (Microsoft 365 F5 Security + Compliance Add-on)",
+}
+
+
+def get_sku_id(name: str) -> str | None:
+    """Returns the SKU GUID of the passed-in product name, or None if the product is unknown."""
+    return MS_PRODUCTS.get(name)
+
+
+def get_product_name(sku_id: str) -> str:
+    """Returns the product name of the passed-in SKU GUID, or the GUID itself if the product is unknown."""
+    return MS_PRODUCT_NAMES.get(sku_id, sku_id)
+
+
+def get_product_names(sku_ids: list) -> list:
+    """Returns the list of product names (or GUIDs, for unknown products) of the passed-in SKU GUIDs."""
+    return [MS_PRODUCT_NAMES.get(sku_id, sku_id) for sku_id in sku_ids]
+
+
+def get_licence_tier(product_names: list) -> str | None:
+    """Returns the licence tier description of the passed-in list of assigned product names,
+    or None if no primary Microsoft 365 licence is assigned.
+    """
+    for name, tier in MS_LICENCE_TIERS.items():
+        if name in product_names:
+            return tier
+    return None
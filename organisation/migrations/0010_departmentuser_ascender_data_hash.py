@@ -0,0 +1,18 @@
+# Generated by Django 5.2.14 on 2026-10-18 02:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organisation', '0009_departmentuser_assigned_groups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='departmentuser',
+            name='ascender_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the Ascender job data last applied to this user, used to skip unchanged records', max_length=64, null=True),
+        ),
+    ]
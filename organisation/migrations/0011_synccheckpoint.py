@@ -0,0 +1,24 @@
+# Generated by Django 5.2.14 on 2026-10-18 03:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organisation', '0010_departmentuser_ascender_data_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, unique=True)),
+                ('watermark', models.DateTimeField(blank=True, help_text='Start time of the last successful sync run', null=True)),
+                ('last_full_sync', models.DateTimeField(blank=True, help_text='Start time of the last successful full sync run', null=True)),
+                ('data', models.JSONField(blank=True, default=dict, help_text='Any additional sync state')),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.14 on 2026-10-18 04:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organisation', '0011_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AscenderJobSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('employee_id', models.CharField(db_index=True, help_text='Ascender employee number', max_length=128)),
+                ('position_no', models.CharField(blank=True, db_index=True, max_length=128, null=True)),
+                ('job_rank', models.PositiveIntegerField(help_text="Position of this job in the employee's sorted list of jobs")),
+                ('data', models.JSONField(default=dict, help_text='Ascender job record')),
+                ('row_hash', models.CharField(help_text='Hash of the Ascender job record', max_length=64)),
+                ('snapshot_at', models.DateTimeField(help_text='Timestamp of the extract containing this job record')),
+            ],
+            options={
+                'ordering': ('employee_id', 'job_rank'),
+                'indexes': [models.Index(fields=['employee_id', 'job_rank'], name='ascender_job_employee_rank_idx')],
+            },
+        ),
+    ]
@@ -2,19 +2,24 @@ import json
 import logging
 from datetime import date, datetime, timedelta
 from io import BytesIO
-from typing import Optional
+from typing import TYPE_CHECKING, Iterable, Optional
 
-import requests
 from dateutil.parser import parse
 from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.utils import timezone
 
+from itassets.ms_graph import get_graph_client
 from itassets.utils import ms_graph_client_token, smart_truncate, upload_blob
 
-from .microsoft_products import MS_PRODUCTS
+from .microsoft_products import get_licence_tier, get_product_names
 from .utils import compare_values, ms_graph_get_user, parse_ad_pwd_last_set, parse_windows_ts, title_except
 
+if TYPE_CHECKING:
+    from .ascender import AscenderBulkWriter, AscenderLookups
+    from .bulk import DepartmentUserBulkWriter
+
 LOGGER = logging.getLogger("organisation")
 
 
@@ -166,6 +171,13 @@ class DepartmentUser(models.Model):
         editable=False,
         help_text="Timestamp of when Ascender data was last updated for this user",
     )
+    ascender_data_hash = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Hash of the Ascender job data last applied to this user, used to skip unchanged records",
+    )
     position_no = models.CharField(
         max_length=128,
         null=True,
@@ -226,6 +238,11 @@ class DepartmentUser(models.Model):
 
     def save(self, *args, **kwargs):
         """Override the save method with additional business logic."""
+        self.apply_business_rules()
+        super(DepartmentUser, self).save(*args, **kwargs)
+
+    def apply_business_rules(self):
+        """Normalise field values according to business rules, prior to the object being saved."""
         if self.employee_id:
             if (self.employee_id.lower() == "n/a") or (self.employee_id.strip() == ""):
                 self.employee_id = None
@@ -247,15 +264,22 @@ class DepartmentUser(models.Model):
             self.telephone = self.telephone.strip()
         if self.mobile_phone:
             self.mobile_phone = self.mobile_phone.strip()
-        super(DepartmentUser, self).save(*args, **kwargs)
+
+    @classmethod
+    def clear_guids(cls, field: str, guids: Iterable[str]) -> list:
+        """Clear the passed-in set of stale GUID values for `field` ("azure_guid" or "ad_guid") from
+        the department users having them, using a single UPDATE query (save() is not called).
+        Returns a list of (email, GUID) tuples for the users updated.
+        """
+        stale = list(cls.objects.filter(**{f"{field}__in": guids}).values_list("pk", "email", field))
+        if stale:
+            cls.objects.filter(pk__in=[pk for pk, _, _ in stale]).update(**{field: None, "date_updated": timezone.now()})
+        return [(email, guid) for _, email, guid in stale]
 
     def get_licence(self) -> Optional[str]:
         """Return Microsoft 365 licence description consistent with other OIM communications."""
         if self.assigned_licences:
-            if "MICROSOFT 365 E5" in self.assigned_licences:
-                return "On-premise"
-            elif "MICROSOFT 365 F3" in self.assigned_licences:
-                return "Cloud"
+            return get_licence_tier(self.assigned_licences)
         return None
 
     def get_display_name(self) -> str:
@@ -455,7 +479,8 @@ class DepartmentUser(models.Model):
 
         from organisation.ascender import ascender_employee_fetch
 
-        jobs_data = ascender_employee_fetch(self.employee_id)  # ('<employee_id>', [<list of jobs>])
+        # ('<employee_id>', [<list of jobs>])
+        jobs_data = ascender_employee_fetch(self.employee_id, from_snapshot=settings.ASCENDER_FETCH_FROM_SNAPSHOT)
         return jobs_data[1]
 
     def get_term_reason(self) -> Optional[str]:
@@ -468,15 +493,30 @@ class DepartmentUser(models.Model):
 
         return None
 
-    def sync_ad_data(self, container: str = "azuread", log_only: bool = False, token: dict = {}):
+    def sync_ad_data(self, container: str = "azuread", log_only: bool = False, token: dict = {}, graph_requests: Optional[list] = None):
         """For this DepartmentUser, iterate through fields which need to be synced between IT Assets
         and external AD databases (Entra ID, onprem AD).
         Each field has a 'source of truth'. In each case, check the source of truth and make changes
         to the required databases.
         If `log_only` is True, do not schedule changes to AD databases (output logs only).
+        If a `graph_requests` list is passed in, Graph API requests to change cloud accounts are appended
+        to it as (method, url, kwargs, logs) tuples to be made later (in order), rather than being made immediately.
+        The log messages for each change should only be output once its request has succeeded.
         """
         if not token:
             token = ms_graph_client_token()
+
+        def graph_request(method: str, request_url: str, logs: list, **kwargs):
+            if graph_requests is not None:
+                graph_requests.append((method, request_url, kwargs, logs))
+                return
+            resp = get_graph_client().request(method, request_url, **kwargs)
+            if resp.ok:
+                for log in logs:
+                    LOGGER.info(log)
+            else:
+                LOGGER.error(f"ENTRA ID SYNC: Graph API request to update {self} failed: {resp.status_code} {resp.text}")
+
         url = f"https://graph.microsoft.com/v1.0/users/{self.azure_guid}"
         acct = "onprem" if (self.ad_guid and self.ad_data and self.dir_sync_enabled) else "cloud"
         today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)  # We need a datetime object.
@@ -526,12 +566,18 @@ class DepartmentUser(models.Model):
                         }
                         data = {"accountEnabled": False}
                         if not log_only and settings.ASCENDER_DEACTIVATE_EXPIRED:
-                            requests.patch(url, headers=headers, json=data)
-                            LOGGER.info(f"AZURE SYNC: {self} Entra ID account accountEnabled set to False")
+                            graph_request(
+                                "PATCH",
+                                url,
+                                [f"AZURE SYNC: {self} Entra ID account accountEnabled set to False"],
+                                headers=headers,
+                                json=data,
+                            )
                             # Revoke cloud user sessions.
                             revoke_url = f"https://graph.microsoft.com/v1.0/users/{self.azure_guid}/revokeSignInSessions"
-                            requests.post(revoke_url, headers=headers)
-                            LOGGER.info(f"AZURE SYNC: {self} Entra ID account user sessions revoked")
+                            graph_request(
+                                "POST", revoke_url, [f"AZURE SYNC: {self} Entra ID account user sessions revoked"], headers=headers
+                            )
                         else:
                             LOGGER.info("NO ACTION (log only)")
 
@@ -572,12 +618,12 @@ class DepartmentUser(models.Model):
                     }
                     data = {"accountEnabled": False}
                     if not log_only and settings.DORMANT_ACCOUNT_DEACTIVATE:
-                        requests.patch(url, headers=headers, json=data)
-                        LOGGER.info(f"AZURE SYNC: {self} Entra ID account accountEnabled set to False")
+                        graph_request(
+                            "PATCH", url, [f"AZURE SYNC: {self} Entra ID account accountEnabled set to False"], headers=headers, json=data
+                        )
                         # Revoke cloud user sessions.
                         revoke_url = f"https://graph.microsoft.com/v1.0/users/{self.azure_guid}/revokeSignInSessions"
-                        requests.post(revoke_url, headers=headers)
-                        LOGGER.info(f"AZURE SYNC: {self} Entra ID account user sessions revoked")
+                        graph_request("POST", revoke_url, [f"AZURE SYNC: {self} Entra ID account user sessions revoked"], headers=headers)
                     else:
                         LOGGER.info("NO ACTION (log only)")
 
@@ -716,8 +762,9 @@ class DepartmentUser(models.Model):
                 }
                 data = {"displayName": self.name}
                 if not log_only:
-                    requests.patch(url, headers=headers, json=data)
-                    LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account displayName set to {self.name}")
+                    graph_request(
+                        "PATCH", url, [f"ENTRA ID SYNC: {self} Entra ID account displayName set to {self.name}"], headers=headers, json=data
+                    )
                 else:
                     LOGGER.info("NO ACTION (log only)")
 
@@ -769,8 +816,9 @@ class DepartmentUser(models.Model):
                 }
                 data = {"givenName": given_name}
                 if not log_only:
-                    requests.patch(url, headers=headers, json=data)
-                    LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account givenName set to {given_name}")
+                    graph_request(
+                        "PATCH", url, [f"ENTRA ID SYNC: {self} Entra ID account givenName set to {given_name}"], headers=headers, json=data
+                    )
                 else:
                     LOGGER.info("NO ACTION (log only)")
 
@@ -813,8 +861,9 @@ class DepartmentUser(models.Model):
                 }
                 data = {"surname": self.surname}
                 if not log_only:
-                    requests.patch(url, headers=headers, json=data)
-                    LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account surname set to {self.surname}")
+                    graph_request(
+                        "PATCH", url, [f"ENTRA ID SYNC: {self} Entra ID account surname set to {self.surname}"], headers=headers, json=data
+                    )
                 else:
                     LOGGER.info("NO ACTION (log only)")
 
@@ -860,8 +909,13 @@ class DepartmentUser(models.Model):
                 }
                 data = {"companyName": self.cost_centre.code}
                 if not log_only:
-                    requests.patch(url, headers=headers, json=data)
-                    LOGGER.info(f"AZURE SYNC: {self} Entra ID account companyName set to {self.cost_centre.code}")
+                    graph_request(
+                        "PATCH",
+                        url,
+                        [f"AZURE SYNC: {self} Entra ID account companyName set to {self.cost_centre.code}"],
+                        headers=headers,
+                        json=data,
+                    )
                 else:
                     LOGGER.info("NO ACTION (log only)")
 
@@ -906,8 +960,13 @@ class DepartmentUser(models.Model):
                 }
                 data = {"department": self.get_business_unit()}
                 if not log_only:
-                    requests.patch(url, headers=headers, json=data)
-                    LOGGER.info(f"AZURE SYNC: {self} Entra ID account department set to {self.get_business_unit()}")
+                    graph_request(
+                        "PATCH",
+                        url,
+                        [f"AZURE SYNC: {self} Entra ID account department set to {self.get_business_unit()}"],
+                        headers=headers,
+                        json=data,
+                    )
                 else:
                     LOGGER.info("NO ACTION (log only)")
 
@@ -944,8 +1003,9 @@ class DepartmentUser(models.Model):
                 }
                 data = {"jobTitle": self.title}
                 if not log_only:
-                    requests.patch(url, headers=headers, json=data)
-                    LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account jobTitle set to {self.title}")
+                    graph_request(
+                        "PATCH", url, [f"ENTRA ID SYNC: {self} Entra ID account jobTitle set to {self.title}"], headers=headers, json=data
+                    )
                 else:
                     LOGGER.info("NO ACTION (log only)")
 
@@ -982,8 +1042,13 @@ class DepartmentUser(models.Model):
                     }
                     data = {"businessPhones": [self.telephone if self.telephone else " "]}
                     if not log_only:
-                        requests.patch(url, headers=headers, json=data)
-                        LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account telephoneNumber set to {self.telephone}")
+                        graph_request(
+                            "PATCH",
+                            url,
+                            [f"ENTRA ID SYNC: {self} Entra ID account telephoneNumber set to {self.telephone}"],
+                            headers=headers,
+                            json=data,
+                        )
                     else:
                         LOGGER.info("NO ACTION (log only)")
 
@@ -1020,8 +1085,13 @@ class DepartmentUser(models.Model):
                     }
                     data = {"mobilePhone": self.mobile_phone}
                     if not log_only:
-                        requests.patch(url, headers=headers, json=data)
-                        LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account mobilePhone set to {self.mobile_phone}")
+                        graph_request(
+                            "PATCH",
+                            url,
+                            [f"ENTRA ID SYNC: {self} Entra ID account mobilePhone set to {self.mobile_phone}"],
+                            headers=headers,
+                            json=data,
+                        )
                     else:
                         LOGGER.info("NO ACTION (log only)")
 
@@ -1064,8 +1134,13 @@ class DepartmentUser(models.Model):
                 }
                 data = {"employeeId": self.employee_id}
                 if not log_only:
-                    requests.patch(url, headers=headers, json=data)
-                    LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account employeeId set to {self.employee_id}")
+                    graph_request(
+                        "PATCH",
+                        url,
+                        [f"ENTRA ID SYNC: {self} Entra ID account employeeId set to {self.employee_id}"],
+                        headers=headers,
+                        json=data,
+                    )
                 else:
                     LOGGER.info("NO ACTION (log only)")
 
@@ -1119,8 +1194,13 @@ class DepartmentUser(models.Model):
                     manager_url = f"https://graph.microsoft.com/v1.0/users/{self.azure_guid}/manager/$ref"
                     data = {"@odata.id": f"https://graph.microsoft.com/v1.0/users/{self.manager.azure_guid}"}
                     if not log_only:
-                        requests.put(manager_url, headers=headers, json=data)
-                        LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account manager set to {self.manager}")
+                        graph_request(
+                            "PUT",
+                            manager_url,
+                            [f"ENTRA ID SYNC: {self} Entra ID account manager set to {self.manager}"],
+                            headers=headers,
+                            json=data,
+                        )
                     else:
                         LOGGER.info("NO ACTION (log only)")
 
@@ -1208,15 +1288,25 @@ class DepartmentUser(models.Model):
                         "streetAddress": ascender_location.address,
                     }
                     if not log_only:
-                        requests.patch(url, headers=headers, json=data)
-                        LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account officeLocation set to {ascender_location.name}")
-                        LOGGER.info(f"ENTRA ID SYNC: {self} Entra ID account streetAddress set to {ascender_location.address}")
+                        graph_request(
+                            "PATCH",
+                            url,
+                            [
+                                f"ENTRA ID SYNC: {self} Entra ID account officeLocation set to {ascender_location.name}",
+                                f"ENTRA ID SYNC: {self} Entra ID account streetAddress set to {ascender_location.address}",
+                            ],
+                            headers=headers,
+                            json=data,
+                        )
                     else:
                         LOGGER.info("NO ACTION (log only)")
 
-    def update_from_ascender_data(self):
+    def update_from_ascender_data(self, lookups: Optional["AscenderLookups"] = None, writer: Optional["AscenderBulkWriter"] = None):
         """For this DepartmentUser object, update the field values from cached Ascender data
         (the source of truth for these values).
+        Optionally pass in preloaded `lookups` to resolve cost centres, managers and locations
+        without querying the database for each one, and a `writer` to buffer the changes and
+        action logs for a bulk write instead of saving this object immediately.
         """
         if not self.employee_id or not self.ascender_data:
             return
@@ -1236,8 +1326,7 @@ class DepartmentUser(models.Model):
                 # Ascender stores names in all caps, use title case.
                 first_name = self.ascender_data["first_name"].title()
                 log = f"{self} first name {self.given_name} differs from Ascender first name {first_name}, updating it"
-                AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                LOGGER.info(log)
+                self.ascender_action_log(log, writer)
                 self.given_name = first_name
         # Handle blank/null value.
         elif "first_name" in self.ascender_data and not self.ascender_data["first_name"]:
@@ -1245,8 +1334,7 @@ class DepartmentUser(models.Model):
                 log = (
                     f"{self} first name {self.given_name} differs from Ascender first name {self.ascender_data['first_name']}, updating it"
                 )
-                AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                LOGGER.info(log)
+                self.ascender_action_log(log, writer)
                 self.given_name = self.ascender_data["first_name"]
 
         # Preferred name
@@ -1258,15 +1346,13 @@ class DepartmentUser(models.Model):
             if self.ascender_data["preferred_name"].upper() != preferred_name.upper():
                 preferred_name = self.ascender_data["preferred_name"].title()
                 log = f"{self} preferred name {self.preferred_name} differs from Ascender preferred name {preferred_name}, updating it"
-                AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                LOGGER.info(log)
+                self.ascender_action_log(log, writer)
                 self.preferred_name = preferred_name
         # Handle blank/null value.
         elif "preferred_name" in self.ascender_data and not self.ascender_data["preferred_name"]:
             if self.ascender_data["preferred_name"] != self.preferred_name:
                 log = f"{self} preferred name {self.preferred_name} differs from Ascender preferred name {self.ascender_data['preferred_name']}, updating it"
-                AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                LOGGER.info(log)
+                self.ascender_action_log(log, writer)
                 self.preferred_name = self.ascender_data["preferred_name"]
 
         # Surname
@@ -1278,15 +1364,13 @@ class DepartmentUser(models.Model):
             if self.ascender_data["surname"].upper() != surname.upper():
                 surname = self.ascender_data["surname"].title()
                 log = f"{self} surname {self.surname} differs from Ascender surname {surname}, updating it"
-                AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                LOGGER.info(log)
+                self.ascender_action_log(log, writer)
                 self.surname = surname
         # Handle blank/null value.
         elif "surname" in self.ascender_data and not self.ascender_data["surname"]:
             if self.ascender_data["surname"] != self.surname:
                 log = f"{self} surname {self.surname} differs from Ascender surname {self.ascender_data['surname']}, updating it"
-                AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                LOGGER.info(log)
+                self.ascender_action_log(log, writer)
                 self.surname = self.ascender_data["surname"]
 
         # Set the user display name (Entra ID / Outlook) from Ascender name values,
@@ -1294,75 +1378,79 @@ class DepartmentUser(models.Model):
         self.name = self.get_display_name()
 
         # Cost centre (Ascender records cost centre as 'paypoint').
-        if "paypoint" in self.ascender_data and CostCentre.objects.filter(ascender_code=self.ascender_data["paypoint"]).exists():
+        cc = None
+        if "paypoint" in self.ascender_data:
+            if lookups:
+                cc = lookups.get_cost_centre(self.ascender_data["paypoint"])
+            else:
+                cc = CostCentre.objects.filter(ascender_code=self.ascender_data["paypoint"]).first()
+
+        if "paypoint" in self.ascender_data and cc:
             paypoint = self.ascender_data["paypoint"]
-            cc = CostCentre.objects.get(ascender_code=paypoint)
 
             # The user's current CC differs from that in Ascender (it might be None).
-            if self.cost_centre != cc:
-                if self.cost_centre:
+            if self.cost_centre_id != cc.pk:
+                if self.cost_centre_id:
                     log = f"{self} cost centre {self.cost_centre.ascender_code} differs from Ascender paypoint {paypoint}, updating it"
-                    AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                    LOGGER.info(log)
+                    self.ascender_action_log(log, writer)
                 else:
                     log = f"{self} cost centre set from Ascender paypoint {paypoint}"
-                    AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                    LOGGER.info(log)
+                    self.ascender_action_log(log, writer)
                 self.cost_centre = cc  # Change the department user's cost centre.
-        elif "paypoint" in self.ascender_data and not CostCentre.objects.filter(ascender_code=self.ascender_data["paypoint"]).exists():
+        elif "paypoint" in self.ascender_data and not cc:
             LOGGER.info(f"Cost centre {self.ascender_data['paypoint']} is not present in the IT Assets database, creating it")
             paypoint = self.ascender_data["paypoint"]
             new_cc = CostCentre.objects.create(code=paypoint, ascender_code=paypoint)
+            if lookups:
+                lookups.add_cost_centre(new_cc)
             self.cost_centre = new_cc
             log = f"{self} cost centre set from Ascender paypoint {paypoint}"
-            AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-            LOGGER.info(log)
+            self.ascender_action_log(log, writer)
 
         # Manager
-        if (
-            "manager_emp_no" in self.ascender_data
-            and self.ascender_data["manager_emp_no"]
-            and DepartmentUser.objects.filter(employee_id=self.ascender_data["manager_emp_no"]).exists()
-        ):
-            manager = DepartmentUser.objects.get(employee_id=self.ascender_data["manager_emp_no"])
+        manager = None
+        if "manager_emp_no" in self.ascender_data and self.ascender_data["manager_emp_no"]:
+            if lookups:
+                manager = lookups.get_user(self.ascender_data["manager_emp_no"])
+            else:
+                manager = DepartmentUser.objects.filter(employee_id=self.ascender_data["manager_emp_no"]).first()
+
+        if manager:
             # Hard-coded short-circuit business rule: a staff member having the title "DIRECTOR GENERAL"
             # will not have a manager set. Context: the Ascender record for the DG has the DDG set as
             # the 'manager' for payroll certification purposes.
             if self.title and self.title.upper() == "DIRECTOR GENERAL":
-                if self.manager:
+                if self.manager_id:
                     log = f"Director General {self} manager set manually to null"
-                    AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                    LOGGER.info(log)
+                    self.ascender_action_log(log, writer)
                     self.manager = None
             # The user's current manager differs from that in Ascender (it might be set to None).
-            elif self.manager != manager:
-                if self.manager:
+            elif self.manager_id != manager.pk:
+                if self.manager_id:
                     log = f"{self} manager {self.manager} differs from Ascender, updating it to {manager}"
-                    AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                    LOGGER.info(log)
+                    self.ascender_action_log(log, writer)
                 else:
                     log = f"{self} manager set from Ascender to {manager}"
-                    AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                    LOGGER.info(log)
+                    self.ascender_action_log(log, writer)
                 self.manager = manager  # Change the department user's manager.
 
         # Location
-        if (
-            "geo_location_desc" in self.ascender_data
-            and self.ascender_data["geo_location_desc"]
-            and Location.objects.filter(ascender_desc=self.ascender_data["geo_location_desc"]).exists()
-        ):
-            location = Location.objects.get(ascender_desc=self.ascender_data["geo_location_desc"])
+        location = None
+        if "geo_location_desc" in self.ascender_data and self.ascender_data["geo_location_desc"]:
+            if lookups:
+                location = lookups.get_location(self.ascender_data["geo_location_desc"])
+            else:
+                location = Location.objects.filter(ascender_desc=self.ascender_data["geo_location_desc"]).first()
+
+        if location:
             # The user's current location differs from that in Ascender.
-            if self.location != location:
-                if self.location:
+            if self.location_id != location.pk:
+                if self.location_id:
                     log = f"{self} location {self.location} differs from Ascender location {location}, updating it"
-                    AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                    LOGGER.info(log)
+                    self.ascender_action_log(log, writer)
                 else:
                     log = f"{self} location set from Ascender location {location}"
-                    AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                    LOGGER.info(log)
+                    self.ascender_action_log(log, writer)
                 self.location = location
 
         # Title
@@ -1371,19 +1459,41 @@ class DepartmentUser(models.Model):
             current_title = self.title if self.title else ""
             if ascender_title.upper() != current_title.upper():
                 log = f"{self} title {self.title} differs from Ascender title {ascender_title}, updating it"
-                AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
-                LOGGER.info(log)
+                self.ascender_action_log(log, writer)
                 self.title = ascender_title
 
-        self.save()
+        if writer:
+            writer.add_user(self)
+        else:
+            self.save()
+
+    def ascender_action_log(self, log: str, writer: Optional["AscenderBulkWriter"] = None):
+        """Record an INFO-level AscenderActionLog for an update made from this user's Ascender data,
+        optionally buffering it on the passed-in bulk writer.
+        """
+        if writer:
+            writer.add_action_log(level="INFO", log=log, ascender_data=self.ascender_data)
+        else:
+            AscenderActionLog.objects.create(level="INFO", log=log, ascender_data=self.ascender_data)
+        LOGGER.info(log)
 
-    def update_from_entra_id_data(self):
+    def update_from_entra_id_data(self, writer: Optional["DepartmentUserBulkWriter"] = None):
         """For this DepartmentUser object, update the field values from cached Azure Entra ID data
         (the source of truth for these values).
+        Optionally pass in a `writer` to buffer the changes for a bulk write, rather than saving
+        (call `writer.track()` on this user before modifying it).
         """
         if not self.azure_guid or not self.azure_ad_data:
             return
 
+        self.apply_entra_id_data()
+        if writer:
+            writer.add_user(self)
+        else:
+            self.save()
+
+    def apply_entra_id_data(self):
+        """Set the field values of this DepartmentUser from cached Azure Entra ID data, without saving."""
         if "accountEnabled" in self.azure_ad_data and self.azure_ad_data["accountEnabled"] != self.active:
             self.active = self.azure_ad_data["accountEnabled"]
             LOGGER.info(f"ENTRA ID SYNC: {self} active changed to {self.active}")
@@ -1402,14 +1512,7 @@ class DepartmentUser(models.Model):
         # We replace the SKU GUID values with (known) human-readable licence types, as appropriate.
         self.assigned_licences = []
         if "assignedLicenses" in self.azure_ad_data:
-            for sku in self.azure_ad_data["assignedLicenses"]:
-                match = False
-                for name, guid in MS_PRODUCTS.items():
-                    if sku == guid:
-                        self.assigned_licences.append(name)
-                        match = True
-                if not match:
-                    self.assigned_licences.append(sku)
+            self.assigned_licences = get_product_names(self.azure_ad_data["assignedLicenses"])
 
         # last_signin (last successful sign-in event for an account)
         # NOTE: the signInActivity dict returned on the user object from Graph API is inaccurate,
@@ -1419,8 +1522,6 @@ class DepartmentUser(models.Model):
         if self.get_pw_last_change():
             self.last_password_change = self.get_pw_last_change()
 
-        self.save()
-
     def get_account_dormant(self, dormant_account_days: Optional[int] = None) -> Optional[bool]:
         """Returns boolean if the last_signin or last_password_change dates are within the threshold, or None if unknown."""
         # If we don't have the account object GUID, cached account data or the timestamp of the last sign-in, return None.
@@ -1572,3 +1673,42 @@ class CostCentre(models.Model):
 
     def __str__(self):
         return self.code
+
+
+class AscenderJobSnapshot(models.Model):
+    """A local copy of a single job row from the most recent extract of the Ascender view,
+    refreshed by the Ascender import process.
+    """
+
+    employee_id = models.CharField(max_length=128, db_index=True, help_text="Ascender employee number")
+    position_no = models.CharField(max_length=128, null=True, blank=True, db_index=True)
+    job_rank = models.PositiveIntegerField(help_text="Position of this job in the employee's sorted list of jobs")
+    data = models.JSONField(default=dict, help_text="Ascender job record")
+    row_hash = models.CharField(max_length=64, help_text="Hash of the Ascender job record")
+    snapshot_at = models.DateTimeField(help_text="Timestamp of the extract containing this job record")
+
+    class Meta:
+        ordering = ("employee_id", "job_rank")
+        indexes = [models.Index(fields=["employee_id", "job_rank"], name="ascender_job_employee_rank_idx")]
+
+    def __str__(self):
+        return f"{self.employee_id} {self.position_no}"
+
+
+class SyncCheckpoint(models.Model):
+    """Persists the state of an incremental sync process between runs, i.e. the start time of the
+    last successful run (the watermark) and of the last successful full sync.
+    """
+
+    name = models.CharField(max_length=128, unique=True)
+    watermark = models.DateTimeField(null=True, blank=True, help_text="Start time of the last successful sync run")
+    last_full_sync = models.DateTimeField(null=True, blank=True, help_text="Start time of the last successful full sync run")
+    data = models.JSONField(default=dict, blank=True, help_text="Any additional sync state")
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+    def full_sync_due(self, interval: timedelta) -> bool:
+        """Returns True if no full sync has completed within the passed-in interval."""
+        return not self.watermark or not self.last_full_sync or timezone.now() - self.last_full_sync >= interval
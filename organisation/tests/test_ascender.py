@@ -7,10 +7,20 @@ from uuid import uuid4
 from django.contrib.auth.models import User
 from django.core import mail
 from django.test import TestCase, override_settings
+from django.utils import timezone
 from mixer.backend.django import mixer
 
+from itassets.ms_graph import GraphCircuitOpenError
 from itassets.test_api import random_dbca_email
 from organisation.ascender import (
+    ASCENDER_SNAPSHOT_CHECKPOINT,
+    ASCENDER_SYNC_CHECKPOINT,
+    ASCENDER_SYNC_OVERLAP,
+    DATE_MAX,
+    FOREIGN_TABLE_FIELDS,
+    PROVISIONING_MIN_WAIT,
+    AscenderBulkWriter,
+    AscenderLookups,
     _assign_licence_with_retry,
     _build_licence_payload,
     _check_licence_availability,
@@ -18,15 +28,27 @@ from organisation.ascender import (
     _resolve_names,
     _send_admin_failure_email,
     _wait_for_usage_location,
+    ascender_cc_manager_fetch,
+    ascender_db_fetch,
+    ascender_employee_fetch,
+    ascender_employees_fetch_all,
+    ascender_job_hash,
+    ascender_job_sort_key,
+    ascender_snapshot_employee_fetch,
+    ascender_snapshot_refresh,
+    ascender_user_import_all,
+    compile_row_transformer,
     create_entra_id_user,
     department_user_create,
     generate_valid_dbca_email,
+    get_ascender_db_pool,
     new_user_creation_email,
+    row_to_python,
     sanitise_name_values,
     validate_ascender_user_account_rules,
 )
 from organisation.microsoft_products import MS_PRODUCTS
-from organisation.models import AscenderActionLog, CostCentre, DepartmentUser, Location
+from organisation.models import AscenderActionLog, AscenderJobSnapshot, CostCentre, DepartmentUser, Location, SyncCheckpoint
 from organisation.utils import title_except
 
 # Disable non-critical logging output.
@@ -99,6 +121,13 @@ class AscenderTestCase(TestCase):
         """Test the validate_ascender_user_account_rules function"""
         self.assertTrue(validate_ascender_user_account_rules(self.ascender_data))
 
+    def test_validate_ascender_user_account_rules_lookups(self):
+        """Test the validate_ascender_user_account_rules function using preloaded lookups"""
+        lookups = AscenderLookups()
+        self.assertTrue(validate_ascender_user_account_rules(self.ascender_data, lookups=lookups))
+        lookups.add_user(mixer.blend(DepartmentUser, email=random_dbca_email, employee_id=self.ascender_data["employee_id"]))
+        self.assertFalse(validate_ascender_user_account_rules(self.ascender_data, lookups=lookups))
+
     def test_validate_ascender_user_account_rules_fpc(self):
         """Test the validate_ascender_user_account_rules function for an FPC record"""
         self.ascender_data["clevel1_id"] = "FPC"
@@ -374,70 +403,70 @@ class CheckLicenceAvailabilityTestCase(TestCase):
         self.token = {"access_token": "dummy"}
         self.record = "123456, Test User"
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_onpul_available_returns_on_premise(self, mock_sku):
         """Returns 'On-premise' when E5 licence is available."""
         mock_sku.return_value = _make_sku(100, 0, 50)
         result = _check_licence_availability("ONPUL", self.token, self.record)
         self.assertEqual(result, "On-premise")
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_onpul_no_sku_data_returns_none(self, mock_sku):
         """Returns None when the E5 SKU query returns no data."""
         mock_sku.return_value = None
         result = _check_licence_availability("ONPUL", self.token, self.record)
         self.assertIsNone(result)
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_onpul_exhausted_returns_none(self, mock_sku):
         """Returns None when all E5 licences are consumed."""
         mock_sku.return_value = _make_sku(10, 0, 10)
         result = _check_licence_availability("ONPUL", self.token, self.record)
         self.assertIsNone(result)
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_cldul_all_available_returns_cloud(self, mock_sku):
         """Returns 'Cloud' when F3, Exchange Online and Security skus are available."""
         mock_sku.return_value = _make_sku(100, 0, 50)
         result = _check_licence_availability("CLDUL", self.token, self.record)
         self.assertEqual(result, "Cloud")
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_cldul_f3_no_data_returns_none(self, mock_sku):
         """Returns None when the F3 SKU query returns no data."""
         mock_sku.side_effect = [None]  # First call (F3) returns None
         result = _check_licence_availability("CLDUL", self.token, self.record)
         self.assertIsNone(result)
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_cldul_f3_exhausted_returns_none(self, mock_sku):
         """Returns None when all F3 licences are consumed."""
         mock_sku.side_effect = [_make_sku(5, 0, 5)]  # F3 exhausted
         result = _check_licence_availability("CLDUL", self.token, self.record)
         self.assertIsNone(result)
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_cldul_exchange_online_exhausted_returns_none(self, mock_sku):
         """Returns None when Exchange Online licences are exhausted."""
         mock_sku.side_effect = [_make_sku(100, 0, 50), _make_sku(5, 0, 5)]  # F3 ok, EO exhausted
         result = _check_licence_availability("CLDUL", self.token, self.record)
         self.assertIsNone(result)
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_cldul_security_addon_exhausted_returns_none(self, mock_sku):
         """Returns None when Security + Compliance Add-on licences are exhausted."""
         mock_sku.side_effect = [_make_sku(100, 0, 50), _make_sku(100, 0, 50), _make_sku(5, 0, 5)]
         result = _check_licence_availability("CLDUL", self.token, self.record)
         self.assertIsNone(result)
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_invalid_licence_code_returns_none(self, mock_sku):
         """Returns None for an unrecognised licence type code."""
         result = _check_licence_availability("FOOBAR", self.token, self.record)
         self.assertIsNone(result)
         mock_sku.assert_not_called()
 
-    @patch("organisation.ascender.ms_graph_get_subscribed_sku")
+    @patch("organisation.ascender.SUBSCRIBED_SKU_CACHE.get_sku")
     def test_onpul_available_with_warning_units(self, mock_sku):
         """Licence availability calculation includes 'warning' prepaid units."""
         # 8 enabled + 2 warning = 10 assignable; 9 consumed → 1 available
@@ -492,7 +521,7 @@ class WaitForUsageLocationTestCase(TestCase):
         self.email = "test.user@dbca.wa.gov.au"
 
     @patch("organisation.ascender.sleep")
-    @patch("organisation.ascender.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_returns_true_when_usage_location_set(self, mock_get, mock_sleep):
         """Returns True immediately when usageLocation is 'AU' on the first poll."""
         mock_resp = MagicMock()
@@ -503,7 +532,7 @@ class WaitForUsageLocationTestCase(TestCase):
         mock_sleep.assert_not_called()
 
     @patch("organisation.ascender.sleep")
-    @patch("organisation.ascender.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_returns_false_on_timeout_and_logs(self, mock_get, mock_sleep):
         """Returns False and creates an AscenderActionLog when usageLocation never appears."""
         mock_resp = MagicMock()
@@ -513,8 +542,29 @@ class WaitForUsageLocationTestCase(TestCase):
         self.assertFalse(result)
         self.assertTrue(AscenderActionLog.objects.filter(log__icontains="usageLocation field value not set").exists())
 
+    @patch("itassets.ms_graph.random.uniform", return_value=0)
     @patch("organisation.ascender.sleep")
-    @patch("organisation.ascender.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_minimum_total_wait_on_timeout(self, mock_get, mock_sleep, mock_uniform):
+        """Even with the least possible jitter, at least PROVISIONING_MIN_WAIT seconds are waited before giving up."""
+        mock_resp = MagicMock()
+        mock_resp.json.return_value = {"id": self.guid}
+        mock_get.return_value = mock_resp
+        _wait_for_usage_location(self.guid, self.headers, self.job, self.email)
+        total_wait = sum(c.args[0] for c in mock_sleep.call_args_list)
+        self.assertGreaterEqual(total_wait, PROVISIONING_MIN_WAIT)
+        self.assertGreaterEqual(PROVISIONING_MIN_WAIT, 511)
+
+    @patch("organisation.ascender.sleep")
+    @patch("itassets.ms_graph.MSGraphClient.get", side_effect=GraphCircuitOpenError("Circuit breaker open"))
+    def test_returns_false_when_circuit_open(self, mock_get, mock_sleep):
+        """An open circuit breaker is handled as a failed poll, rather than aborting provisioning."""
+        result = _wait_for_usage_location(self.guid, self.headers, self.job, self.email)
+        self.assertFalse(result)
+        self.assertTrue(AscenderActionLog.objects.filter(log__icontains="usageLocation field value not set").exists())
+
+    @patch("organisation.ascender.sleep")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_returns_false_on_timeout_sends_email(self, mock_get, mock_sleep):
         """Sends an admin alert email when the usageLocation poll times out."""
         mock_resp = MagicMock()
@@ -524,7 +574,7 @@ class WaitForUsageLocationTestCase(TestCase):
         self.assertGreater(len(mail.outbox), 0)
 
     @patch("organisation.ascender.sleep")
-    @patch("organisation.ascender.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_returns_true_after_initial_failures(self, mock_get, mock_sleep):
         """Returns True once the poll eventually sees usageLocation == 'AU'."""
         resp_no_location = MagicMock()
@@ -547,7 +597,7 @@ class AssignLicenceWithRetryTestCase(TestCase):
         self.payload = {"addLicenses": [], "removeLicenses": []}
 
     @patch("organisation.ascender.sleep")
-    @patch("organisation.ascender.requests.post")
+    @patch("itassets.ms_graph.MSGraphClient.post")
     def test_returns_true_on_success(self, mock_post, mock_sleep):
         """Returns True when the licence assignment POST succeeds on the first attempt."""
         mock_resp = MagicMock()
@@ -557,8 +607,8 @@ class AssignLicenceWithRetryTestCase(TestCase):
         self.assertTrue(result)
 
     @patch("organisation.ascender.sleep")
-    @patch("organisation.ascender.requests.delete")
-    @patch("organisation.ascender.requests.post")
+    @patch("itassets.ms_graph.MSGraphClient.delete")
+    @patch("itassets.ms_graph.MSGraphClient.post")
     def test_returns_false_on_timeout_and_logs(self, mock_post, mock_delete, mock_sleep):
         """Returns False and creates a log entry when licence assignment exhausts retries."""
         import requests as req
@@ -572,8 +622,8 @@ class AssignLicenceWithRetryTestCase(TestCase):
         self.assertTrue(AscenderActionLog.objects.filter(log__icontains="assign license step").exists())
 
     @patch("organisation.ascender.sleep")
-    @patch("organisation.ascender.requests.delete")
-    @patch("organisation.ascender.requests.post")
+    @patch("itassets.ms_graph.MSGraphClient.delete")
+    @patch("itassets.ms_graph.MSGraphClient.post")
     def test_deletes_orphan_on_failure(self, mock_post, mock_delete, mock_sleep):
         """Attempts to delete the orphaned Entra ID account when licence assignment fails."""
         import requests as req
@@ -589,8 +639,8 @@ class AssignLicenceWithRetryTestCase(TestCase):
         self.assertIn(self.guid, url_called)
 
     @patch("organisation.ascender.sleep")
-    @patch("organisation.ascender.requests.delete")
-    @patch("organisation.ascender.requests.post")
+    @patch("itassets.ms_graph.MSGraphClient.delete")
+    @patch("itassets.ms_graph.MSGraphClient.post")
     def test_logs_cleanup_failure(self, mock_post, mock_delete, mock_sleep):
         """Logs a WARNING when the orphan deletion itself fails."""
         import requests as req
@@ -605,8 +655,8 @@ class AssignLicenceWithRetryTestCase(TestCase):
         self.assertTrue(AscenderActionLog.objects.filter(log__icontains="manual deletion required").exists())
 
     @patch("organisation.ascender.sleep")
-    @patch("organisation.ascender.requests.delete")
-    @patch("organisation.ascender.requests.post")
+    @patch("itassets.ms_graph.MSGraphClient.delete")
+    @patch("itassets.ms_graph.MSGraphClient.post")
     def test_returns_false_and_sends_email_on_failure(self, mock_post, mock_delete, mock_sleep):
         """Sends an admin alert email when licence assignment exhausts retries."""
         import requests as req
@@ -700,6 +750,20 @@ class CreateEntraIdUserTestCase(TestCase):
         result = create_entra_id_user(self.job, self.cc, self.next_week, self.manager, self.location, token=self.token)
         self.assertIsNone(result)
 
+    @patch("organisation.ascender.sleep")
+    @patch("itassets.ms_graph.MSGraphClient.patch", side_effect=GraphCircuitOpenError("Circuit breaker open"))
+    @patch("itassets.ms_graph.MSGraphClient.post")
+    @patch("organisation.ascender.ms_graph_validate_password", return_value=True)
+    @patch("organisation.ascender._check_licence_availability", return_value="On-premise")
+    @override_settings(ASCENDER_CREATE_AZURE_AD=True, DEBUG=False)
+    def test_circuit_open_at_update_step_returns_none_with_log(self, mock_licence, mock_pwd, mock_post, mock_patch, mock_sleep):
+        """An open circuit breaker after the account is created is handled by the step's failure path."""
+        mock_post.return_value.json.return_value = {"id": str(uuid4())}
+        result = create_entra_id_user(self.job, self.cc, self.next_week, self.manager, self.location, token=self.token)
+        self.assertIsNone(result)
+        self.assertTrue(AscenderActionLog.objects.filter(log__icontains="failed at account update step").exists())
+        self.assertGreater(len(mail.outbox), 0)
+
     @patch("organisation.ascender._check_licence_availability", return_value="On-premise")
     def test_email_generation_failure_returns_none_with_log(self, mock_licence):
         """Returns None and logs when a unique email address cannot be generated."""
@@ -707,3 +771,376 @@ class CreateEntraIdUserTestCase(TestCase):
             result = create_entra_id_user(self.job, self.cc, self.next_week, self.manager, self.location, token=self.token)
         self.assertIsNone(result)
         self.assertTrue(AscenderActionLog.objects.filter(log__icontains="unable to generate unique email").exists())
+
+
+def make_ascender_row(employee_no="123456", job_end_date=None):
+    """Return a tuple of column values in the order that the Ascender view is queried."""
+    row = []
+    for field in FOREIGN_TABLE_FIELDS:
+        column = field[0] if isinstance(field, (list, tuple)) else field
+        if column == "employee_no":
+            row.append(employee_no)
+        elif column == "job_end_date":
+            row.append(job_end_date)
+        elif column.endswith("_date"):
+            row.append(None)
+        else:
+            row.append(f"{column} value")
+    return tuple(row)
+
+
+@override_settings(FOREIGN_TABLE="ascender_view")
+class AscenderDbFetchTestCase(TestCase):
+    """Tests for the ascender_db_fetch function."""
+
+    def setUp(self):
+        self.cursor = MagicMock()
+        self.conn = MagicMock()
+        self.conn.__enter__.return_value = self.conn
+        self.conn.cursor.return_value = self.cursor
+        self.pool = MagicMock()
+        self.pool.connection.return_value = self.conn
+
+    @patch("organisation.ascender.get_ascender_db_pool")
+    def test_stream_uses_named_cursor(self, mock_pool):
+        """Streaming mode uses a named server-side cursor and fetches rows in batches."""
+        mock_pool.return_value = self.pool
+        self.cursor.fetchmany.side_effect = [[make_ascender_row("1"), make_ascender_row("2")], [make_ascender_row("3")], []]
+        records = list(ascender_db_fetch(stream=True, batch_size=2))
+        self.conn.cursor.assert_called_once_with(name="ascender_db_fetch")
+        self.assertEqual(self.cursor.itersize, 2)
+        self.cursor.fetchmany.assert_called_with(2)
+        self.assertEqual([r["employee_id"] for r in records], ["1", "2", "3"])
+
+    @patch("organisation.ascender.get_ascender_db_pool")
+    def test_stream_yields_same_records(self, mock_pool):
+        """Streaming and non-streaming modes yield identical records."""
+        mock_pool.return_value = self.pool
+        rows = [make_ascender_row("1", date(2030, 1, 1)), make_ascender_row("2")]
+        self.cursor.fetchmany.side_effect = [rows, []]
+        streamed = list(ascender_db_fetch(stream=True))
+        self.cursor.fetchmany.side_effect = [rows, []]
+        fetched = list(ascender_db_fetch())
+        self.assertEqual(streamed, fetched)
+        self.assertEqual(streamed[0]["job_end_date"], "2030-01-01")
+
+    @patch("organisation.ascender.get_ascender_db_pool")
+    def test_top_job_only_ranks_in_query(self, mock_pool):
+        """Ranked mode uses a window function to rank jobs, and can filter to the top-ranked job."""
+        mock_pool.return_value = self.pool
+        self.cursor.fetchmany.side_effect = [[make_ascender_row("1")], []]
+        records = list(ascender_db_fetch(top_job_only=True))
+        self.assertEqual(len(records), 1)
+        query, params = self.cursor.execute.call_args[0]
+        query = query.as_string()
+        self.assertIn("ROW_NUMBER() OVER (PARTITION BY", query)
+        self.assertIn("WHERE job_rank = 1", query)
+        self.assertEqual(params["date_max"], DATE_MAX)
+        self.assertEqual(params["today"], date.today())
+
+    @patch("organisation.ascender.get_ascender_db_pool")
+    def test_ranked_returns_all_jobs(self, mock_pool):
+        """Ranked mode without top_job_only does not filter on job rank."""
+        mock_pool.return_value = self.pool
+        self.cursor.fetchmany.side_effect = [[], []]
+        list(ascender_db_fetch(ranked=True))
+        query = self.cursor.execute.call_args[0][0].as_string()
+        self.assertIn('ORDER BY "employee_no", job_rank', query)
+        self.assertNotIn("WHERE job_rank = 1", query)
+
+    @override_settings(FOREIGN_TABLE_CHANGE_COLUMN="last_updated")
+    @patch("organisation.ascender.get_ascender_db_pool")
+    def test_changed_since_filters_employees(self, mock_pool):
+        """Passing changed_since filters on employees having any job row changed since that time."""
+        mock_pool.return_value = self.pool
+        self.cursor.fetchmany.side_effect = [[], []]
+        changed_since = timezone.now()
+        list(ascender_db_fetch(changed_since=changed_since))
+        query = self.cursor.execute.call_args[0][0].as_string()
+        params = self.cursor.execute.call_args[0][1]
+        self.assertIn('WHERE "employee_no" IN (SELECT "employee_no"', query)
+        self.assertIn('"last_updated" >= %(changed_since)s', query)
+        self.assertEqual(params["changed_since"], changed_since)
+
+    def test_changed_since_requires_change_column(self):
+        """Passing changed_since without a change column configured raises ValueError."""
+        with self.assertRaises(ValueError):
+            list(ascender_db_fetch(changed_since=timezone.now()))
+
+    def test_invalid_employee_id(self):
+        """An employee ID that is not castable to an integer raises ValueError."""
+        with self.assertRaises(ValueError):
+            list(ascender_db_fetch("abc"))
+
+    @patch("organisation.ascender.ASCENDER_DB_POOL", None)
+    @patch("organisation.ascender.atexit")
+    @patch("organisation.ascender.ConnectionPool")
+    def test_pool_created_once(self, mock_pool_class, mock_atexit):
+        """The connection pool is created on first use and reused thereafter."""
+        pool = get_ascender_db_pool()
+        self.assertIs(get_ascender_db_pool(), pool)
+        mock_pool_class.assert_called_once()
+        self.assertEqual(mock_pool_class.call_args.kwargs["check"], mock_pool_class.check_connection)
+        mock_atexit.register.assert_called_once_with(pool.close)
+
+    @patch("organisation.ascender.get_ascender_db_pool")
+    def test_cc_manager_fetch_uses_pool(self, mock_pool):
+        """Cost centre manager records are fetched using a pooled connection."""
+        mock_pool.return_value = self.pool
+        self.cursor.__enter__.return_value = self.cursor
+        self.cursor.fetchall.return_value = [("1", "2")]
+        self.assertEqual(ascender_cc_manager_fetch(), [("1", "2")])
+        self.pool.connection.assert_called_once()
+
+
+class RowToPythonTestCase(TestCase):
+    """Tests for the compiled Ascender row transformer."""
+
+    def test_compile_row_transformer(self):
+        """Field definitions compile into record keys plus transforms for callable columns only."""
+        upper = str.upper
+        keys, transforms = compile_row_transformer((("a", "renamed"), "b", ("c", upper)))
+        self.assertEqual(keys, ("renamed", "b", "c"))
+        self.assertEqual(transforms, (("c", 2, upper),))
+
+    def test_row_to_python(self):
+        """Rows are converted to a dict having renamed keys and transformed values."""
+        record = row_to_python(make_ascender_row("123456", date(2030, 6, 30)))
+        self.assertEqual(len(record), len(FOREIGN_TABLE_FIELDS))
+        self.assertEqual(record["employee_id"], "123456")
+        self.assertNotIn("employee_no", record)
+        self.assertEqual(record["job_end_date"], "2030-06-30")
+        self.assertIsNone(record["job_start_date"])
+        self.assertEqual(record["surname"], "surname value")
+
+    def test_row_to_python_date_max(self):
+        """The Ascender 'null' date value DATE_MAX is converted to None."""
+        record = row_to_python(make_ascender_row("123456", DATE_MAX))
+        self.assertIsNone(record["job_end_date"])
+
+
+class AscenderJobSortTestCase(TestCase):
+    """Tests for sorting and grouping of Ascender job records."""
+
+    def setUp(self):
+        today = date.today()
+        self.ended = {"employee_id": "1", "position_no": "ended", "job_end_date": (today - timedelta(days=30)).strftime("%Y-%m-%d")}
+        self.open_ended = {"employee_id": "1", "position_no": "open", "job_end_date": None}
+        self.future = {"employee_id": "1", "position_no": "future", "job_end_date": (today + timedelta(days=30)).strftime("%Y-%m-%d")}
+
+    def test_ascender_job_sort_key(self):
+        """Future end dates rank above no end date, which ranks above ended jobs."""
+        self.assertGreater(ascender_job_sort_key(self.future), ascender_job_sort_key(self.open_ended))
+        self.assertGreater(ascender_job_sort_key(self.open_ended), ascender_job_sort_key(self.ended))
+
+    def test_ascender_job_sort_key_today(self):
+        """Passing in today's date gives the same result as calculating it."""
+        today = date.today().strftime("%Y-%m-%d")
+        for job in (self.ended, self.open_ended, self.future):
+            self.assertEqual(ascender_job_sort_key(job, today), ascender_job_sort_key(job))
+
+    @patch("organisation.ascender.ascender_db_fetch")
+    def test_ascender_employees_fetch_all(self, mock_fetch):
+        """Jobs are grouped by employee, and each employee's jobs are sorted."""
+        other = {"employee_id": "2", "position_no": "other", "job_end_date": None}
+        mock_fetch.return_value = iter([self.ended, other, self.open_ended, self.future])
+        records = ascender_employees_fetch_all()
+        self.assertEqual(set(records.keys()), {"1", "2"})
+        self.assertEqual([j["position_no"] for j in records["1"]], ["future", "open", "ended"])
+        self.assertEqual(records["2"], [other])
+
+    @patch("organisation.ascender.ascender_db_fetch")
+    def test_ascender_employees_fetch_all_ranked(self, mock_fetch):
+        """Jobs ranked by the database query are not re-sorted."""
+        mock_fetch.return_value = iter([self.ended, self.future])
+        records = ascender_employees_fetch_all(top_job_only=True)
+        mock_fetch.assert_called_once_with(stream=True, ranked=True, top_job_only=True, changed_since=None)
+        self.assertEqual([j["position_no"] for j in records["1"]], ["ended", "future"])
+
+
+class AscenderBulkWriterTestCase(TestCase):
+    """Tests for buffered bulk writes of Ascender updates."""
+
+    def setUp(self):
+        self.user = mixer.blend(DepartmentUser, email=random_dbca_email, employee_id=mixer.RANDOM, surname="Smythe")
+
+    def test_only_changed_fields_written(self):
+        """Only fields changed since the user was tracked are written."""
+        writer = AscenderBulkWriter()
+        writer.track(self.user)
+        self.user.surname = "Smith"
+        writer.add_user(self.user)
+        self.assertEqual(writer.update_fields, {"surname", "date_updated"})
+        writer.flush()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.surname, "Smith")
+        self.assertEqual(writer.users_updated, 1)
+
+    def test_unchanged_user_not_buffered(self):
+        """A tracked user having no changes is not written."""
+        writer = AscenderBulkWriter()
+        writer.track(self.user)
+        writer.add_user(self.user)
+        self.assertFalse(writer.users)
+
+    def test_flush_when_batch_full(self):
+        """Buffered records are written once the batch size is reached."""
+        writer = AscenderBulkWriter(batch_size=2)
+        writer.add_action_log(level="INFO", log="Test log 1", ascender_data={})
+        self.assertFalse(AscenderActionLog.objects.exists())
+        writer.add_user_log(self.user, {"description": "Test"})
+        self.assertEqual(AscenderActionLog.objects.count(), 1)
+        self.assertEqual(self.user.departmentuserlog_set.count(), 1)
+        self.assertFalse(writer.action_logs)
+
+    def test_update_from_ascender_data_buffers_changes(self):
+        """Updates from Ascender data are buffered on the writer, not saved immediately."""
+        writer = AscenderBulkWriter()
+        writer.track(self.user)
+        self.user.ascender_data = {"surname": "SMITH"}
+        self.user.update_from_ascender_data(writer=writer)
+        self.assertEqual(DepartmentUser.objects.get(pk=self.user.pk).surname, "Smythe")
+        self.assertEqual(len(writer.action_logs), 1)
+        writer.flush()
+        self.assertEqual(DepartmentUser.objects.get(pk=self.user.pk).surname, "Smith")
+        self.assertEqual(AscenderActionLog.objects.count(), 1)
+
+
+@patch("organisation.ascender.ms_graph_client_token")
+@patch("organisation.ascender.ascender_employees_fetch_all")
+class AscenderChangeDetectionTestCase(TestCase):
+    """Tests for skipping users whose Ascender job data is unchanged."""
+
+    def setUp(self):
+        self.user = mixer.blend(DepartmentUser, email=random_dbca_email, employee_id="123456")
+        self.job = row_to_python(make_ascender_row(self.user.employee_id))
+
+    def test_job_hash_stable(self, mock_fetch, mock_token):
+        """The job hash does not depend upon key order."""
+        reordered = dict(reversed(list(self.job.items())))
+        self.assertEqual(ascender_job_hash(self.job), ascender_job_hash(reordered))
+        self.assertNotEqual(ascender_job_hash(self.job), ascender_job_hash({**self.job, "surname": "OTHER"}))
+
+    def test_unchanged_job_skipped(self, mock_fetch, mock_token):
+        """A user whose job data is unchanged is skipped, unless forced."""
+        mock_fetch.return_value = {self.user.employee_id: [self.job]}
+        ascender_user_import_all()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.ascender_data_hash, ascender_job_hash(self.job, AscenderLookups().get_related_ids(self.job)))
+        updated = self.user.ascender_data_updated
+
+        ascender_user_import_all()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.ascender_data_updated, updated)
+
+        ascender_user_import_all(force=True)
+        self.user.refresh_from_db()
+        self.assertNotEqual(self.user.ascender_data_updated, updated)
+
+    def test_job_hash_includes_related_ids(self, mock_fetch, mock_token):
+        """The job hash changes when a related object is resolved from the job record."""
+        self.assertNotEqual(ascender_job_hash(self.job), ascender_job_hash(self.job, {"manager": None}))
+        self.assertNotEqual(ascender_job_hash(self.job, {"manager": None}), ascender_job_hash(self.job, {"manager": 1}))
+
+    def test_user_updated_when_manager_created(self, mock_fetch, mock_token):
+        """A user whose job data is unchanged is updated once their manager exists."""
+        mock_fetch.return_value = {self.user.employee_id: [self.job]}
+        ascender_user_import_all()
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.manager)
+
+        manager = mixer.blend(DepartmentUser, email=random_dbca_email, employee_id=self.job["manager_emp_no"])
+        ascender_user_import_all()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.manager, manager)
+
+
+@patch("organisation.ascender.ms_graph_client_token")
+@patch("organisation.ascender.ascender_employees_fetch_all")
+class AscenderIncrementalImportTestCase(TestCase):
+    """Tests for watermark-driven incremental Ascender imports."""
+
+    def test_first_run_is_full_sync(self, mock_fetch, mock_token):
+        """The first incremental run performs a full sync and records the checkpoint."""
+        mock_fetch.return_value = {}
+        with override_settings(FOREIGN_TABLE_CHANGE_COLUMN="last_updated"):
+            ascender_user_import_all(incremental=True)
+        self.assertIsNone(mock_fetch.call_args.kwargs["changed_since"])
+        checkpoint = SyncCheckpoint.objects.get(name=ASCENDER_SYNC_CHECKPOINT)
+        self.assertIsNotNone(checkpoint.watermark)
+        self.assertEqual(checkpoint.watermark, checkpoint.last_full_sync)
+
+    @override_settings(FOREIGN_TABLE_CHANGE_COLUMN="last_updated", ASCENDER_FULL_SYNC_INTERVAL_HOURS=24)
+    def test_incremental_run_uses_watermark(self, mock_fetch, mock_token):
+        """A subsequent incremental run queries rows changed since the watermark."""
+        mock_fetch.return_value = {}
+        watermark = timezone.now() - timedelta(hours=1)
+        SyncCheckpoint.objects.create(name=ASCENDER_SYNC_CHECKPOINT, watermark=watermark, last_full_sync=watermark)
+        ascender_user_import_all(incremental=True)
+        self.assertEqual(mock_fetch.call_args.kwargs["changed_since"], watermark - ASCENDER_SYNC_OVERLAP)
+        checkpoint = SyncCheckpoint.objects.get(name=ASCENDER_SYNC_CHECKPOINT)
+        self.assertGreater(checkpoint.watermark, watermark)
+        self.assertEqual(checkpoint.last_full_sync, watermark)
+
+    @override_settings(FOREIGN_TABLE_CHANGE_COLUMN="last_updated", ASCENDER_FULL_SYNC_INTERVAL_HOURS=24)
+    def test_full_sync_when_due(self, mock_fetch, mock_token):
+        """An incremental run falls back to a full sync once the full sync interval has passed."""
+        mock_fetch.return_value = {}
+        last_full_sync = timezone.now() - timedelta(hours=25)
+        SyncCheckpoint.objects.create(name=ASCENDER_SYNC_CHECKPOINT, watermark=timezone.now(), last_full_sync=last_full_sync)
+        ascender_user_import_all(incremental=True)
+        self.assertIsNone(mock_fetch.call_args.kwargs["changed_since"])
+        self.assertGreater(SyncCheckpoint.objects.get(name=ASCENDER_SYNC_CHECKPOINT).last_full_sync, last_full_sync)
+
+    def test_no_change_column_is_full_sync(self, mock_fetch, mock_token):
+        """Without a change column configured, an incremental run performs a full sync."""
+        mock_fetch.return_value = {}
+        SyncCheckpoint.objects.create(name=ASCENDER_SYNC_CHECKPOINT, watermark=timezone.now(), last_full_sync=timezone.now())
+        ascender_user_import_all(incremental=True)
+        self.assertIsNone(mock_fetch.call_args.kwargs["changed_since"])
+
+
+class AscenderSnapshotTestCase(TestCase):
+    """Tests for the local snapshot of the Ascender extract."""
+
+    def setUp(self):
+        self.jobs = {
+            "1": [row_to_python(make_ascender_row("1"))],
+            "2": [row_to_python(make_ascender_row("2", date(2030, 1, 1))), row_to_python(make_ascender_row("2"))],
+        }
+        ascender_snapshot_refresh(self.jobs)
+
+    def test_refresh_diff(self):
+        """Refreshing the snapshot reports added, removed and changed employees."""
+        self.assertEqual(AscenderJobSnapshot.objects.count(), 3)
+        records = {
+            "2": [self.jobs["2"][0], {**self.jobs["2"][1], "surname": "OTHER"}],
+            "3": [row_to_python(make_ascender_row("3"))],
+        }
+        diff = ascender_snapshot_refresh(records)
+        self.assertEqual(diff, {"added": ["3"], "removed": ["1"], "changed": ["2"]})
+        self.assertEqual(SyncCheckpoint.objects.get(name=ASCENDER_SNAPSHOT_CHECKPOINT).data, diff)
+        self.assertEqual(ascender_snapshot_employee_fetch("2")[1]["surname"], "OTHER")
+        self.assertFalse(AscenderJobSnapshot.objects.filter(employee_id="1").exists())
+
+    def test_partial_refresh_keeps_absent_employees(self):
+        """A partial refresh does not remove employees absent from the passed-in records."""
+        diff = ascender_snapshot_refresh({"3": [row_to_python(make_ascender_row("3"))]}, partial=True)
+        self.assertEqual(diff["removed"], [])
+        self.assertTrue(AscenderJobSnapshot.objects.filter(employee_id="1").exists())
+
+    def test_unchanged_refresh_writes_nothing(self):
+        """Refreshing with unchanged records reports no differences."""
+        diff = ascender_snapshot_refresh(self.jobs)
+        self.assertEqual(diff, {"added": [], "removed": [], "changed": []})
+
+    @patch("organisation.ascender.ascender_db_fetch")
+    def test_employee_fetch_from_snapshot(self, mock_fetch):
+        """Employee jobs can be served from the snapshot in sorted order, falling back to the Ascender database."""
+        employee_id, jobs = ascender_employee_fetch("2", from_snapshot=True)
+        self.assertEqual(jobs, self.jobs["2"])
+        mock_fetch.assert_not_called()
+        mock_fetch.return_value = iter([row_to_python(make_ascender_row("4"))])
+        employee_id, jobs = ascender_employee_fetch("4", from_snapshot=True)
+        mock_fetch.assert_called_once_with("4")
+        self.assertEqual(len(jobs), 1)
@@ -0,0 +1,34 @@
+from django.test import TestCase
+from mixer.backend.django import mixer
+
+from itassets.test_api import random_dbca_email
+from organisation.bulk import DepartmentUserBulkWriter
+from organisation.models import DepartmentUser
+
+
+class DepartmentUserBulkWriterTestCase(TestCase):
+    """Tests for buffered bulk writes of DepartmentUser updates."""
+
+    def setUp(self):
+        self.user = mixer.blend(DepartmentUser, email=random_dbca_email, azure_guid="1234", azure_ad_data={}, active=True)
+
+    def test_update_from_entra_id_data_buffers_changes(self):
+        """Updates from Entra ID data are buffered on the writer, not saved immediately."""
+        writer = DepartmentUserBulkWriter()
+        writer.track(self.user)
+        self.user.azure_ad_data = {"accountEnabled": False}
+        self.user.update_from_entra_id_data(writer=writer)
+        self.assertTrue(DepartmentUser.objects.get(pk=self.user.pk).active)
+        self.assertIn("active", writer.update_fields)
+        writer.flush()
+        self.assertFalse(DepartmentUser.objects.get(pk=self.user.pk).active)
+        self.assertEqual(writer.users_updated, 1)
+
+    def test_autoflush_disabled(self):
+        """Buffered records are only written by an explicit flush when autoflush is disabled."""
+        writer = DepartmentUserBulkWriter(batch_size=1, autoflush=False)
+        writer.add_user_log(self.user, {"description": "Test"})
+        self.assertEqual(self.user.departmentuserlog_set.count(), 0)
+        writer.flush()
+        self.assertEqual(self.user.departmentuserlog_set.count(), 1)
+        self.assertFalse(writer.user_logs)
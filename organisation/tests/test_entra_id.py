@@ -0,0 +1,108 @@
+from unittest.mock import patch
+from uuid import uuid4
+
+from django.db import DatabaseError
+from django.test import TestCase
+from mixer.backend.django import mixer
+
+from itassets.test_api import random_dbca_email
+from organisation.entra_id import EntraIdReconciler
+from organisation.microsoft_products import MS_PRODUCTS
+from organisation.models import CostCentre, DepartmentUser
+
+
+def entra_user(**kwargs):
+    """Return a minimal transformed Entra ID user account dict, with optional overrides."""
+    az = {
+        "objectId": str(uuid4()),
+        "userPrincipalName": random_dbca_email(),
+        "mail": None,
+        "accountEnabled": True,
+        "displayName": "Test User",
+        "givenName": "Test",
+        "surname": "User",
+        "jobTitle": "Tester",
+        "telephoneNumber": None,
+        "mobilePhone": None,
+        "employeeId": None,
+        "companyName": None,
+        "officeLocation": None,
+        "onPremisesSyncEnabled": None,
+        "proxyAddresses": [],
+        "assignedLicenses": [],
+    }
+    az.update(kwargs)
+    return az
+
+
+class EntraIdReconcilerTestCase(TestCase):
+    def setUp(self):
+        self.linked_user = mixer.blend(DepartmentUser, email=random_dbca_email, azure_guid=str(uuid4()), employee_id="000001", active=True)
+        self.unlinked_user = mixer.blend(DepartmentUser, email=random_dbca_email, azure_guid=None, employee_id="000002")
+        self.cost_centre = mixer.blend(CostCentre, code="101")
+
+    def test_classify_update(self):
+        reconciler = EntraIdReconciler()
+        az = entra_user(objectId=self.linked_user.azure_guid)
+        self.assertEqual(reconciler.classify(az), (reconciler.UPDATE, self.linked_user))
+
+    def test_classify_unchanged(self):
+        az = entra_user(objectId=self.linked_user.azure_guid)
+        self.linked_user.azure_ad_data = dict(az, proxyAddresses=None)
+        self.linked_user.save()
+        reconciler = EntraIdReconciler()
+        self.assertEqual(reconciler.classify(az), (reconciler.UNCHANGED, self.linked_user))
+        self.assertEqual(reconciler.classify(dict(az, jobTitle="Manager")), (reconciler.UPDATE, self.linked_user))
+        # Unchanged users are still updated if forced.
+        reconciler = EntraIdReconciler(force=True)
+        self.assertEqual(reconciler.classify(az), (reconciler.UPDATE, self.linked_user))
+
+    def test_classify_link_ignores_email_case(self):
+        reconciler = EntraIdReconciler()
+        az = entra_user(userPrincipalName=self.unlinked_user.email.upper())
+        self.assertEqual(reconciler.classify(az), (reconciler.LINK, self.unlinked_user))
+
+    def test_classify_conflict_email(self):
+        reconciler = EntraIdReconciler()
+        az = entra_user(userPrincipalName=self.linked_user.email)
+        self.assertEqual(reconciler.classify(az), (reconciler.CONFLICT_EMAIL, self.linked_user))
+
+    def test_classify_conflict_employee_id(self):
+        reconciler = EntraIdReconciler()
+        az = entra_user(employeeId=self.unlinked_user.employee_id)
+        self.assertEqual(reconciler.classify(az), (reconciler.CONFLICT_EMPLOYEE_ID, self.unlinked_user))
+
+    def test_classify_create_requires_licence(self):
+        reconciler = EntraIdReconciler()
+        self.assertEqual(reconciler.classify(entra_user()), (reconciler.SKIP, None))
+        az = entra_user(assignedLicenses=[MS_PRODUCTS["MICROSOFT 365 F3"]])
+        self.assertEqual(reconciler.classify(az), (reconciler.CREATE, None))
+
+    def test_reconcile_makes_no_queries(self):
+        """Matching and applying Entra ID accounts is done in memory."""
+        reconciler = EntraIdReconciler(member_groups={self.linked_user.azure_guid: ["Group 1"]})
+        new_az = entra_user(assignedLicenses=[MS_PRODUCTS["MICROSOFT 365 E5"]], companyName="101")
+        with self.assertNumQueries(0):
+            reconciler.reconcile(entra_user(objectId=self.linked_user.azure_guid, accountEnabled=False))
+            reconciler.reconcile(entra_user(userPrincipalName=self.unlinked_user.email))
+            reconciler.reconcile(new_az)
+            # The new user is indexed, so a repeated account is an update rather than a second create.
+            self.assertEqual(reconciler.classify(new_az)[0], reconciler.UPDATE)
+
+        self.assertEqual(reconciler.flush(), [])
+        self.linked_user.refresh_from_db()
+        self.assertFalse(self.linked_user.active)
+        self.assertEqual(self.linked_user.assigned_groups, ["Group 1"])
+        self.unlinked_user.refresh_from_db()
+        self.assertIsNotNone(self.unlinked_user.azure_guid)
+        new_user = DepartmentUser.objects.get(azure_guid=new_az["objectId"])
+        self.assertEqual(new_user.cost_centre, self.cost_centre)
+        self.assertIn("MICROSOFT 365 E5", new_user.assigned_licences)
+
+    @patch("organisation.entra_id.DepartmentUser.objects.bulk_create", side_effect=DatabaseError)
+    def test_flush_falls_back_to_individual_saves(self, mock_bulk_create):
+        reconciler = EntraIdReconciler()
+        az = entra_user(assignedLicenses=[MS_PRODUCTS["MICROSOFT 365 E5"]])
+        reconciler.reconcile(az)
+        self.assertEqual(reconciler.flush(), [])
+        self.assertTrue(DepartmentUser.objects.filter(azure_guid=az["objectId"]).exists())
@@ -0,0 +1,33 @@
+from django.test import TestCase
+
+from organisation.microsoft_products import (
+    MS_PRODUCT_NAMES,
+    MS_PRODUCTS,
+    get_licence_tier,
+    get_product_name,
+    get_product_names,
+    get_sku_id,
+)
+
+
+class MicrosoftProductsTestCase(TestCase):
+    def test_reverse_map(self):
+        self.assertEqual(len(MS_PRODUCT_NAMES), len(MS_PRODUCTS))
+        for name, guid in MS_PRODUCTS.items():
+            self.assertEqual(MS_PRODUCT_NAMES[guid], name)
+
+    def test_get_sku_id(self):
+        self.assertEqual(get_sku_id("MICROSOFT 365 E5"), MS_PRODUCTS["MICROSOFT 365 E5"])
+        self.assertIsNone(get_sku_id("UNKNOWN PRODUCT"))
+
+    def test_get_product_name(self):
+        self.assertEqual(get_product_name(MS_PRODUCTS["MICROSOFT 365 F3"]), "MICROSOFT 365 F3")
+        unknown_guid = "aaaaaaaa-0000-0000-0000-000000000000"
+        self.assertEqual(get_product_name(unknown_guid), unknown_guid)
+        self.assertEqual(get_product_names([MS_PRODUCTS["INTUNE"], unknown_guid]), ["INTUNE", unknown_guid])
+
+    def test_get_licence_tier(self):
+        self.assertEqual(get_licence_tier(["MICROSOFT 365 F3", "MICROSOFT 365 E5"]), "On-premise")
+        self.assertEqual(get_licence_tier(["INTUNE", "MICROSOFT 365 F3"]), "Cloud")
+        self.assertIsNone(get_licence_tier(["INTUNE"]))
+        self.assertIsNone(get_licence_tier([]))
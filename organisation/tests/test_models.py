@@ -10,6 +10,7 @@ from django.utils import timezone
 from mixer.backend.django import mixer
 
 from itassets.test_api import random_dbca_email
+from organisation.ascender import AscenderLookups
 from organisation.microsoft_products import MS_PRODUCTS
 from organisation.models import AscenderActionLog, CostCentre, DepartmentUser, DepartmentUserLog, Location
 
@@ -106,6 +107,17 @@ class DepartmentUserTestCase(TestCase):
         self.user.save()
         self.assertFalse(self.user.employee_id)
 
+    def test_clear_guids(self):
+        azure_guid = self.user.azure_guid
+        other_user = mixer.blend(DepartmentUser, email=random_dbca_email, azure_guid=uuid1)
+        with self.assertNumQueries(2):
+            cleared = DepartmentUser.clear_guids("azure_guid", {azure_guid, "unknown-guid"})
+        self.assertEqual(cleared, [(self.user.email, azure_guid)])
+        self.user.refresh_from_db()
+        other_user.refresh_from_db()
+        self.assertIsNone(self.user.azure_guid)
+        self.assertTrue(other_user.azure_guid)
+
     def test_get_licence(self):
         self.assertFalse(self.user.get_licence())
         self.user.assigned_licences = ["MICROSOFT 365 E5", "foo"]
@@ -565,6 +577,18 @@ class UpdateFromAscenderDataTestCase(TestCase):
         user.refresh_from_db()
         self.assertEqual(user.cost_centre, cc)
 
+    def test_lookups_avoid_related_queries(self):
+        """Preloaded lookups resolve the cost centre, manager and location without querying the database."""
+        cc = mixer.blend(CostCentre, code="CC02", ascender_code="CC02")
+        loc = mixer.blend(Location, ascender_desc="17 Dick Perry Ave, KENSINGTON")
+        manager = mixer.blend(DepartmentUser, email=random_dbca_email, employee_id="MGR002")
+        user = self._make_user({"paypoint": "CC02", "manager_emp_no": "MGR002", "geo_location_desc": "17 Dick Perry Ave, KENSINGTON"})
+        user.cost_centre, user.manager, user.location = cc, manager, loc
+        user.save()
+        lookups = AscenderLookups()
+        with self.assertNumQueries(1):  # The UPDATE query from save().
+            user.update_from_ascender_data(lookups)
+
 
 # ---------------------------------------------------------------------------
 # DepartmentUser.get_graph_user() with mocked Graph API
@@ -3,19 +3,25 @@ import re
 from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock, patch
 
-from django.test import TestCase
+import requests
+from django.test import TestCase, override_settings
 
 from organisation.utils import (
+    SubscribedSkuCache,
     compare_values,
     generate_password,
     ms_graph_get_subscribed_sku,
     ms_graph_get_user,
+    ms_graph_list_member_groups_batch,
     ms_graph_list_signins_user,
     ms_graph_list_subscribed_skus,
     ms_graph_list_users,
+    ms_graph_list_users_delta,
+    ms_graph_users_delta_link,
     ms_graph_validate_password,
     parse_ad_pwd_last_set,
     parse_windows_ts,
+    payload_changes,
     title_except,
 )
 
@@ -106,6 +112,22 @@ class CompareValuesTestCase(TestCase):
         self.assertFalse(compare_values(None, "value"))
 
 
+class PayloadChangesTestCase(TestCase):
+    def test_no_change(self):
+        cached = {"mail": "user@dbca.wa.gov.au", "proxyAddresses": ["a", "b"], "mobilePhone": None}
+        payload = {"mail": "user@dbca.wa.gov.au ", "proxyAddresses": ["b", "a"], "mobilePhone": ""}
+        self.assertEqual(payload_changes(cached, payload), set())
+
+    def test_changed_keys(self):
+        cached = {"accountEnabled": True, "jobTitle": "Tester", "manager": {"id": "1", "mail": "a@dbca.wa.gov.au"}}
+        payload = {"accountEnabled": False, "jobTitle": "Tester", "manager": {"id": "2", "mail": "b@dbca.wa.gov.au"}}
+        self.assertEqual(payload_changes(cached, payload), {"accountEnabled", "manager"})
+
+    def test_added_and_removed_keys(self):
+        self.assertEqual(payload_changes({"surname": "User"}, {"givenName": "Test"}), {"surname", "givenName"})
+        self.assertEqual(payload_changes(None, {"givenName": "Test"}), {"givenName"})
+
+
 class ParseWindowsTsTestCase(TestCase):
     def test_valid_timestamp(self):
         # A known Windows timestamp string (milliseconds since epoch, embedded in a string).
@@ -144,7 +166,7 @@ class ParseAdPwdLastSetTestCase(TestCase):
 
 
 class MsGraphListSubscribedSkusTestCase(TestCase):
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_single_page(self, mock_get):
         skus = [{"skuId": "sku-001", "skuPartNumber": "M365_E5"}]
         mock_get.return_value = mock_response({"value": skus})
@@ -154,7 +176,7 @@ class MsGraphListSubscribedSkusTestCase(TestCase):
         self.assertEqual(result, skus)
         mock_get.assert_called_once()
 
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_paginated_results(self, mock_get):
         page1 = {"value": [{"skuId": "sku-001"}], "@odata.nextLink": "https://graph.microsoft.com/next"}
         page2 = {"value": [{"skuId": "sku-002"}]}
@@ -178,7 +200,7 @@ class MsGraphListSubscribedSkusTestCase(TestCase):
 
 class MsGraphGetSubscribedSkuTestCase(TestCase):
     @patch.dict(os.environ, AZURE_TENANT_ENV)
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_returns_sku_data(self, mock_get):
         sku_data = {"skuId": "sku-001", "consumedUnits": 10, "prepaidUnits": {"enabled": 100, "warning": 0}}
         mock_get.return_value = mock_response(sku_data)
@@ -198,8 +220,62 @@ class MsGraphGetSubscribedSkuTestCase(TestCase):
         self.assertIsNone(result)
 
 
+def make_sku(sku_id, enabled=10, warning=0, consumed=5):
+    return {"skuId": sku_id, "prepaidUnits": {"enabled": enabled, "warning": warning}, "consumedUnits": consumed}
+
+
+class SubscribedSkuCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = SubscribedSkuCache()
+
+    @patch("organisation.utils.ms_graph_list_subscribed_skus")
+    def test_single_query_for_all_skus(self, mock_list):
+        mock_list.return_value = [make_sku("sku-1"), make_sku("sku-2", warning=2)]
+
+        self.assertEqual(self.cache.get_available("sku-1", FAKE_TOKEN), 5)
+        self.assertEqual(self.cache.get_available("sku-2", FAKE_TOKEN), 7)
+        self.assertIsNone(self.cache.get_sku("sku-3", FAKE_TOKEN))
+        mock_list.assert_called_once()
+
+    @patch("organisation.utils.ms_graph_list_subscribed_skus")
+    def test_record_assignment_decrements_availability(self, mock_list):
+        mock_list.return_value = [make_sku("sku-1")]
+
+        self.cache.get_skus(FAKE_TOKEN)
+        self.cache.record_assignment(["sku-1", "sku-unknown"])
+
+        self.assertEqual(self.cache.get_available("sku-1", FAKE_TOKEN), 4)
+        mock_list.assert_called_once()
+
+    @patch("organisation.utils.ms_graph_list_subscribed_skus")
+    def test_invalidate_refreshes(self, mock_list):
+        mock_list.return_value = [make_sku("sku-1")]
+
+        self.cache.get_skus(FAKE_TOKEN)
+        self.cache.invalidate()
+        self.cache.get_skus(FAKE_TOKEN)
+
+        self.assertEqual(mock_list.call_count, 2)
+
+    @override_settings(MS_GRAPH_SKU_CACHE_TTL=0)
+    @patch("organisation.utils.ms_graph_list_subscribed_skus")
+    def test_expired_snapshot_refreshes(self, mock_list):
+        mock_list.return_value = [make_sku("sku-1")]
+
+        self.cache.get_skus(FAKE_TOKEN)
+        self.cache.get_skus(FAKE_TOKEN)
+
+        self.assertEqual(mock_list.call_count, 2)
+
+    @patch("organisation.utils.ms_graph_list_subscribed_skus")
+    def test_query_failure_returns_none(self, mock_list):
+        mock_list.side_effect = requests.exceptions.HTTPError("503 Server Error")
+
+        self.assertIsNone(self.cache.get_available("sku-1", FAKE_TOKEN))
+
+
 class MsGraphListUsersTestCase(TestCase):
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_returns_transformed_users(self, mock_get):
         user = make_graph_user()
         mock_get.return_value = mock_response({"value": [user]})
@@ -217,7 +293,7 @@ class MsGraphListUsersTestCase(TestCase):
         # assignedLicenses maps to skuId list.
         self.assertEqual(u["assignedLicenses"], ["sku-abc-123"])
 
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_user_without_manager(self, mock_get):
         user = make_graph_user()
         # Graph API omits the "manager" key when not set.
@@ -227,7 +303,7 @@ class MsGraphListUsersTestCase(TestCase):
 
         self.assertIsNone(result[0]["manager"])
 
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_user_with_manager(self, mock_get):
         user = make_graph_user()
         user["manager"] = {"id": "mgr-guid", "mail": "manager@example.com"}
@@ -237,7 +313,7 @@ class MsGraphListUsersTestCase(TestCase):
 
         self.assertEqual(result[0]["manager"], {"id": "mgr-guid", "mail": "manager@example.com"})
 
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_paginated_results(self, mock_get):
         user1 = make_graph_user(id="guid-001", mail="a@example.com", userPrincipalName="a@example.com")
         user2 = make_graph_user(id="guid-002", mail="b@example.com", userPrincipalName="b@example.com")
@@ -249,20 +325,33 @@ class MsGraphListUsersTestCase(TestCase):
 
         self.assertEqual(len(result), 2)
 
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_licensed_filter(self, mock_get):
         licensed_user = make_graph_user(
             id="guid-001", mail="a@example.com", userPrincipalName="a@example.com", assignedLicenses=[{"skuId": "sku-1"}]
         )
-        unlicensed_user = make_graph_user(id="guid-002", mail="b@example.com", userPrincipalName="b@example.com", assignedLicenses=[])
-        mock_get.return_value = mock_response({"value": [licensed_user, unlicensed_user]})
+        # The licensed filter is applied by the Graph API.
+        mock_get.return_value = mock_response({"value": [licensed_user]})
 
         result = ms_graph_list_users(licensed=True, token=FAKE_TOKEN)
 
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]["objectId"], "guid-001")
+        params = mock_get.call_args[1]["params"]
+        self.assertEqual(params["$filter"], "assignedLicenses/$count ne 0")
+        self.assertEqual(params["$count"], "true")
+        self.assertEqual(mock_get.call_args[1]["headers"]["ConsistencyLevel"], "eventual")
+
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_combined_filters(self, mock_get):
+        mock_get.return_value = mock_response({"value": []})
+
+        ms_graph_list_users(licensed=True, enabled=True, has_employee_id=True, token=FAKE_TOKEN)
 
-    @patch("organisation.utils.requests.get")
+        params = mock_get.call_args[1]["params"]
+        self.assertEqual(params["$filter"], "assignedLicenses/$count ne 0 and accountEnabled eq true and employeeId ne null")
+
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_no_filter_returns_all(self, mock_get):
         licensed_user = make_graph_user(
             id="guid-001", mail="a@example.com", userPrincipalName="a@example.com", assignedLicenses=[{"skuId": "sku-1"}]
@@ -273,6 +362,7 @@ class MsGraphListUsersTestCase(TestCase):
         result = ms_graph_list_users(licensed=False, token=FAKE_TOKEN)
 
         self.assertEqual(len(result), 2)
+        self.assertNotIn("$filter", mock_get.call_args[1]["params"])
 
     @patch("organisation.utils.ms_graph_client_token")
     def test_returns_none_when_token_fails(self, mock_token):
@@ -282,7 +372,7 @@ class MsGraphListUsersTestCase(TestCase):
 
         self.assertIsNone(result)
 
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_null_fields_become_none(self, mock_get):
         user = make_graph_user(
             mail=None,
@@ -307,9 +397,33 @@ class MsGraphListUsersTestCase(TestCase):
         self.assertIsNone(u["displayName"])
         self.assertIsNone(u["telephoneNumber"])
 
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_fields_projection(self, mock_get):
+        mock_get.return_value = mock_response({"value": [{"id": "guid-001", "mail": "a@example.com"}]})
+
+        result = ms_graph_list_users(token=FAKE_TOKEN, fields=["id", "mail"])
+
+        self.assertEqual(result, [{"id": "guid-001", "mail": "a@example.com"}])
+        params = mock_get.call_args[1]["params"]
+        self.assertEqual(params["$select"], "id,mail")
+        self.assertNotIn("$expand", params)
+
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_fields_projection_compact(self, mock_get):
+        mock_get.return_value = mock_response(
+            {"value": [{"id": "guid-001", "mail": "a@example.com", "manager": {"id": "guid-002", "mail": "b@example.com"}}]}
+        )
+
+        result = ms_graph_list_users(token=FAKE_TOKEN, fields=["mail", "manager"], compact=True)
+
+        self.assertEqual(result, [("a@example.com", {"id": "guid-002", "mail": "b@example.com"})])
+        params = mock_get.call_args[1]["params"]
+        self.assertEqual(params["$select"], "mail")
+        self.assertIn("$expand", params)
+
 
 class MsGraphGetUserTestCase(TestCase):
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_returns_user_data(self, mock_get):
         user_data = make_graph_user()
         mock_get.return_value = mock_response(user_data)
@@ -329,8 +443,125 @@ class MsGraphGetUserTestCase(TestCase):
         self.assertIsNone(result)
 
 
+class MsGraphListMemberGroupsBatchTestCase(TestCase):
+    @patch("itassets.ms_graph.MSGraphClient.batch")
+    def test_returns_groups_by_user(self, mock_batch):
+        mock_batch.return_value = {
+            "guid-1": {"id": "guid-1", "status": 200, "body": {"value": ["group-1", "group-2"]}},
+            "guid-2": {"id": "guid-2", "status": 404, "body": {"error": {"code": "Request_ResourceNotFound"}}},
+        }
+
+        result = ms_graph_list_member_groups_batch(["guid-1", "guid-2"], token=FAKE_TOKEN)
+
+        self.assertEqual(result, {"guid-1": ["group-1", "group-2"], "guid-2": None})
+        sub_requests = mock_batch.call_args[0][0]
+        self.assertEqual(sub_requests[0]["url"], "/users/guid-1/getMemberGroups")
+        self.assertEqual(sub_requests[0]["method"], "POST")
+
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    @patch("itassets.ms_graph.MSGraphClient.batch")
+    def test_follows_next_link(self, mock_batch, mock_get):
+        mock_batch.return_value = {
+            "guid-1": {"id": "guid-1", "status": 200, "body": {"value": ["group-1"], "@odata.nextLink": "https://next"}},
+        }
+        mock_get.return_value = mock_response({"value": ["group-2"]})
+
+        result = ms_graph_list_member_groups_batch(["guid-1"], token=FAKE_TOKEN)
+
+        self.assertEqual(result["guid-1"], ["group-1", "group-2"])
+        self.assertEqual(mock_get.call_args[0][0], "https://next")
+
+    @patch("itassets.ms_graph.MSGraphClient.batch")
+    def test_batches_are_chunked(self, mock_batch):
+        mock_batch.side_effect = lambda sub_requests, headers: {
+            r["id"]: {"id": r["id"], "status": 200, "body": {"value": []}} for r in sub_requests
+        }
+
+        result = ms_graph_list_member_groups_batch([f"guid-{i}" for i in range(25)], token=FAKE_TOKEN)
+
+        self.assertEqual(mock_batch.call_count, 2)
+        self.assertEqual(len(result), 25)
+
+    @patch("itassets.ms_graph.MSGraphClient.batch")
+    def test_failed_batch_returns_none(self, mock_batch):
+        mock_batch.side_effect = requests.exceptions.HTTPError("503 Server Error")
+
+        result = ms_graph_list_member_groups_batch(["guid-1", "guid-2"], token=FAKE_TOKEN)
+
+        self.assertEqual(result, {"guid-1": None, "guid-2": None})
+
+
+class MsGraphUsersDeltaTestCase(TestCase):
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_delta_link_latest(self, mock_get):
+        mock_get.return_value = mock_response({"value": [], "@odata.deltaLink": "https://delta?$deltatoken=abc"})
+
+        result = ms_graph_users_delta_link(token=FAKE_TOKEN)
+
+        self.assertEqual(result, "https://delta?$deltatoken=abc")
+        self.assertEqual(mock_get.call_args[1]["params"]["$deltatoken"], "latest")
+
+    @patch("itassets.ms_graph.MSGraphClient.batch")
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_returns_changed_and_removed_users(self, mock_get, mock_batch):
+        user = make_graph_user()
+        mock_get.side_effect = [
+            mock_response({"value": [{"id": user["id"], "displayName": "Jane Smith"}], "@odata.nextLink": "https://next"}),
+            mock_response({"value": [{"id": "guid-removed", "@removed": {"reason": "changed"}}], "@odata.deltaLink": "https://delta-2"}),
+        ]
+        mock_batch.return_value = {user["id"]: {"id": user["id"], "status": 200, "body": user}}
+
+        changed, removed, failed, delta_link = ms_graph_list_users_delta("https://delta-1", token=FAKE_TOKEN)
+
+        # Changed users are queried in full and transformed.
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(changed[0]["objectId"], user["id"])
+        self.assertEqual(changed[0]["userPrincipalName"], "jane.smith@example.com")
+        self.assertEqual(removed, ["guid-removed"])
+        self.assertEqual(failed, [])
+        self.assertEqual(delta_link, "https://delta-2")
+        self.assertEqual(mock_get.call_args_list[0][0][0], "https://delta-1")
+        self.assertEqual(mock_batch.call_args[0][0][0]["method"], "GET")
+
+    @patch("itassets.ms_graph.MSGraphClient.batch")
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_no_changes(self, mock_get, mock_batch):
+        mock_get.return_value = mock_response({"value": [], "@odata.deltaLink": "https://delta-2"})
+
+        result = ms_graph_list_users_delta("https://delta-1", token=FAKE_TOKEN)
+
+        self.assertEqual(result, ([], [], [], "https://delta-2"))
+        mock_batch.assert_not_called()
+
+    @patch("itassets.ms_graph.MSGraphClient.batch")
+    @patch("itassets.ms_graph.MSGraphClient.get")
+    def test_returns_failed_users(self, mock_get, mock_batch):
+        user = make_graph_user()
+        mock_get.return_value = mock_response(
+            {
+                "value": [{"id": user["id"]}, {"id": "guid-throttled"}, {"id": user["id"]}, {"id": "guid-missing"}],
+                "@odata.deltaLink": "https://delta-2",
+            }
+        )
+        mock_batch.return_value = {
+            user["id"]: {"id": user["id"], "status": 200, "body": user},
+            "guid-throttled": {"id": "guid-throttled", "status": 429, "body": {}},
+        }
+
+        changed, removed, failed, delta_link = ms_graph_list_users_delta("https://delta-1", token=FAKE_TOKEN)
+
+        # Users appearing more than once in the delta are only queried once.
+        self.assertEqual(len(mock_batch.call_args[0][0]), 3)
+        self.assertEqual([az["objectId"] for az in changed], [user["id"]])
+        self.assertEqual(failed, ["guid-throttled", "guid-missing"])
+
+    @patch("organisation.utils.ms_graph_client_token", return_value=None)
+    def test_returns_none_when_token_fails(self, mock_token):
+        self.assertIsNone(ms_graph_list_users_delta("https://delta-1"))
+
+
 class MsGraphValidatePasswordTestCase(TestCase):
-    @patch("organisation.utils.requests.post")
+    @patch("itassets.ms_graph.MSGraphClient.post")
     def test_valid_password(self, mock_post):
         mock_post.return_value = mock_response({"isValid": True})
 
@@ -340,7 +571,7 @@ class MsGraphValidatePasswordTestCase(TestCase):
         called_url = mock_post.call_args[0][0]
         self.assertIn("validatePassword", called_url)
 
-    @patch("organisation.utils.requests.post")
+    @patch("itassets.ms_graph.MSGraphClient.post")
     def test_invalid_password(self, mock_post):
         mock_post.return_value = mock_response({"isValid": False})
 
@@ -358,7 +589,7 @@ class MsGraphValidatePasswordTestCase(TestCase):
 
 
 class MsGraphListSigninsUserTestCase(TestCase):
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_returns_signins(self, mock_get):
         signins = [
             {"id": "signin-001", "createdDateTime": "2024-06-01T10:00:00Z", "isInteractive": True},
@@ -372,7 +603,7 @@ class MsGraphListSigninsUserTestCase(TestCase):
         called_url = mock_get.call_args[0][0]
         self.assertIn("signIns", called_url)
 
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_passes_top_parameter(self, mock_get):
         mock_get.return_value = mock_response({"value": []})
 
@@ -381,7 +612,7 @@ class MsGraphListSigninsUserTestCase(TestCase):
         params = mock_get.call_args[1]["params"]
         self.assertEqual(params["$top"], 10)
 
-    @patch("organisation.utils.requests.get")
+    @patch("itassets.ms_graph.MSGraphClient.get")
     def test_filters_by_user_guid(self, mock_get):
         mock_get.return_value = mock_response({"value": []})
 
@@ -3,16 +3,23 @@ import random
 import re
 import string
 from datetime import datetime, timedelta
+from functools import partial
 from io import BytesIO
-from typing import Dict, Iterable, List, Optional
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
 
 import requests
 import unicodecsv as csv
 from django.conf import settings
 
+from itassets.ms_graph import BATCH_MAX_REQUESTS, get_graph_client, run_concurrently
 from itassets.utils import ms_graph_client_token, upload_blob
 
 FRESHSERVICE_AUTH = (settings.FRESHSERVICE_API_KEY, "X")
+# Entra ID user properties queried by ms_graph_list_users and related functions.
+MS_GRAPH_USER_SELECT = "id,mail,userPrincipalName,displayName,givenName,surname,employeeId,employeeType,jobTitle,businessPhones,mobilePhone,department,companyName,officeLocation,proxyAddresses,accountEnabled,onPremisesSyncEnabled,onPremisesSamAccountName,lastPasswordChangeDateTime,assignedLicenses,createdDateTime"
+MS_GRAPH_USER_EXPAND = "manager($select=id,mail)"
 
 
 def title_except(s: str, exceptions: Optional[Iterable[str]] = None, acronyms: Optional[Iterable[str]] = None) -> str:
@@ -124,19 +131,7 @@ def ms_graph_list_subscribed_skus(token: Optional[dict] = None) -> List[Dict] |
 
     headers = {"Authorization": f"{token['token_type']} {token['access_token']}"}
     url = "https://graph.microsoft.com/v1.0/subscribedSkus"
-    skus = []
-    resp = requests.get(url, headers=headers)
-    resp.raise_for_status()
-    j = resp.json()
-
-    while "@odata.nextLink" in j:
-        skus = skus + j["value"]
-        resp = requests.get(j["@odata.nextLink"], headers=headers)
-        resp.raise_for_status()
-        j = resp.json()
-
-    skus = skus + j["value"]  # Final page.
-    return skus
+    return list(get_graph_client().paginate(url, headers))
 
 
 def ms_graph_get_subscribed_sku(sku_id: str, token: Optional[dict] = None) -> Dict | None:
@@ -152,16 +147,85 @@ def ms_graph_get_subscribed_sku(sku_id: str, token: Optional[dict] = None) -> Di
     azure_tenant_id = os.environ["AZURE_TENANT_ID"]
     url = f"https://graph.microsoft.com/v1.0/subscribedSkus/{azure_tenant_id}_{sku_id}"
     try:
-        resp = requests.get(url, headers=headers)
+        resp = get_graph_client().get(url, headers=headers)
         resp.raise_for_status()
     except (requests.exceptions.HTTPError, requests.exceptions.RequestException, Exception):
         return None
     return resp.json()
 
 
-def ms_graph_list_users(licensed: bool = False, token: Optional[dict] = None) -> List[Dict] | None:
+class SubscribedSkuCache:
+    """A short-lived, process-wide snapshot of our subscribed SKUs (licence subscriptions), refreshed from a
+    single ms_graph_list_subscribed_skus query once older than MS_GRAPH_SKU_CACHE_TTL seconds.
+    Licences assigned by this process are counted against the snapshot (the Graph API reports consumedUnits
+    with some delay), so that a bulk provisioning run stays accurate without re-querying each SKU.
+    Call invalidate() where the outcome of a licence assignment is unknown.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        """Discard the snapshot, so that it is refreshed on next use."""
+        self.skus = {}
+        self.refreshed = 0
+
+    def get_skus(self, token: Optional[dict] = None) -> Dict | None:
+        """Returns the snapshot as a dict of {skuId: subscribedSku}, refreshing it if required."""
+        with self.lock:
+            if not self.skus or monotonic() - self.refreshed >= settings.MS_GRAPH_SKU_CACHE_TTL:
+                try:
+                    skus = ms_graph_list_subscribed_skus(token)
+                except requests.exceptions.RequestException:
+                    skus = None
+                if not skus:
+                    return None
+                self.skus = {sku["skuId"]: sku for sku in skus}
+                self.refreshed = monotonic()
+            return self.skus
+
+    def get_sku(self, sku_id: str, token: Optional[dict] = None) -> Dict | None:
+        """Returns a copy of the subscribedSku for the passed-in skuId, or None if unavailable."""
+        skus = self.get_skus(token)
+        if not skus or sku_id not in skus:
+            return None
+        return dict(skus[sku_id])
+
+    def get_available(self, sku_id: str, token: Optional[dict] = None) -> int | None:
+        """Returns the number of licences of the passed-in skuId available to be assigned.
+        Only "enabled" and "warning" prepaid units can be assigned to users.
+        """
+        sku = self.get_sku(sku_id, token)
+        if not sku:
+            return None
+        return sku["prepaidUnits"]["enabled"] + sku["prepaidUnits"]["warning"] - sku["consumedUnits"]
+
+    def record_assignment(self, sku_ids: Iterable[str]):
+        """Count one licence of each of the passed-in skuIds as consumed in the snapshot."""
+        with self.lock:
+            for sku_id in sku_ids:
+                if sku_id in self.skus:
+                    self.skus[sku_id]["consumedUnits"] += 1
+
+
+SUBSCRIBED_SKU_CACHE = SubscribedSkuCache()
+
+
+def ms_graph_list_users(
+    licensed: bool = False,
+    token: Optional[dict] = None,
+    fields: Optional[Sequence[str]] = None,
+    compact: bool = False,
+    enabled: Optional[bool] = None,
+    has_employee_id: bool = False,
+) -> List | None:
     """Query the Microsoft Graph API for Entra ID user accounts in our tenancy.
     Passing `licensed=True` will return only those users having >0 licenses assigned.
+    Pass `enabled=True/False` to return only enabled/disabled accounts, and `has_employee_id=True`
+    to return only those users having an employeeId value. These filters are applied by the Graph API.
+    Pass a list of user properties as `fields` to query only those properties (see ms_graph_iter_users),
+    and `compact=True` to return each user as a tuple of those values.
     Reference: https://learn.microsoft.com/en-us/graph/api/user-list
     """
     if not token:
@@ -169,62 +233,179 @@ def ms_graph_list_users(licensed: bool = False, token: Optional[dict] = None) ->
     if not token:  # The call to the MS API occasionally fails.
         return None
 
+    users = ms_graph_iter_users(token, licensed=licensed, fields=fields, compact=compact, enabled=enabled, has_employee_id=has_employee_id)
+    return list(users)
+
+
+def ms_graph_iter_users(
+    token: dict,
+    page_size: Optional[int] = None,
+    licensed: bool = False,
+    fields: Optional[Sequence[str]] = None,
+    compact: bool = False,
+    enabled: Optional[bool] = None,
+    has_employee_id: bool = False,
+) -> Iterator:
+    """Query the Microsoft Graph API for Entra ID user accounts in our tenancy, yielding each user
+    (transformed as per ms_graph_list_users) as each page of results is received.
+    Filters (`licensed`, `enabled`, `has_employee_id`) are applied server-side as advanced queries,
+    so only matching users are returned.
+    Pass a list of Graph API user properties as `fields` to select only those properties (include "manager"
+    to expand the user's manager); each user is then yielded as a dict of the untransformed property values,
+    or as a tuple of the values in `fields` order if `compact=True`.
+    Reference: https://learn.microsoft.com/en-us/graph/query-parameters
+    Reference: https://learn.microsoft.com/en-us/graph/aad-advanced-queries
+    """
+    headers = {
+        "Authorization": f"Bearer {token['access_token']}",
+        "ConsistencyLevel": "eventual",
+    }
+    if fields:
+        params = {"$select": ",".join(field for field in fields if field != "manager")}
+        if "manager" in fields:
+            params["$expand"] = MS_GRAPH_USER_EXPAND
+    else:
+        params = {
+            "$select": MS_GRAPH_USER_SELECT,
+            "$expand": MS_GRAPH_USER_EXPAND,
+        }
+
+    filters = []
+    if licensed:
+        filters.append("assignedLicenses/$count ne 0")
+    if enabled is not None:
+        filters.append(f"accountEnabled eq {str(enabled).lower()}")
+    if has_employee_id:
+        filters.append("employeeId ne null")
+    if filters:
+        # These filters are advanced queries, requiring $count and the ConsistencyLevel header.
+        params["$filter"] = " and ".join(filters)
+        params["$count"] = "true"
+
+    url = "https://graph.microsoft.com/v1.0/users"
+
+    for user in get_graph_client().paginate(url, headers, params=params, page_size=page_size or settings.MS_GRAPH_PAGE_SIZE):
+        if not fields:
+            yield ms_graph_transform_user(user)
+        elif compact:
+            yield tuple(user.get(field) for field in fields)
+        else:
+            yield {field: user.get(field) for field in fields}
+
+
+def ms_graph_transform_user(user: dict) -> dict:
+    """Transform an Entra ID user returned by the Microsoft Graph API (having the properties in
+    MS_GRAPH_USER_SELECT) into the dict format that we cache on DepartmentUser objects.
+    """
+    return {
+        "objectId": user["id"],
+        "userPrincipalName": user["userPrincipalName"].lower(),
+        "mail": user["mail"].lower() if user["mail"] else None,
+        "displayName": user["displayName"] if user["displayName"] else None,
+        "givenName": user["givenName"] if user["givenName"] else None,
+        "surname": user["surname"] if user["surname"] else None,
+        "employeeId": user["employeeId"] if user["employeeId"] else None,
+        "employeeType": user["employeeType"] if user["employeeType"] else None,
+        "jobTitle": user["jobTitle"] if user["jobTitle"] else None,
+        "telephoneNumber": user["businessPhones"][0] if user["businessPhones"] else None,
+        "mobilePhone": user["mobilePhone"] if user["mobilePhone"] else None,
+        "department": user["department"] if user["department"] else None,
+        "companyName": user["companyName"] if user["companyName"] else None,
+        "officeLocation": user["officeLocation"] if user["officeLocation"] else None,
+        "proxyAddresses": [i.lower().replace("smtp:", "") for i in user["proxyAddresses"] if i.lower().startswith("smtp")],
+        "accountEnabled": user["accountEnabled"],
+        "onPremisesSyncEnabled": user["onPremisesSyncEnabled"],
+        "onPremisesSamAccountName": user["onPremisesSamAccountName"],
+        "lastPasswordChangeDateTime": user["lastPasswordChangeDateTime"],
+        "createdDateTime": user["createdDateTime"],
+        "assignedLicenses": [i["skuId"] for i in user["assignedLicenses"]],
+        "manager": {"id": user["manager"]["id"], "mail": user["manager"]["mail"]} if "manager" in user else None,
+    }
+
+
+def ms_graph_get_users_batch(azure_guids: Iterable[str], token: Optional[dict] = None) -> Dict | None:
+    """Query the Microsoft Graph API for each of the passed-in Entra ID user accounts using JSON batching.
+    Returns a dict of {azure_guid: user} (transformed as per ms_graph_list_users), where the value is
+    None for any user whose query failed.
+    """
+    if not token:
+        token = ms_graph_client_token()
+    if not token:  # The call to the MS API occasionally fails.
+        return None
+
     headers = {
         "Authorization": f"Bearer {token['access_token']}",
         "ConsistencyLevel": "eventual",
     }
+    query = f"$select={MS_GRAPH_USER_SELECT}&$expand={MS_GRAPH_USER_EXPAND}"
+    sub_requests = [{"id": guid, "method": "GET", "url": f"/users/{guid}?{query}"} for guid in azure_guids]
+    responses = get_graph_client().batch(sub_requests, headers=headers)
+    return {
+        guid: ms_graph_transform_user(sub_response["body"]) if sub_response["status"] == 200 else None
+        for guid, sub_response in responses.items()
+    }
+
+
+def ms_graph_users_delta_link(token: Optional[dict] = None) -> str | None:
+    """Query the Microsoft Graph API for a delta link that tracks changes to Entra ID user accounts
+    from this point onwards, without returning the current state of all users.
+    Reference: https://learn.microsoft.com/en-us/graph/delta-query-overview
+    """
+    if not token:
+        token = ms_graph_client_token()
+    if not token:  # The call to the MS API occasionally fails.
+        return None
+
+    headers = {"Authorization": f"Bearer {token['access_token']}"}
     params = {
-        "$select": "id,mail,userPrincipalName,displayName,givenName,surname,employeeId,employeeType,jobTitle,businessPhones,mobilePhone,department,companyName,officeLocation,proxyAddresses,accountEnabled,onPremisesSyncEnabled,onPremisesSamAccountName,lastPasswordChangeDateTime,assignedLicenses,createdDateTime",
-        "$expand": "manager($select=id,mail)",
+        "$select": MS_GRAPH_USER_SELECT,
+        "$expand": MS_GRAPH_USER_EXPAND,
+        "$deltatoken": "latest",
     }
-    url = "https://graph.microsoft.com/v1.0/users"
-    resp = requests.get(url, headers=headers, params=params)
+    url = "https://graph.microsoft.com/v1.0/users/delta"
+    resp = get_graph_client().get(url, headers=headers, params=params)
     resp.raise_for_status()
-    j = resp.json()
-    users = []
+    return resp.json()["@odata.deltaLink"]
 
-    while "@odata.nextLink" in j:
-        users = users + j["value"]
-        resp = requests.get(j["@odata.nextLink"], headers=headers)
-        resp.raise_for_status()
-        j = resp.json()
-
-    users = users + j["value"]  # Final page
-    entra_users = []
-
-    # Transform the returned data.
-    for user in users:
-        user_data = {
-            "objectId": user["id"],
-            "userPrincipalName": user["userPrincipalName"].lower(),
-            "mail": user["mail"].lower() if user["mail"] else None,
-            "displayName": user["displayName"] if user["displayName"] else None,
-            "givenName": user["givenName"] if user["givenName"] else None,
-            "surname": user["surname"] if user["surname"] else None,
-            "employeeId": user["employeeId"] if user["employeeId"] else None,
-            "employeeType": user["employeeType"] if user["employeeType"] else None,
-            "jobTitle": user["jobTitle"] if user["jobTitle"] else None,
-            "telephoneNumber": user["businessPhones"][0] if user["businessPhones"] else None,
-            "mobilePhone": user["mobilePhone"] if user["mobilePhone"] else None,
-            "department": user["department"] if user["department"] else None,
-            "companyName": user["companyName"] if user["companyName"] else None,
-            "officeLocation": user["officeLocation"] if user["officeLocation"] else None,
-            "proxyAddresses": [i.lower().replace("smtp:", "") for i in user["proxyAddresses"] if i.lower().startswith("smtp")],
-            "accountEnabled": user["accountEnabled"],
-            "onPremisesSyncEnabled": user["onPremisesSyncEnabled"],
-            "onPremisesSamAccountName": user["onPremisesSamAccountName"],
-            "lastPasswordChangeDateTime": user["lastPasswordChangeDateTime"],
-            "createdDateTime": user["createdDateTime"],
-            "assignedLicenses": [i["skuId"] for i in user["assignedLicenses"]],
-            "manager": {"id": user["manager"]["id"], "mail": user["manager"]["mail"]} if "manager" in user else None,
-        }
 
-        entra_users.append(user_data)
+def ms_graph_list_users_delta(delta_link: str, token: Optional[dict] = None) -> tuple | None:
+    """Query the Microsoft Graph API for Entra ID user accounts created, changed or deleted since the
+    passed-in delta link was issued. Returns a tuple:
+    ([changed users], [removed user IDs], [failed user IDs], new delta link).
+    Changed users are queried in full and transformed as per ms_graph_list_users. The IDs of changed users
+    which could not be queried are returned as failed, as their changes are not included in the results.
+    Raises a HTTPError having status 410 if the delta link has expired, in which case a full sync is required.
+    Reference: https://learn.microsoft.com/en-us/graph/api/user-delta
+    """
+    if not token:
+        token = ms_graph_client_token()
+    if not token:  # The call to the MS API occasionally fails.
+        return None
 
-    if licensed:
-        return [u for u in entra_users if u["assignedLicenses"]]
-    else:
-        return entra_users
+    headers = {"Authorization": f"Bearer {token['access_token']}"}
+    # Dicts are used as insertion-ordered sets (a user may appear more than once in the delta pages).
+    changed_guids = {}
+    removed_guids = {}
+
+    for page in get_graph_client().iter_pages(delta_link, headers):
+        for user in page["value"]:
+            if "@removed" in user:
+                removed_guids[user["id"]] = None
+            else:
+                changed_guids[user["id"]] = None
+
+    # Delta responses may only include the changed properties, so query each changed user in full.
+    changed_users = []
+    failed_guids = []
+    if changed_guids:
+        users = ms_graph_get_users_batch(changed_guids, token=token)
+        for guid in changed_guids:
+            if users.get(guid):
+                changed_users.append(users[guid])
+            else:
+                failed_guids.append(guid)
+
+    return (changed_users, list(removed_guids), failed_guids, page["@odata.deltaLink"])
 
 
 def ms_graph_get_user(azure_guid: str, token: Optional[dict] = None) -> Dict | None:
@@ -242,7 +423,7 @@ def ms_graph_get_user(azure_guid: str, token: Optional[dict] = None) -> Dict | N
         "$expand": "manager($select=id,mail)",
     }
     url = f"https://graph.microsoft.com/v1.0/users/{azure_guid}"
-    resp = requests.get(url, headers=headers, params=params)
+    resp = get_graph_client().get(url, headers=headers, params=params)
     resp.raise_for_status()
     return resp.json()
 
@@ -261,7 +442,7 @@ def ms_graph_get_group(azure_guid: str, token: Optional[dict] = None) -> Dict |
         "$select": "id,displayName,description,mail,securityEnabled,assignedLicenses",
     }
     url = f"https://graph.microsoft.com/v1.0/groups/{azure_guid}"
-    resp = requests.get(url, headers=headers, params=params)
+    resp = get_graph_client().get(url, headers=headers, params=params)
     resp.raise_for_status()
     return resp.json()
 
@@ -277,21 +458,64 @@ def ms_graph_list_member_groups(azure_guid: str, token: Optional[dict] = None) -
     }
     payload = {"securityEnabledOnly": False}
     url = f"https://graph.microsoft.com/v1.0/users/{azure_guid}/getMemberGroups"
-    resp = requests.post(url, headers=headers, json=payload)
+    resp = get_graph_client().post(url, headers=headers, json=payload)
     resp.raise_for_status()
-    j = resp.json()
     groups = []
 
-    while "@odata.nextLink" in j:
-        groups = groups + j["value"]
-        resp = requests.get(j["@odata.nextLink"], headers=headers)
-        resp.raise_for_status()
-        j = resp.json()
+    for page in get_graph_client().follow_pages(resp.json(), headers):
+        groups.extend(page["value"])
 
-    groups = groups + j["value"]  # Final page.
     return groups
 
 
+def ms_graph_list_member_groups_batch(azure_guids: Iterable[str], token: Optional[dict] = None) -> Dict | None:
+    """Query the Microsoft Graph API for the groups of each of the passed-in Entra ID user accounts,
+    using JSON batching (with batches sent concurrently). Returns a dict of {azure_guid: [groups]},
+    where the value is None for any user whose query failed.
+    """
+    if not token:
+        token = ms_graph_client_token()
+    if not token:  # The call to the MS API occasionally fails and returns None.
+        return None
+    headers = {
+        "Authorization": f"Bearer {token['access_token']}",
+        "ConsistencyLevel": "eventual",
+    }
+    sub_requests = [
+        {"id": guid, "method": "POST", "url": f"/users/{guid}/getMemberGroups", "body": {"securityEnabledOnly": False}}
+        for guid in azure_guids
+    ]
+    chunks = [sub_requests[i : i + BATCH_MAX_REQUESTS] for i in range(0, len(sub_requests), BATCH_MAX_REQUESTS)]
+    results = run_concurrently([partial(_ms_graph_member_groups_chunk, chunk, headers) for chunk in chunks])
+    member_groups = {}
+
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            member_groups.update({sub_request["id"]: None for sub_request in chunk})
+        else:
+            member_groups.update(result)
+
+    return member_groups
+
+
+def _ms_graph_member_groups_chunk(sub_requests: List[Dict], headers: Dict) -> Dict:
+    """Execute a single JSON batch of getMemberGroups sub-requests, following any further pages of groups."""
+    responses = get_graph_client().batch(sub_requests, headers=headers)
+    member_groups = {}
+
+    for guid, sub_response in responses.items():
+        if sub_response["status"] != 200:
+            member_groups[guid] = None
+            continue
+
+        groups = []
+        for page in get_graph_client().follow_pages(sub_response["body"], headers):
+            groups.extend(page["value"])
+        member_groups[guid] = groups
+
+    return member_groups
+
+
 def ms_graph_validate_password(password: str, token: Optional[dict] = None) -> bool | None:
     """Query the Microsoft Graph API (beta) if a given password string validates complexity requirements."""
     if not token:
@@ -302,7 +526,7 @@ def ms_graph_validate_password(password: str, token: Optional[dict] = None) -> b
         "Authorization": f"Bearer {token['access_token']}",
     }
     url = "https://graph.microsoft.com/beta/users/validatePassword"
-    resp = requests.post(url, headers=headers, json={"password": password})
+    resp = get_graph_client().post(url, headers=headers, json={"password": password})
     res = resp.json()
     return res["isValid"]
 
@@ -320,22 +544,12 @@ def ms_graph_list_sites(team_sites: bool = True, token: Optional[dict] = None) -
         "ConsistencyLevel": "eventual",
     }
     url = "https://graph.microsoft.com/v1.0/sites"
-    resp = requests.get(url, headers=headers)
-    resp.raise_for_status()
-    j = resp.json()
+    sites = get_graph_client().paginate(url, headers)
 
-    sites = []
-    while "@odata.nextLink" in j:
-        sites = sites + j["value"]
-        resp = requests.get(j["@odata.nextLink"], headers=headers)
-        resp.raise_for_status()
-        j = resp.json()
-
-    sites = sites + j["value"]  # Final page.
     if team_sites:
-        sites = [site for site in sites if "teams" in site["webUrl"]]
+        return [site for site in sites if "teams" in site["webUrl"]]
 
-    return sites
+    return list(sites)
 
 
 def ms_graph_get_site(site_id: str, token: Optional[Dict] = None) -> Dict | None:
@@ -350,7 +564,7 @@ def ms_graph_get_site(site_id: str, token: Optional[Dict] = None) -> Dict | None
         "Authorization": f"Bearer {token['access_token']}",
     }
     url = f"https://graph.microsoft.com/v1.0/sites/{site_id}"
-    resp = requests.get(url, headers=headers)
+    resp = get_graph_client().get(url, headers=headers)
     resp.raise_for_status()
 
     return resp.json()
@@ -372,7 +586,7 @@ def ms_graph_site_storage_usage(period_value: str = "D7", token: Optional[Dict]
         "ConsistencyLevel": "eventual",
     }
     url = f"https://graph.microsoft.com/v1.0/reports/getSharePointSiteUsageDetail(period='{period_value}')"
-    resp = requests.get(url, headers=headers)
+    resp = get_graph_client().get(url, headers=headers)
     resp.raise_for_status()
 
     return resp.content
@@ -398,21 +612,20 @@ def ms_graph_site_storage_summary(ds: Optional[str] = None, token: Optional[Dict
     writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
     writer.writerow([header_row[0], header_row[2], header_row[5], header_row[6], header_row[10]])
 
-    for row in storage_csv[1:]:
-        row = row.decode()
-        row = row.split(",")
-        # We're only interested in some of the report output.
-        if int(row[10]) >= 1024 * 1024 * 1024:  # Only return rows >= 1 GB.
-            # TEMP FIX: Microsoft reported an issue where usage reports are incomplete for Sharepoint.
-            # Query each site ID to get the site URL.
-            # Ref: https://stackoverflow.com/a/77550299/14508
-            site_id = row[1]
-            try:
-                site_json = ms_graph_get_site(site_id, token)
-                site_url = site_json["webUrl"].replace("https://dpaw.sharepoint.com", "")
-            except:
-                site_url = ""
-            writer.writerow([row[0], site_url, row[5], int(row[6]), int(row[10])])
+    # We're only interested in some of the report output: only return rows >= 1 GB.
+    rows = [row.decode().split(",") for row in storage_csv[1:]]
+    rows = [row for row in rows if int(row[10]) >= 1024 * 1024 * 1024]
+    # TEMP FIX: Microsoft reported an issue where usage reports are incomplete for Sharepoint.
+    # Query each site ID (concurrently) to get the site URL.
+    # Ref: https://stackoverflow.com/a/77550299/14508
+    sites = run_concurrently([partial(ms_graph_get_site, row[1], token) for row in rows])
+
+    for row, site_json in zip(rows, sites):
+        try:
+            site_url = site_json["webUrl"].replace("https://dpaw.sharepoint.com", "")
+        except:
+            site_url = ""
+        writer.writerow([row[0], site_url, row[5], int(row[6]), int(row[10])])
 
     f.seek(0)
     blob_name = f"storage/site_storage_usage_{ds}.csv"
@@ -436,7 +649,7 @@ def ms_graph_list_signins_user(azure_guid: str, top: int = 5, token: dict | None
         "$filter": f"(userId eq '{azure_guid}' and isInteractive eq true and status/errorCode eq 0)",
     }
     url = "https://graph.microsoft.com/v1.0/auditLogs/signIns"
-    resp = requests.get(url, headers=headers, params=params)
+    resp = get_graph_client().get(url, headers=headers, params=params)
     resp.raise_for_status()
     j = resp.json()
     return j["value"]
@@ -453,6 +666,33 @@ def compare_values(a, b) -> bool:
     return a == b
 
 
+def normalise_payload_value(value):
+    """Normalise a value from a cached user account payload for comparison: 'falsy' values are None,
+    strings are stripped of whitespace and lists are sorted (their order is not significant).
+    """
+    if not value and value is not False:
+        return None
+    if isinstance(value, str):
+        return value.strip() or None
+    if isinstance(value, (list, tuple)):
+        return sorted((normalise_payload_value(i) for i in value), key=str)
+    if isinstance(value, dict):
+        return {k: normalise_payload_value(v) for k, v in value.items()}
+    return value
+
+
+def payload_changes(cached: Optional[dict], payload: dict) -> set:
+    """Returns the set of keys whose normalised values differ between a cached user account payload
+    and a newly-queried one (an empty set if there is no material change).
+    """
+    cached = cached or {}
+    return {
+        key
+        for key in cached.keys() | payload.keys()
+        if normalise_payload_value(cached.get(key)) != normalise_payload_value(payload.get(key))
+    }
+
+
 def parse_windows_ts(ts: str) -> datetime | None:
     """Parse the string repr of Windows timestamp output, a 64-bit value representing the number of
     100-nanoseconds elapsed since January 1, 1601 (UTC).
@@ -11,6 +11,7 @@ from django.views.generic import ListView, View
 
 from itassets.utils import get_next_pages, get_previous_pages
 
+from .microsoft_products import MS_USER_LICENCES
 from .models import CostCentre, DepartmentUser, Location
 from .reports import department_user_export, user_account_export
 
@@ -72,12 +73,7 @@ class UserAccounts(LoginRequiredMixin, ListView):
         # Initial queryset: accounts associated with a M365 account, having an appropriate license assigned.
         queryset = (
             DepartmentUser.objects.filter(azure_guid__isnull=False)
-            .filter(
-                Q(assigned_licences__contains=["MICROSOFT 365 E5"])
-                | Q(assigned_licences__contains=["MICROSOFT 365 F3"])
-                | Q(assigned_licences__contains=["OFFICE 365 E5"])
-                | Q(assigned_licences__contains=["OFFICE 365 E1"])
-            )
+            .filter(assigned_licences__overlap=MS_USER_LICENCES)
             .select_related(
                 "cost_centre",
             )
@@ -234,12 +230,7 @@ class LicenseAPIResource(View):
             DepartmentUser.objects.filter(
                 active=True,
             )
-            .filter(
-                Q(assigned_licences__contains=["MICROSOFT 365 E5"])
-                | Q(assigned_licences__contains=["MICROSOFT 365 F3"])
-                | Q(assigned_licences__contains=["OFFICE 365 E5"])
-                | Q(assigned_licences__contains=["OFFICE 365 E1"])
-            )
+            .filter(assigned_licences__overlap=MS_USER_LICENCES)
             .select_related(
                 "cost_centre",
             )
@@ -1,7 +1,8 @@
+from django.conf import settings
 from django.db.models import Q
 from django.utils.text import smart_split
 from functools import reduce
-import requests
+from itassets.ms_graph import get_graph_client
 from itassets.utils import ms_graph_client_token
 
 
@@ -43,17 +44,7 @@ def ms_graph_sharepoint_users():
         "ConsistencyLevel": "eventual",
     }
     url = "https://graph.microsoft.com/v1.0/sites/dpaw.sharepoint.com/lists/a9a3eaf6-6580-4506-b7ac-73b621b5ab7a/items?expand=fields"
-    sharepoint_users = []
-    resp = requests.get(url, headers=headers)
-    j = resp.json()
-
-    while "@odata.nextLink" in j:
-        sharepoint_users = sharepoint_users + j["value"]
-        resp = requests.get(j["@odata.nextLink"], headers=headers)
-        resp.raise_for_status()
-        j = resp.json()
-
-    sharepoint_users = sharepoint_users + j["value"]  # Final page
+    sharepoint_users = get_graph_client().paginate(url, headers, page_size=settings.MS_GRAPH_PAGE_SIZE)
     return [user["fields"] for user in sharepoint_users]
 
 
@@ -67,15 +58,5 @@ def ms_graph_sharepoint_it_systems():
         "ConsistencyLevel": "eventual",
     }
     url = "https://graph.microsoft.com/v1.0/sites/dpaw.sharepoint.com,485537cf-e72c-431d-9d71-f5101df1f274,2091d73c-5d12-4d02-ac11-fdbe889a6d95/lists/65703834-92c6-4de6-9d10-83862730115f/items?expand=fields"
-    it_systems = []
-    resp = requests.get(url, headers=headers)
-    j = resp.json()
-
-    while "@odata.nextLink" in j:
-        it_systems = it_systems + j["value"]
-        resp = requests.get(j["@odata.nextLink"], headers=headers)
-        resp.raise_for_status()
-        j = resp.json()
-
-    it_systems = it_systems + j["value"]
+    it_systems = get_graph_client().paginate(url, headers, page_size=settings.MS_GRAPH_PAGE_SIZE)
     return [system["fields"] for system in it_systems]